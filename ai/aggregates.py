@@ -0,0 +1,319 @@
+"""
+FASE 3 - Tablas de Resumen
+Mantiene tablas de resumen sobre DCitas (citas y duración por día, odontólogo, estado y
+tratamiento) que se actualizan de forma incremental: solo se recalculan los días cuya
+huella (recuento + CHECKSUM_AGG) ha cambiado. Las peticiones de estadísticas en lenguaje
+natural que encajan se responden desde el resumen sin pasar por el modelo ni por DCitas
+"""
+
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from datetime import date, timedelta
+
+from sql_cache import normalize_request
+from sql_rewriter import day_serial
+
+
+# Resumen: tabla destino, tabla origen, columna de día, dimensiones, medidas y columnas de la huella
+AggregateDefinition = namedtuple(
+    'AggregateDefinition', 'name source date_column dimensions measures checksum_columns'
+)
+
+CITAS_DIA = AggregateDefinition(
+    name='RESUMEN_CITAS_DIA',
+    source='DCitas',
+    date_column='Fecha',
+    dimensions=('IdUsu', 'IdSitC', 'IdIcono'),
+    measures=(('citas', 'INT', 'COUNT(*)'),
+              ('duracion_total', 'BIGINT', 'SUM(CAST(ISNULL(Duracion, 0) AS BIGINT))')),
+    checksum_columns=('IdOrden', 'IdUsu', 'IdSitC', 'IdIcono', 'Duracion'),
+)
+
+AGGREGATES = [CITAS_DIA]
+
+# Huellas por día de cada resumen (para saber qué días recalcular)
+FINGERPRINT_TABLE = 'RESUMEN_HUELLAS'
+
+# Parámetros por sentencia (SQL Server admite 2100)
+_CHUNK = 500
+
+# Ruta de una petición al resumen: SQL, resumen usado y dimensiones
+AggregateRoute = namedtuple('AggregateRoute', 'sql aggregate dimensions period')
+
+# Dimensiones reconocidas en la petición normalizada
+_DIMENSION_PATTERNS = [
+    ('IdUsu', re.compile(r'\bpor (?:cada )?(?:doctor|doctora|odontolog[oa]|dentista|profesional|medico|usuario)s?\b')),
+    ('IdSitC', re.compile(r'\btasa de (?:cancelacion|anulacion)\w*|\b(?:cancelaciones|anulaciones)\b|\bpor estados?\b')),
+    ('IdIcono', re.compile(r'\btratamientos? mas frecuentes\b|\bpor (?:tipo de )?tratamientos?\b')),
+    ('Fecha', re.compile(r'\bpor dias?\b|\bcada dia\b|\bdiari[oa]s?\b')),
+]
+_STATISTIC = re.compile(r'\b(?:cuant[oa]s|numero|total|tasa|porcentaje|estadisticas?|resumen|frecuentes|por)\b')
+_SUBJECT = re.compile(r'\b(?:citas?|cancelacion|anulacion|cancelaciones|anulaciones|tratamientos?)\b')
+
+# Periodos canónicos de normalize_request
+_PERIODS = re.compile(r'\b(?P<day>\d{4}-\d{2}-\d{2})\b|\bsemana (?P<week>\d{4}-W\d{2})\b|\bmes (?P<month>\d{4}-\d{2})\b')
+
+# Palabras que pueden acompañar a una estadística sin cambiar su significado. Cualquier otra
+# (un paciente, una hora, otro filtro) hace que la petición vaya al modelo
+_VOCABULARY = set("""
+    a al algun cada cancelacion cancelaciones anulacion anulaciones cita citas cual cuales cuantas cuantos
+    dame de del dia diaria diario dias doctor doctora doctores el en es esta estado estados estadisticas
+    fue frecuentes hay la las lista los mas me medico medicos muestrame numero odontologa odontologo
+    odontologos para por porcentaje profesional profesionales que quiero resumen semana tasa tenemos
+    tipo total tratamiento tratamientos un una usuario usuarios ver y dentista dentistas mes
+""".split())
+
+
+def _period_range(match):
+    """(primer día, último día) de un periodo canónico"""
+    if match.group('day'):
+        day = date.fromisoformat(match.group('day'))
+        return day, day
+    if match.group('week'):
+        year, week = match.group('week').split('-W')
+        start = date.fromisocalendar(int(year), int(week), 1)
+        return start, start + timedelta(days=6)
+    year, month = (int(part) for part in match.group('month').split('-'))
+    start = date(year, month, 1)
+    return start, (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+
+class AggregateManager:
+    """Crea, actualiza de forma incremental y consulta las tablas de resumen"""
+    
+    def __init__(self, db_connection, aggregates=None, refresh_interval=None, hot_days=None):
+        self.db = db_connection
+        self.aggregates = list(aggregates or AGGREGATES)
+        if refresh_interval is None:
+            refresh_interval = float(os.getenv('IA_AGG_REFRESH_SECONDS', '60'))
+        if hot_days is None:
+            hot_days = int(os.getenv('IA_AGG_HOT_DAYS', '90'))
+        self.refresh_interval = refresh_interval
+        # Las actualizaciones periódicas solo comparan días desde hoy - hot_days; full=True compara todo
+        self.hot_days = hot_days
+        self.enabled = os.getenv('IA_AGGREGATES', '1') != '0'
+        self._available = None
+        self._last_refresh = None
+        self._lock = threading.Lock()
+        self.stats = {'refreshes': 0, 'days_checked': 0, 'days_recomputed': 0, 'routed': 0}
+    
+    def setup(self):
+        """Crea las tablas de resumen y de huellas si no existen"""
+        for aggregate in self.aggregates:
+            columns = [f"{aggregate.date_column} INT NOT NULL"]
+            columns += [f"{dimension} INT NOT NULL" for dimension in aggregate.dimensions]
+            columns += [f"{name} {sql_type} NOT NULL" for name, sql_type, _ in aggregate.measures]
+            key = ', '.join((aggregate.date_column,) + aggregate.dimensions)
+            self.db.execute_query(f"""
+                IF OBJECT_ID('{aggregate.name}') IS NULL
+                CREATE TABLE {aggregate.name} (
+                    {', '.join(columns)},
+                    CONSTRAINT PK_{aggregate.name} PRIMARY KEY ({key})
+                )
+            """)
+        self.db.execute_query(f"""
+            IF OBJECT_ID('{FINGERPRINT_TABLE}') IS NULL
+            CREATE TABLE {FINGERPRINT_TABLE} (
+                resumen VARCHAR(64) NOT NULL,
+                dia INT NOT NULL,
+                filas BIGINT NOT NULL,
+                huella INT NOT NULL,
+                CONSTRAINT PK_{FINGERPRINT_TABLE} PRIMARY KEY (resumen, dia)
+            )
+        """)
+        self._available = True
+        print(f"✅ Tablas de resumen listas: {', '.join(a.name for a in self.aggregates)}")
+    
+    def available(self):
+        """True si las tablas de resumen existen (se comprueba una vez)"""
+        if not self.enabled or not self.db:
+            return False
+        if self._available is None:
+            try:
+                names = [a.name for a in self.aggregates] + [FINGERPRINT_TABLE]
+                rows = self.db.execute_query(
+                    "SELECT COUNT(*) AS total FROM sys.tables WHERE name IN ("
+                    + ', '.join('?' * len(names)) + ")", names)
+                self._available = rows[0]['total'] == len(names)
+            except Exception as e:
+                print(f"⚠️  No se pudo comprobar las tablas de resumen: {e}")
+                self._available = False
+        return self._available
+    
+    def _current_fingerprints(self, aggregate, since):
+        """{día: (filas, huella)} de la tabla origen desde el día 'since' (todos si es None)"""
+        where = f"{aggregate.date_column} IS NOT NULL"
+        params = None
+        if since is not None:
+            where = f"{aggregate.date_column} >= ?"
+            params = [since]
+        rows = self.db.execute_query(f"""
+            SELECT {aggregate.date_column} AS dia, COUNT_BIG(*) AS filas,
+                   CHECKSUM_AGG(BINARY_CHECKSUM({', '.join(aggregate.checksum_columns)})) AS huella
+            FROM {aggregate.source}
+            WHERE {where}
+            GROUP BY {aggregate.date_column}
+        """, params)
+        return {row['dia']: (row['filas'], row['huella'] or 0) for row in rows}
+    
+    def _stored_fingerprints(self, aggregate, since):
+        query = f"SELECT dia, filas, huella FROM {FINGERPRINT_TABLE} WHERE resumen = ?"
+        params = [aggregate.name]
+        if since is not None:
+            query += " AND dia >= ?"
+            params.append(since)
+        return {row['dia']: (row['filas'], row['huella']) for row in self.db.execute_query(query, params)}
+    
+    def refresh(self, full=False):
+        """Recalcula los días cambiados de cada resumen; devuelve {resumen: días recalculados}"""
+        since = None if full else day_serial(date.today()) - self.hot_days
+        changed = {}
+        for aggregate in self.aggregates:
+            current = self._current_fingerprints(aggregate, since)
+            stored = self._stored_fingerprints(aggregate, since)
+            days = sorted(day for day in set(current) | set(stored) if current.get(day) != stored.get(day))
+            self.stats['days_checked'] += len(current)
+            if days:
+                self._recompute(aggregate, days, current)
+            changed[aggregate.name] = len(days)
+            self.stats['days_recomputed'] += len(days)
+        
+        self.stats['refreshes'] += 1
+        self._last_refresh = time.monotonic()
+        return changed
+    
+    def _recompute(self, aggregate, days, current):
+        """Sustituye en una transacción las filas de resumen y las huellas de los días dados"""
+        keys = ', '.join(f"ISNULL({d}, -1)" for d in aggregate.dimensions)
+        measures = ', '.join(expression for _, _, expression in aggregate.measures)
+        columns = ', '.join((aggregate.date_column,) + aggregate.dimensions
+                            + tuple(name for name, _, _ in aggregate.measures))
+        with self.db.transaction():
+            for start in range(0, len(days), _CHUNK):
+                chunk = days[start:start + _CHUNK]
+                marks = ', '.join('?' * len(chunk))
+                self.db.execute_query(
+                    f"DELETE FROM {aggregate.name} WHERE {aggregate.date_column} IN ({marks})", chunk)
+                self.db.execute_query(f"""
+                    INSERT INTO {aggregate.name} ({columns})
+                    SELECT {aggregate.date_column}, {keys}, {measures}
+                    FROM {aggregate.source}
+                    WHERE {aggregate.date_column} IN ({marks})
+                    GROUP BY {aggregate.date_column}, {keys}
+                """, chunk)
+                self.db.execute_query(
+                    f"DELETE FROM {FINGERPRINT_TABLE} WHERE resumen = ? AND dia IN ({marks})",
+                    [aggregate.name] + chunk)
+            self.db.execute_many(
+                f"INSERT INTO {FINGERPRINT_TABLE} (resumen, dia, filas, huella) VALUES (?, ?, ?, ?)",
+                [(aggregate.name, day) + current[day] for day in days if day in current])
+        print(f"🔄 {aggregate.name}: {len(days)} día(s) recalculado(s)")
+    
+    def ensure_fresh(self):
+        """Actualiza si ha pasado el intervalo; False si los resúmenes no se pueden usar"""
+        if not self.available():
+            return False
+        if self._last_refresh is not None and time.monotonic() - self._last_refresh < self.refresh_interval:
+            return True
+        # Si otro hilo ya está actualizando se usa el resumen tal como está
+        if not self._lock.acquire(blocking=False):
+            return self._last_refresh is not None
+        try:
+            self.refresh()
+            return True
+        except Exception as e:
+            print(f"⚠️  No se pudieron actualizar los resúmenes: {e}")
+            return False
+        finally:
+            self._lock.release()
+    
+    def match(self, user_request, today=None):
+        """Ruta al resumen de citas si la petición es una estadística que puede responder"""
+        text = normalize_request(user_request, today)
+        if not _SUBJECT.search(text) or not _STATISTIC.search(text):
+            return None
+        
+        periods = list(_PERIODS.finditer(text))
+        if len(periods) > 1:
+            return None
+        period = _period_range(periods[0]) if periods else None
+        
+        dimensions = [name for name, pattern in _DIMENSION_PATTERNS if pattern.search(text)]
+        if not dimensions and not re.search(r'\bcuant[oa]s citas\b|\b(?:numero|total) de citas\b', text):
+            return None
+        
+        # Cualquier palabra fuera del vocabulario es un filtro que el resumen no tiene
+        leftovers = set(_PERIODS.sub(' ', text).split()) - _VOCABULARY
+        if leftovers:
+            return None
+        
+        return AggregateRoute(self._route_sql(CITAS_DIA, dimensions, period), CITAS_DIA.name,
+                              tuple(dimensions), period)
+    
+    @staticmethod
+    def _route_sql(aggregate, dimensions, period):
+        """SELECT sobre el resumen: suma de medidas por las dimensiones pedidas"""
+        select = list(dimensions) + ["SUM(citas) AS citas", "SUM(duracion_total) / 60 AS minutos"]
+        if 'IdSitC' in dimensions:
+            select.append("CAST(100.0 * SUM(citas) / NULLIF(SUM(SUM(citas)) OVER (), 0) AS DECIMAL(5, 1)) "
+                          "AS porcentaje")
+        sql = f"SELECT {', '.join(select)} FROM {aggregate.name}"
+        if period:
+            sql += (f" WHERE {aggregate.date_column} BETWEEN {day_serial(period[0])} "
+                    f"AND {day_serial(period[1])}")
+        if dimensions:
+            sql += f" GROUP BY {', '.join(dimensions)}"
+            sql += f" ORDER BY {'Fecha, ' if 'Fecha' in dimensions else ''}citas DESC"
+        return sql
+    
+    def route(self, user_request):
+        """Ruta para la petición si encaja y los resúmenes están al día; None si no"""
+        route = self.match(user_request)
+        if route is None or not self.ensure_fresh():
+            return None
+        self.stats['routed'] += 1
+        return route
+    
+    def source_tables(self, tables):
+        """Sustituye los resúmenes por su tabla origen (para decodificar sus columnas)"""
+        sources = {a.name.upper(): a.source for a in self.aggregates}
+        return [sources.get(table.split('.')[-1].upper(), table) for table in tables]
+
+
+# Creación, actualización y prueba de rutas
+if __name__ == "__main__":
+    import sys
+    
+    print("=" * 70)
+    print("TABLAS DE RESUMEN")
+    print("=" * 70)
+    
+    if '--setup' in sys.argv or '--refresh' in sys.argv:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'phase1'))
+        from db_connection import DatabaseConnection
+        
+        manager = AggregateManager(DatabaseConnection())
+        if '--setup' in sys.argv:
+            manager.setup()
+        started = time.perf_counter()
+        changed = manager.refresh(full='--full' in sys.argv)
+        print(f"📊 {changed} en {time.perf_counter() - started:.2f}s | {manager.stats}")
+        manager.db.close()
+        sys.exit(0)
+    
+    manager = AggregateManager(None)
+    samples = [
+        "Citas por doctor esta semana",
+        "¿Cuál es la tasa de cancelación del mes pasado?",
+        "Tratamientos más frecuentes este mes",
+        "¿Cuántas citas hay hoy?",
+        "Citas por día y por odontólogo la semana que viene",
+        "Citas del paciente Juan Pérez por doctor",
+        "Muéstrame las citas de mañana por la tarde",
+    ]
+    for request in samples:
+        route = manager.match(request)
+        print(f"\n📝 {request}\n➡️  {route.sql if route else '(modelo)'}")
@@ -0,0 +1,204 @@
+"""
+FASE 2 - Caché de Configuración
+Mantiene en memoria CONFIG_SISTEMA y MAPEO_COLUMNAS para todo el proceso y detecta
+cambios con un sondeo barato (índice idx_config_fecha_mod) en lugar de releer todo
+en cada petición
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+
+CONFIG_COLUMNS = "categoria, clave, valor, tipo_dato, activo, prioridad, version, fecha_modificacion"
+
+
+class ConfigCache:
+    """Caché de configuración con sondeo de cambios y carga incremental"""
+    
+    def __init__(self, db_connection, poll_interval=None, checksum_every=None):
+        self.db = db_connection
+        if poll_interval is None:
+            poll_interval = float(os.getenv('IA_CONFIG_POLL_SECONDS', '5'))
+        self.poll_interval = poll_interval
+        # Cada sondeo usa recuentos y MAX(fecha_modificacion) (índice idx_config_fecha_mod);
+        # los cambios sin fecha (UPDATE de valor o activo sin tocarla, o de MAPEO_COLUMNAS)
+        # solo se ven con el checksum, que recorre las tablas: uno de cada checksum_every
+        # sondeos (12 × 5 s = hasta un minuto de retraso para esos cambios). A cambio, tras
+        # cualquier cambio el siguiente checksum distinto provoca una carga completa más
+        if checksum_every is None:
+            checksum_every = int(os.getenv('IA_CONFIG_CHECKSUM_EVERY', '12'))
+        self.checksum_every = max(1, checksum_every)
+        self._polls_since_checksum = 0
+        self._checksums = None
+        
+        self._lock = threading.RLock()
+        self._rows = {}
+        self._mappings = []
+        self._config_state = None
+        self._mapping_state = None
+        self._last_poll = None
+        self._derived = {}
+        
+        # Se incrementa cada vez que cambia algo; sirve de clave para datos derivados
+        self.version = 0
+        self.stats = {'polls': 0, 'checksum_polls': 0, 'full_loads': 0, 'delta_loads': 0,
+                      'mapping_loads': 0, 'rows_fetched': 0}
+    
+    def _poll(self, with_checksums=False):
+        """Consulta ligera: número de filas y última modificación (o último id) de cada tabla
+
+        Con with_checksums añade CHECKSUM_AGG de ambas tablas, que las recorre
+        enteras: solo se pide cada checksum_every sondeos. Devuelve
+        (estado de CONFIG_SISTEMA, estado de MAPEO_COLUMNAS, checksums o None).
+        """
+        self.stats['polls'] += 1
+        checksums = ""
+        if with_checksums:
+            self.stats['checksum_polls'] += 1
+            checksums = """,
+                (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(categoria, clave, valor, activo, prioridad))
+                 FROM CONFIG_SISTEMA) AS config_checksum,
+                (SELECT CHECKSUM_AGG(BINARY_CHECKSUM(tabla, columna_bd, nombre_coloquial, tipo_dato, formula_conversion))
+                 FROM MAPEO_COLUMNAS) AS mapeo_checksum"""
+        result = self.db.execute_query(f"""
+            SELECT
+                (SELECT COUNT(*) FROM CONFIG_SISTEMA) AS config_total,
+                (SELECT MAX(fecha_modificacion) FROM CONFIG_SISTEMA) AS config_ultima,
+                (SELECT COUNT(*) FROM MAPEO_COLUMNAS) AS mapeo_total,
+                (SELECT MAX(id) FROM MAPEO_COLUMNAS) AS mapeo_ultimo{checksums}
+        """)
+        row = result[0]
+        return (
+            (row['config_total'], row['config_ultima']),
+            (row['mapeo_total'], row['mapeo_ultimo']),
+            (row['config_checksum'], row['mapeo_checksum']) if with_checksums else None
+        )
+    
+    def _load_config(self, since=None):
+        """Carga CONFIG_SISTEMA completa o solo las filas modificadas desde 'since'"""
+        if since is None:
+            rows = self.db.execute_query(f"SELECT {CONFIG_COLUMNS} FROM CONFIG_SISTEMA")
+            self._rows = {}
+            self.stats['full_loads'] += 1
+        else:
+            # >= porque DATETIME tiene resolución de ~3 ms; reaplicar una fila es inocuo
+            rows = self.db.execute_query(
+                f"SELECT {CONFIG_COLUMNS} FROM CONFIG_SISTEMA WHERE fecha_modificacion >= ?",
+                [since]
+            )
+            self.stats['delta_loads'] += 1
+        
+        self.stats['rows_fetched'] += len(rows)
+        for row in rows:
+            self._rows[(row['categoria'], row['clave'])] = row
+    
+    def _load_mappings(self):
+        """Carga MAPEO_COLUMNAS completo"""
+        self._mappings = self.db.execute_query("""
+            SELECT tabla, columna_bd, nombre_coloquial, tipo_dato, formula_conversion
+            FROM MAPEO_COLUMNAS
+            ORDER BY tabla, columna_bd
+        """)
+        self.stats['mapping_loads'] += 1
+        self.stats['rows_fetched'] += len(self._mappings)
+    
+    def refresh(self, force=False):
+        """Sincroniza la caché si ha pasado el intervalo de sondeo; True si hubo cambios"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_poll is not None and now - self._last_poll < self.poll_interval:
+                return False
+            self._last_poll = now
+            
+            self._polls_since_checksum += 1
+            deep = force or self._checksums is None or self._polls_since_checksum >= self.checksum_every
+            config_state, mapping_state, checksums = self._poll(with_checksums=deep)
+            if deep:
+                self._polls_since_checksum = 0
+            # Checksum distinto del último calculado: hubo cambios, con o sin fecha
+            compared = checksums is not None and self._checksums is not None
+            config_checksum_changed = compared and checksums[0] != self._checksums[0]
+            mapping_checksum_changed = compared and checksums[1] != self._checksums[1]
+            changed = False
+            
+            if force or self._config_state is None or config_checksum_changed:
+                # Con el checksum cambiado la carga es completa: la incremental no ve
+                # los UPDATE que no actualizan fecha_modificacion
+                self._load_config()
+                changed = True
+            elif config_state != self._config_state:
+                previous_total, previous_last = self._config_state
+                total, last = config_state
+                if previous_last is not None and total >= previous_total and last != previous_last:
+                    self._load_config(since=previous_last)
+                    # Si hubo borrados compensados con altas, el recuento no cuadra
+                    if len(self._rows) != total:
+                        self._load_config()
+                else:
+                    self._load_config()
+                changed = True
+            
+            if force or mapping_state != self._mapping_state or mapping_checksum_changed:
+                self._load_mappings()
+                changed = True
+            
+            self._config_state = config_state
+            self._mapping_state = mapping_state
+            if checksums is not None:
+                self._checksums = checksums
+            
+            if changed:
+                self.version += 1
+                self._derived = {}
+            return changed
+    
+    @property
+    def fingerprint(self):
+        """Huella estable entre procesos del estado sondeado (recuentos, fechas y checksums)"""
+        raw = repr((self._config_state, self._mapping_state, self._checksums))
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+    
+    def get_value(self, categoria, clave, default=None):
+        """Valor de una clave activa de CONFIG_SISTEMA"""
+        row = self._rows.get((categoria, clave))
+        if row is None or not row.get('activo', 1):
+            return default
+        return row['valor']
+    
+    def get_category(self, categoria):
+        """Filas activas de una categoría ordenadas por prioridad"""
+        rows = [r for (cat, _), r in self._rows.items() if cat == categoria and r.get('activo', 1)]
+        return sorted(rows, key=lambda r: (r.get('prioridad') or 100, r['clave']))
+    
+    @property
+    def mappings(self):
+        """Todas las filas de MAPEO_COLUMNAS"""
+        return self._mappings
+    
+    @property
+    def formula_mappings(self):
+        """Mapeos con fórmula de conversión (los que necesita el prompt)"""
+        return [m for m in self._mappings if m.get('formula_conversion') is not None]
+    
+    def derived(self, name, builder):
+        """Devuelve un dato derivado (p. ej. texto del prompt) reconstruyéndolo solo si cambió la versión"""
+        with self._lock:
+            if name not in self._derived:
+                self._derived[name] = builder(self)
+            return self._derived[name]
+
+
+_shared_caches = {}
+_shared_lock = threading.Lock()
+
+
+def get_shared_cache(db_connection, poll_interval=None):
+    """Caché única por conexión para todo el proceso"""
+    with _shared_lock:
+        cache = _shared_caches.get(id(db_connection))
+        if cache is None or cache.db is not db_connection:
+            cache = ConfigCache(db_connection, poll_interval)
+            _shared_caches[id(db_connection)] = cache
+        return cache
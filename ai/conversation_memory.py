@@ -0,0 +1,170 @@
+"""
+FASE 3 - Memoria de Conversación
+Historial por sesión con ventana deslizante de turnos recientes, resumen incremental
+de los turnos antiguos y presupuesto máximo de tokens, para que el prompt de cada
+turno tenga tamaño acotado aunque la conversación sea larga
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+from schema_index import estimate_tokens
+
+
+ROLE_LABELS = {'user': 'Usuario', 'assistant': 'IA Dental'}
+
+_SPACES = re.compile(r'\s+')
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s')
+
+
+def _compact(text, limit):
+    """Texto en una línea recortado a 'limit' caracteres"""
+    text = _SPACES.sub(' ', text or '').strip()
+    if len(text) <= limit:
+        return text
+    return text[:limit - 1].rstrip() + '…'
+
+
+class ConversationSession:
+    """Historial de una sesión: ventana de turnos recientes + resumen de los anteriores"""
+    
+    def __init__(self, session_id=None, window_turns=6, token_budget=1200,
+                 summary_budget=300, max_turn_chars=1500):
+        self.session_id = session_id
+        self.window_turns = window_turns
+        self.token_budget = token_budget
+        self.summary_budget = summary_budget
+        self.max_turn_chars = max_turn_chars
+        
+        # Cada turno se guarda ya renderizado con su coste en tokens
+        self._turns = deque()
+        self._window_tokens = 0
+        self._summary_lines = deque()
+        self._summary_tokens = 0
+        self._rendered = None
+        self.total_turns = 0
+        self.last_used = time.monotonic()
+    
+    @classmethod
+    def from_history(cls, history, **kwargs):
+        """Sesión temporal a partir de una lista de dicts {role, content} o tuplas (role, texto)"""
+        session = cls(**kwargs)
+        for turn in history or ():
+            if isinstance(turn, dict):
+                session.append(turn.get('role', 'user'), turn.get('content') or turn.get('text', ''))
+            else:
+                session.append(*turn)
+        return session
+    
+    def append(self, role, text):
+        """Añade un turno; los que salen de la ventana o del presupuesto pasan al resumen"""
+        label = ROLE_LABELS.get(role, role)
+        rendered = f"{label}: {_compact(text, self.max_turn_chars)}\n"
+        tokens = estimate_tokens(rendered)
+        
+        self._turns.append((role, text, rendered, tokens))
+        self._window_tokens += tokens
+        self.total_turns += 1
+        
+        window_budget = self.token_budget - self.summary_budget
+        while len(self._turns) > 1 and (
+            len(self._turns) > self.window_turns or self._window_tokens > window_budget
+        ):
+            self._evict()
+        
+        self._rendered = None
+        self.last_used = time.monotonic()
+    
+    def _evict(self):
+        """Saca el turno más antiguo de la ventana y lo resume en una línea"""
+        role, text, _, tokens = self._turns.popleft()
+        self._window_tokens -= tokens
+        
+        if role == 'user':
+            line = f"- El usuario preguntó: {_compact(text, 160)}\n"
+        else:
+            first_sentence = _SENTENCE_END.split(_SPACES.sub(' ', text or '').strip(), 1)[0]
+            line = f"- Se respondió: {_compact(first_sentence, 160)}\n"
+        
+        line_tokens = estimate_tokens(line)
+        self._summary_lines.append((line, line_tokens))
+        self._summary_tokens += line_tokens
+        while self._summary_lines and self._summary_tokens > self.summary_budget:
+            _, dropped = self._summary_lines.popleft()
+            self._summary_tokens -= dropped
+    
+    def render(self):
+        """Historial para el prompt (memorizado hasta el siguiente turno)"""
+        if self._rendered is None:
+            parts = []
+            if self._summary_lines:
+                parts.append("**RESUMEN DE LA CONVERSACIÓN ANTERIOR**:\n")
+                parts.extend(line for line, _ in self._summary_lines)
+                parts.append("\n")
+            if self._turns:
+                parts.append("**TURNOS RECIENTES**:\n")
+                parts.extend(rendered for _, _, rendered, _ in self._turns)
+                parts.append("\n")
+            self._rendered = ''.join(parts)
+        return self._rendered
+    
+    @property
+    def tokens(self):
+        """Tokens estimados del historial renderizado"""
+        return self._summary_tokens + self._window_tokens
+    
+    def __len__(self):
+        return len(self._turns)
+
+
+class ConversationStore:
+    """Sesiones activas del proceso con límite de número y caducidad por inactividad"""
+    
+    def __init__(self, max_sessions=256, idle_ttl=4 * 3600, **session_options):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.session_options = session_options
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, session_id):
+        """Sesión existente o nueva para session_id"""
+        with self._lock:
+            now = time.monotonic()
+            session = self._sessions.get(session_id)
+            if session is not None and now - session.last_used > self.idle_ttl:
+                session = None
+            if session is None:
+                session = ConversationSession(session_id, **self.session_options)
+                self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            return session
+    
+    def drop(self, session_id):
+        """Elimina una sesión (p. ej. al cerrar sesión el usuario)"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+# Prueba: el historial renderizado deja de crecer
+if __name__ == "__main__":
+    print("=" * 70)
+    print("PRUEBA DE MEMORIA DE CONVERSACIÓN")
+    print("=" * 70)
+    
+    store = ConversationStore(window_turns=4, token_budget=400, summary_budget=120)
+    session = store.get('recepcion-1')
+    
+    for turn in range(1, 21):
+        session.append('user', f"¿Qué citas tiene el Dr. Mario Rubio el día {turn} de octubre?")
+        session.append('assistant', f"El día {turn} hay {turn % 7 + 2} citas. La primera es a las 09:00.")
+        if turn in (1, 5, 10, 20):
+            print(f"📝 Turno {turn}: {session.tokens} tokens en historial")
+    
+    print("\n" + session.render())
+    print("✅ Pruebas completadas")
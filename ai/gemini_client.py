@@ -3,73 +3,139 @@ FASE 2 - Cliente de Gemini 2.5 Pro
 Integración con Google Gemini AI con lectura dinámica de configuración
 """
 
-import google.generativeai as genai
 import os
 import json
-from dotenv import load_dotenv
+import sys
+import threading
+import time
+from config_cache import get_shared_cache
+from conversation_memory import ConversationSession, ConversationStore
+from llm_backends import create_backend
+from llm_scheduler import get_shared_scheduler
+from prompt_builder import SystemContextBuilder, load_catalogs
+from schema_index import SchemaIndex
 
-# Cargar variables de entorno
-load_dotenv()
+# Versión de las instrucciones de generación de SQL: al cambiarlas, el SQL cacheado deja de valer
+# (2: columnas codificadas e IDs en bruto, se decodifican en el cliente)
+SQL_PROMPT_VERSION = 2
+
+# Tablas cuyos mapeos con fórmula van siempre en el prefijo, aunque la recuperación no las encuentre
+CORE_MAPPING_TABLES = ('DCitas',)
+
+_env_loaded = False
+
+
+def load_environment():
+    """Carga .env una sola vez, en el primer uso (no al importar el módulo)"""
+    global _env_loaded
+    if not _env_loaded:
+        from dotenv import load_dotenv
+        load_dotenv()
+        _env_loaded = True
 
 
 class GeminiAIClient:
     """Cliente de Gemini 2.5 Pro con auto-configuración"""
     
-    def __init__(self, db_connection=None):
-        self.db = db_connection
+    def __init__(self, db_connection=None, scheduler=None, backend=None):
+        # Cargar variables de entorno antes de leer IA_* (planificador, caché de configuración)
+        load_environment()
         
-        # Configurar Gemini
-        api_key = os.getenv('GEMINI_API_KEY')
-        if not api_key:
-            raise ValueError("❌ ERROR: GEMINI_API_KEY no configurada en .env")
+        self.db = db_connection
+        self.scheduler = scheduler or get_shared_scheduler()
+        self.config_cache = get_shared_cache(db_connection) if db_connection else None
+        self.context_builder = SystemContextBuilder()
+        self.last_prefix_hash = None
+        self.last_stream_metrics = None
+        self.conversations = ConversationStore()
         
-        genai.configure(api_key=api_key)
+        # Recuperación de esquema relevante (solo con BD): mantiene el prompt acotado
+        self.schema_retrieval = os.getenv('IA_SCHEMA_RETRIEVAL', '1') != '0'
+        self.schema_top_k = int(os.getenv('IA_SCHEMA_TOP_K', '5'))
+        self.schema_token_budget = int(os.getenv('IA_SCHEMA_TOKEN_BUDGET', '800'))
         
-        # Usar Gemini 2.5 Pro
-        self.model = genai.GenerativeModel('gemini-2.0-flash-exp')
+        # Backend del modelo (Gemini por defecto, o IA_DENTAL_LLM_BACKEND=stub/replay/record)
+        self.backend = backend or create_backend()
         
-        print("✅ Gemini 2.5 Pro configurado correctamente")
+        if self.backend.name == 'gemini':
+            print("✅ Gemini 2.5 Pro configurado correctamente")
+        else:
+            print(f"✅ Backend de LLM '{self.backend.name}' configurado correctamente")
+    
+    def _generate(self, prompt, deadline=None):
+        """Llamada al modelo a través del planificador (límite de velocidad, reintentos y plazo)"""
+        return self.scheduler.call(self.backend.generate, prompt, deadline=deadline)
+    
+    def _generate_stream(self, prompt, deadline=None):
+        """Abre una respuesta en streaming a través del planificador"""
+        return self.scheduler.call(self.backend.stream, prompt, deadline=deadline)
     
     def load_system_configuration(self):
         """Carga configuración desde CONFIG_SISTEMA (si DB disponible)"""
+        return self.get_compiled_context().prefix
+    
+    def get_compiled_context(self):
+        """Devuelve el prefijo compilado del prompt para la versión actual de configuración
+
+        La configuración se mantiene en una caché compartida por el proceso que
+        solo consulta la BD cuando detecta cambios; el prefijo (prompt base,
+        mapeos y catálogos) se compila una vez por versión. Su prefix_hash
+        identifica el prefijo para cachés de contexto aguas arriba.
+        """
         
         if not self.db:
             # Configuración por defecto si no hay BD
-            return self._get_default_configuration()
+            compiled = self.context_builder.compile('default', self._get_default_configuration())
+        else:
+            try:
+                self.config_cache.refresh()
+                name = 'compiled_context_retrieval' if self.schema_retrieval else 'compiled_context'
+                compiled = self.config_cache.derived(name, self._compile_system_context)
+            except Exception as e:
+                print(f"⚠️  No se pudo cargar configuración de BD: {e}")
+                compiled = self.context_builder.compile('default', self._get_default_configuration())
+        
+        self.last_prefix_hash = compiled.prefix_hash
+        return compiled
+    
+    def _compile_system_context(self, cache):
+        """Compila el contexto completo a partir de la caché de configuración"""
+        # Con recuperación activa los mapeos van en la sección por petición salvo los de
+        # CORE_MAPPING_TABLES: sin ellos una petición sin coincidencias ("¿qué hay hoy?")
+        # se quedaría sin las fórmulas de fecha y hora
+        mappings = cache.formula_mappings
+        if self.schema_retrieval:
+            core = {table.upper() for table in CORE_MAPPING_TABLES}
+            mappings = [m for m in mappings if (m.get('tabla') or '').upper() in core]
+        return self.context_builder.compile(
+            ('db', cache.version, self.schema_retrieval),
+            cache.get_value('PROMPT', 'SISTEMA_BASE') or self._get_default_prompt(),
+            mappings,
+            load_catalogs(cache.get_category('CATALOGO'))
+        )
+    
+    def config_version(self):
+        """Versión de la configuración que influye en el SQL generado (estable entre procesos)"""
+        compiled = self.get_compiled_context()
+        version = f"{compiled.prefix_hash[:16]}:p{SQL_PROMPT_VERSION}"
+        if self.db and self.config_cache.version:
+            version = f"{version}:{self.config_cache.fingerprint}"
+        # El SQL de backends locales (stub/replay) no debe mezclarse con el de Gemini en la caché
+        if self.backend.name != 'gemini':
+            version = f"{self.backend.name}:{version}"
+        return version
+    
+    def get_schema_context(self, user_text):
+        """Sección de esquema relevante para la petición (tablas y columnas top-k)"""
+        if not self.db or not self.schema_retrieval:
+            return ''
         
         try:
-            # 1. Cargar prompt base
-            prompt_result = self.db.execute_query("""
-                SELECT valor FROM CONFIG_SISTEMA 
-                WHERE categoria='PROMPT' AND clave='SISTEMA_BASE' AND activo=1
-            """)
-            
-            base_prompt = prompt_result[0]['valor'] if prompt_result else self._get_default_prompt()
-            
-            # 2. Cargar mapeos de columnas
-            mappings = self.db.execute_query("""
-                SELECT tabla, columna_bd, nombre_coloquial, formula_conversion
-                FROM MAPEO_COLUMNAS
-                WHERE formula_conversion IS NOT NULL
-                ORDER BY tabla, columna_bd
-            """)
-            
-            # 3. Construir contexto completo
-            context = f"""{base_prompt}
-
-**MAPEO DE COLUMNAS (CRÍTICO)**:
-Cuando consultes o modifiques datos, usa estas conversiones:
-
-"""
-            if mappings:
-                for m in mappings:
-                    context += f"- {m['tabla']}.{m['columna_bd']} → {m['nombre_coloquial']}: {m['formula_conversion']}\n"
-            
-            return context
-            
+            index = self.config_cache.derived('schema_index', SchemaIndex.from_config_cache)
+            return index.build_context(user_text, self.schema_top_k, self.schema_token_budget)
         except Exception as e:
-            print(f"⚠️  No se pudo cargar configuración de BD: {e}")
-            return self._get_default_configuration()
+            print(f"⚠️  No se pudo construir el contexto de esquema: {e}")
+            return ''
     
     def _get_default_prompt(self):
         """Prompt por defecto si no hay BD"""
@@ -136,58 +202,204 @@ Odontólogos (IdUsu):
 - Responde en español de forma profesional
 """
     
-    def query(self, user_message, conversation_history=None):
-        """Ejecuta consulta con Gemini"""
-        
-        # Cargar configuración del sistema
-        system_context = self.load_system_configuration()
-        
-        # Construir prompt completo
-        full_prompt = f"""{system_context}
+    def _resolve_session(self, conversation_history=None, session_id=None):
+        """Sesión de conversación y si debe guardar el turno actual
 
-**CONVERSACIÓN**:
+        Acepta una ConversationSession, un session_id del almacén del cliente o
+        una lista de turnos (que solo se lee, no se modifica).
+        """
+        if isinstance(conversation_history, ConversationSession):
+            return conversation_history, True
+        if session_id is not None:
+            return self.conversations.get(session_id), True
+        if conversation_history:
+            return ConversationSession.from_history(conversation_history), False
+        return None, False
+    
+    def _build_query_prompt(self, user_message, session=None):
+        """Prompt completo de una consulta conversacional"""
+        compiled = self.get_compiled_context()
+        history = session.render() if session is not None else ''
+        return self.context_builder.render(compiled, f"""{self.get_schema_context(user_message)}
+
+{history}**CONVERSACIÓN**:
 Usuario: {user_message}
 
 Responde de forma profesional y ejecuta las acciones necesarias.
-"""
+""")
+    
+    def query(self, user_message, conversation_history=None, session_id=None):
+        """Ejecuta consulta con Gemini"""
+        
+        session, remember = self._resolve_session(conversation_history, session_id)
+        
+        # Construir prompt completo
+        full_prompt = self._build_query_prompt(user_message, session)
         
         try:
-            response = self.model.generate_content(full_prompt)
-            return response.text
+            answer = self._generate(full_prompt)
         except Exception as e:
             return f"❌ Error al consultar Gemini: {e}"
+        
+        if remember:
+            session.append('user', user_message)
+            session.append('assistant', answer)
+        return answer
+    
+    def query_stream(self, user_message, conversation_history=None, session_id=None):
+        """Ejecuta consulta con Gemini devolviendo el texto por fragmentos según llega
+
+        Solo la apertura del stream pasa por el planificador (reintentos y límite
+        de velocidad); un fallo a mitad de respuesta se emite como fragmento de
+        error. Las métricas quedan en last_stream_metrics: ttft (tiempo hasta el
+        primer fragmento), total, fragmentos y caracteres.
+        """
+        session, remember = self._resolve_session(conversation_history, session_id)
+        full_prompt = self._build_query_prompt(user_message, session)
+        
+        started = time.perf_counter()
+        metrics = {'ttft': None, 'total': None, 'chunks': 0, 'chars': 0, 'error': None}
+        self.last_stream_metrics = metrics
+        parts = []
+        
+        try:
+            for text in self._generate_stream(full_prompt):
+                if not text:
+                    continue
+                if metrics['ttft'] is None:
+                    metrics['ttft'] = time.perf_counter() - started
+                metrics['chunks'] += 1
+                metrics['chars'] += len(text)
+                parts.append(text)
+                yield text
+        except Exception as e:
+            metrics['error'] = str(e)
+            yield f"❌ Error al consultar Gemini: {e}"
+        finally:
+            metrics['total'] = time.perf_counter() - started
+        
+        if remember and metrics['error'] is None:
+            session.append('user', user_message)
+            session.append('assistant', ''.join(parts))
+    
+    def query_with_callback(self, user_message, on_chunk, conversation_history=None, session_id=None):
+        """Variante con callback: llama on_chunk(texto) por fragmento y devuelve la respuesta completa"""
+        parts = []
+        for text in self.query_stream(user_message, conversation_history, session_id):
+            on_chunk(text)
+            parts.append(text)
+        return ''.join(parts)
+    
+    async def aquery_stream(self, user_message, conversation_history=None, session_id=None):
+        """Iterador asíncrono de fragmentos; el SDK bloqueante corre en un hilo aparte"""
+        import asyncio
+        
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+        
+        def produce():
+            try:
+                for text in self.query_stream(user_message, conversation_history, session_id):
+                    loop.call_soon_threadsafe(queue.put_nowait, text)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+        
+        threading.Thread(target=produce, name='gemini-stream', daemon=True).start()
+        while True:
+            text = await queue.get()
+            if text is done:
+                break
+            yield text
     
     def generate_sql(self, user_request, table_info=None):
         """Genera SQL desde lenguaje natural"""
         
-        system_context = self.load_system_configuration()
+        compiled = self.get_compiled_context()
         
-        prompt = f"""{system_context}
+        prompt = self.context_builder.render(compiled, f"""{self.get_schema_context(user_request)}
 
 **TAREA**: Generar consulta SQL para SQL Server
 
 Usuario solicita: {user_request}
 
 IMPORTANTE: 
-- Usa las fórmulas de conversión para fechas y horas
+- Usa las fórmulas de conversión de fechas y horas solo para filtrar (WHERE)
 - Genera SOLO el SQL, sin explicaciones
 - Usa prepared statements cuando sea posible
-- Convierte IDs a nombres legibles con CASE WHEN
+- Devuelve Fecha, Hora, Duracion y los IDs (IdSitC, IdIcono, IdUsu) sin convertir, sin CASE WHEN: se decodifican al recibir las filas
 
 Responde SOLO con el SQL:
-"""
+""")
         
         try:
-            response = self.model.generate_content(prompt)
-            sql = response.text.strip()
-            
-            # Limpiar markdown si existe
-            if sql.startswith('```sql'):
-                sql = sql.replace('```sql', '').replace('```', '').strip()
-            
-            return sql
+            return self._clean_sql(self._generate(prompt))
         except Exception as e:
             return f"-- Error: {e}"
+    
+    @staticmethod
+    def _clean_sql(text):
+        """Quita espacios y bloques markdown de una respuesta SQL"""
+        sql = text.strip()
+        
+        # Limpiar markdown si existe
+        if sql.startswith('```sql'):
+            sql = sql.replace('```sql', '').replace('```', '').strip()
+        
+        return sql
+    
+    def generate_sql_batch(self, requests):
+        """Genera varias consultas SQL en una sola llamada al modelo
+
+        requests es una lista de (id, petición). Devuelve {id: sql} con los
+        elementos que el modelo respondió; lanza ValueError si la respuesta no
+        es un array JSON válido.
+        """
+        
+        compiled = self.get_compiled_context()
+        items = [{'id': str(item_id), 'peticion': text} for item_id, text in requests]
+        schema_context = self.get_schema_context(' '.join(text for _, text in requests))
+        
+        prompt = self.context_builder.render(compiled, f"""{schema_context}
+
+**TAREA**: Generar varias consultas SQL para SQL Server, una por petición
+
+Peticiones (JSON):
+{json.dumps(items, ensure_ascii=False, indent=2)}
+
+IMPORTANTE: 
+- Usa las fórmulas de conversión de fechas y horas solo para filtrar (WHERE)
+- Cada consulta debe ser independiente y de un solo statement
+- Usa prepared statements cuando sea posible
+- Devuelve Fecha, Hora, Duracion y los IDs (IdSitC, IdIcono, IdUsu) sin convertir, sin CASE WHEN: se decodifican al recibir las filas
+
+Responde SOLO con un array JSON, sin explicaciones ni markdown:
+[{{"id": "<id de la petición>", "sql": "<consulta>"}}]
+""")
+        
+        text = self._generate(prompt).strip()
+        if text.startswith('```'):
+            text = text.strip('`').strip()
+            if text.lower().startswith('json'):
+                text = text[4:]
+        
+        try:
+            answers = json.loads(text)
+        except ValueError as e:
+            raise ValueError(f"❌ Respuesta por lotes no es JSON válido: {e}")
+        if not isinstance(answers, list):
+            raise ValueError("❌ Respuesta por lotes no es un array JSON")
+        
+        expected = {item['id'] for item in items}
+        result = {}
+        for answer in answers:
+            if not isinstance(answer, dict):
+                continue
+            item_id = str(answer.get('id'))
+            sql = answer.get('sql')
+            if item_id in expected and isinstance(sql, str) and sql.strip():
+                result[item_id] = self._clean_sql(sql)
+        return result
 
 
 # Test del cliente
@@ -196,6 +408,11 @@ if __name__ == "__main__":
     print("PRUEBA DE GEMINI 2.5 PRO CLIENT")
     print("=" * 70)
     
+    # Solo medir el coste de arranque de los módulos
+    if '--profile-startup' in sys.argv:
+        from startup_profile import run_startup_profile
+        sys.exit(run_startup_profile())
+    
     # Crear cliente (sin BD por ahora)
     client = GeminiAIClient()
     
@@ -209,4 +426,11 @@ if __name__ == "__main__":
     sql = client.generate_sql("Muéstrame las citas de mañana con el Dr. Mario Rubio")
     print(f"SQL generado:\n{sql}")
     
+    # Prueba 3: Respuesta en streaming
+    print("\n📝 Prueba 3: Consulta en streaming")
+    for fragment in client.query_stream("¿Qué citas hay hoy?"):
+        print(fragment, end='', flush=True)
+    metrics = client.last_stream_metrics
+    print(f"\n⏱️  Primer fragmento: {metrics['ttft']}s | Total: {metrics['total']:.2f}s | Fragmentos: {metrics['chunks']}")
+    
     print("\n✅ Pruebas completadas")
@@ -0,0 +1,266 @@
+"""
+FASE 3 - Backends de LLM
+Interfaz común (generate, stream, count_tokens) para el modelo que usa GeminiAIClient:
+Gemini real, un stub local determinista con latencia configurable y respuestas SQL por
+reglas, y un backend de grabación/reproducción. Permite medir el camino NL→SQL sin red
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+
+from schema_index import estimate_tokens
+
+
+# En <repo>/database/cache, con independencia del directorio de trabajo
+DEFAULT_REPLAY_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'database', 'cache', 'llm_replay.json')
+
+
+class LLMBackend(ABC):
+    """Interfaz de backend: texto completo, texto por fragmentos y recuento de tokens"""
+    
+    name = 'base'
+    
+    @abstractmethod
+    def generate(self, prompt):
+        """Respuesta completa como texto"""
+    
+    def stream(self, prompt):
+        """Abre la respuesta y devuelve un iterador de fragmentos de texto"""
+        return iter([self.generate(prompt)])
+    
+    def count_tokens(self, prompt):
+        """Tokens del prompt (estimación si el backend no sabe contarlos)"""
+        return estimate_tokens(prompt)
+
+
+class GeminiBackend(LLMBackend):
+    """Google Gemini; el SDK se importa y configura en la primera llamada"""
+    
+    name = 'gemini'
+    
+    def __init__(self, api_key=None, model_name='gemini-2.0-flash-exp'):
+        self.api_key = api_key or os.getenv('GEMINI_API_KEY')
+        if not self.api_key:
+            raise ValueError("❌ ERROR: GEMINI_API_KEY no configurada en .env")
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+    
+    @property
+    def model(self):
+        """Modelo de Gemini, creado en el primer uso (importar el SDK cuesta cientos de ms)"""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    import google.generativeai as genai
+                    genai.configure(api_key=self.api_key)
+                    self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+    
+    @model.setter
+    def model(self, model):
+        self._model = model
+    
+    def generate(self, prompt):
+        return self.model.generate_content(prompt).text
+    
+    def stream(self, prompt):
+        # La petición se abre aquí (y puede fallar aquí); los fragmentos se leen después
+        response = self.model.generate_content(prompt, stream=True)
+        return (text for text in (getattr(chunk, 'text', '') for chunk in response) if text)
+    
+    def count_tokens(self, prompt):
+        try:
+            return self.model.count_tokens(prompt).total_tokens
+        except Exception:
+            return estimate_tokens(prompt)
+
+
+# Reglas del stub: (patrón sobre la petición sin acentos, SQL devuelto)
+STUB_SQL_RULES = [
+    (r'\bcuant\w* pacientes?\b', "SELECT COUNT(*) AS total FROM Pacientes"),
+    (r'\bpacientes?\b', "SELECT TOP 100 IdPac, NumPac, Nombre, Apellidos, TelMovil FROM Pacientes ORDER BY Apellidos, Nombre"),
+    (r'\bcuant\w* citas?\b', "SELECT COUNT(*) AS total FROM DCitas WHERE Fecha = DATEDIFF(DAY, '1900-01-01', GETDATE()) + 2"),
+    (r'\bcitas?\b|\bagenda\b', "SELECT IdCita, Fecha, Hora, Duracion, IdUsu, IdSitC, IdIcono, Texto FROM DCitas "
+                              "WHERE Fecha = DATEDIFF(DAY, '1900-01-01', GETDATE()) + 2 ORDER BY Hora"),
+    (r'\btratamientos?\b', "SELECT TOP 100 Codigo, Actos FROM Tratamientos ORDER BY Codigo"),
+    (r'\bpresupuestos?\b', "SELECT TOP 100 * FROM Presu"),
+]
+STUB_DEFAULT_SQL = "SELECT TOP 10 IdCita, Fecha, Hora, IdUsu FROM DCitas ORDER BY Fecha DESC"
+
+_SQL_REQUEST = re.compile(r'Usuario solicita: (.*)')
+_CHAT_REQUEST = re.compile(r'Usuario: (.*)')
+_BATCH_ITEMS = re.compile(r'Peticiones \(JSON\):\n(\[.*?\n\])', re.S)
+
+
+def _fold(text):
+    """Minúsculas y sin acentos"""
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+class LocalStubBackend(LLMBackend):
+    """Backend local determinista: latencia fija y SQL por reglas (sin red)"""
+    
+    name = 'stub'
+    
+    def __init__(self, latency=None, first_token_latency=None, chunk_size=16, rules=None):
+        if latency is None:
+            latency = float(os.getenv('IA_STUB_LATENCY_MS', '50')) / 1000
+        self.latency = latency
+        self.first_token_latency = latency / 2 if first_token_latency is None else first_token_latency
+        self.chunk_size = chunk_size
+        self.rules = [(re.compile(pattern), sql) for pattern, sql in (rules or STUB_SQL_RULES)]
+    
+    def sql_for(self, request):
+        """SQL de la primera regla que coincide con la petición"""
+        folded = _fold(request)
+        for pattern, sql in self.rules:
+            if pattern.search(folded):
+                return sql
+        return STUB_DEFAULT_SQL
+    
+    def _answer(self, prompt):
+        """Respuesta según el tipo de prompt: lote JSON, SQL o conversación"""
+        batch = _BATCH_ITEMS.search(prompt)
+        if batch:
+            items = json.loads(batch.group(1))
+            return json.dumps([{'id': item['id'], 'sql': self.sql_for(item['peticion'])} for item in items],
+                              ensure_ascii=False)
+        
+        sql_request = _SQL_REQUEST.search(prompt)
+        if sql_request:
+            return self.sql_for(sql_request.group(1))
+        
+        chat = _CHAT_REQUEST.findall(prompt)
+        question = chat[-1] if chat else prompt[-200:]
+        return f"(stub) Consulta recibida: {question}. SQL sugerido: {self.sql_for(question)}"
+    
+    def generate(self, prompt):
+        time.sleep(self.latency)
+        return self._answer(prompt)
+    
+    def stream(self, prompt):
+        time.sleep(self.first_token_latency)
+        text = self._answer(prompt)
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+        pause = max(0.0, self.latency - self.first_token_latency) / max(1, len(chunks))
+        
+        def produce():
+            for index, chunk in enumerate(chunks):
+                if index:
+                    time.sleep(pause)
+                yield chunk
+        return produce()
+
+
+class RecordReplayBackend(LLMBackend):
+    """Graba respuestas de otro backend en JSON por hash del prompt y las reproduce sin red"""
+    
+    name = 'replay'
+    
+    def __init__(self, path=None, inner=None, record=False):
+        self.path = path or os.getenv('IA_LLM_REPLAY_PATH', DEFAULT_REPLAY_PATH)
+        self.inner = inner
+        self.record = record
+        self._lock = threading.Lock()
+        self._responses = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._responses = json.load(f)
+        if record and inner is None:
+            raise ValueError("❌ El modo grabación necesita un backend interno")
+    
+    @staticmethod
+    def prompt_key(prompt):
+        return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    
+    def generate(self, prompt):
+        key = self.prompt_key(prompt)
+        with self._lock:
+            if key in self._responses:
+                return self._responses[key]
+        if not self.record:
+            raise LookupError(f"❌ Prompt sin grabación ({key[:12]}) en {self.path}")
+        
+        text = self.inner.generate(prompt)
+        with self._lock:
+            self._responses[key] = text
+            self._save()
+        return text
+    
+    def _save(self):
+        """Escribe las grabaciones de forma atómica"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._responses, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+    
+    def count_tokens(self, prompt):
+        return self.inner.count_tokens(prompt) if self.inner else estimate_tokens(prompt)
+
+
+def create_backend(name=None, api_key=None):
+    """Backend según IA_DENTAL_LLM_BACKEND: gemini (por defecto), stub, replay o record"""
+    name = (name or os.getenv('IA_DENTAL_LLM_BACKEND', 'gemini')).lower()
+    if name == 'gemini':
+        return GeminiBackend(api_key)
+    if name == 'stub':
+        return LocalStubBackend()
+    if name == 'replay':
+        return RecordReplayBackend()
+    if name == 'record':
+        return RecordReplayBackend(inner=GeminiBackend(api_key), record=True)
+    raise ValueError(f"❌ Backend de LLM desconocido: {name}")
+
+
+# Banco de pruebas del camino NL→SQL completo con el stub (sin red)
+if __name__ == "__main__":
+    import sys
+    from gemini_client import GeminiAIClient
+    from llm_scheduler import LLMScheduler
+    from sql_cache import SQLCache
+    from sql_generator import SQLGenerator
+    
+    print("=" * 70)
+    print("BENCHMARK NL→SQL CON BACKEND LOCAL")
+    print("=" * 70)
+    
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    requests = [f"{phrase} (#{i})" for i, phrase in enumerate([
+        "¿Cuántos pacientes tenemos?", "Muéstrame las citas de hoy", "Lista de tratamientos",
+        "Presupuestos pendientes", "¿Cuántas citas hay hoy?"
+    ] * (total // 5 + 1))][:total]
+    
+    scheduler = LLMScheduler(max_in_flight=8, rate_per_second=1000, burst=50)
+    client = GeminiAIClient(scheduler=scheduler, backend=LocalStubBackend(latency=0.05))
+    generator = SQLGenerator(client, sql_cache=SQLCache(max_entries=0, path=''))
+    
+    started = time.perf_counter()
+    latencies = []
+    for request in requests:
+        t0 = time.perf_counter()
+        generator.generate_sql(request)
+        latencies.append(time.perf_counter() - t0)
+    sequential = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    batch = generator.generate_sql_batch(requests, pack_size=5)
+    batched = time.perf_counter() - started
+    
+    latencies.sort()
+    print(f"\n📊 Secuencial: {total / sequential:.1f} peticiones/s | "
+          f"p50 {latencies[len(latencies) // 2] * 1000:.1f} ms | "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} ms")
+    print(f"📊 Por lotes:   {total / batched:.1f} peticiones/s | "
+          f"{batch['stats']['packed_calls']} llamadas al modelo para {total} peticiones")
@@ -0,0 +1,232 @@
+"""
+FASE 3 - Planificador de Llamadas al LLM
+Ejecuta llamadas al modelo de forma concurrente con límite de velocidad (token bucket),
+tope de llamadas simultáneas, reintentos con backoff exponencial con jitter para errores
+transitorios, plazos máximos y registro de latencias
+"""
+
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Errores de la API que merece la pena reintentar (por nombre, sin importar el SDK)
+TRANSIENT_ERROR_NAMES = {
+    'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'DeadlineExceeded',
+    'InternalServerError', 'Aborted', 'Unavailable', 'GatewayTimeout'
+}
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+def is_transient_error(error):
+    """True si el error es transitorio (cuota, sobrecarga, red o timeout)"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    if any(cls.__name__ in TRANSIENT_ERROR_NAMES for cls in type(error).__mro__):
+        return True
+    code = getattr(error, 'code', None) or getattr(error, 'status_code', None)
+    if callable(code):
+        try:
+            code = code()
+        except Exception:
+            code = None
+    return getattr(code, 'value', code) in TRANSIENT_STATUS_CODES
+
+
+class TokenBucket:
+    """Limitador de velocidad: 'rate' llamadas por segundo con ráfagas de hasta 'capacity'"""
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, timeout=None):
+        """Consume un token esperando como máximo 'timeout' segundos"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+class LLMScheduler:
+    """Planificador de llamadas concurrentes al modelo con reintentos y plazos"""
+    
+    def __init__(self, max_in_flight=4, rate_per_second=2.0, burst=None, max_retries=3,
+                 base_delay=0.5, max_delay=8.0, default_deadline=60.0):
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.default_deadline = default_deadline
+        
+        self._bucket = TokenBucket(rate_per_second, burst)
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='llm')
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self.stats = {'calls': 0, 'attempts': 0, 'retries': 0, 'failures': 0, 'timeouts': 0}
+    
+    def _backoff(self, attempt):
+        """Backoff exponencial con jitter completo"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+    
+    def call(self, fn, *args, deadline=None, **kwargs):
+        """Ejecuta fn(*args, **kwargs) respetando límites, con reintentos y plazo en segundos
+        
+        El plazo se comprueba antes de cada intento y durante las esperas; una
+        llamada ya en curso no se interrumpe.
+        """
+        end = time.monotonic() + (deadline if deadline is not None else self.default_deadline)
+        with self._lock:
+            self.stats['calls'] += 1
+        
+        attempt = 0
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0 or not self._bucket.acquire(timeout=remaining):
+                self._count('timeouts')
+                raise TimeoutError("⏱️ Plazo agotado esperando turno para llamar al modelo")
+            
+            remaining = end - time.monotonic()
+            if remaining <= 0 or not self._slots.acquire(timeout=remaining):
+                self._count('timeouts')
+                raise TimeoutError("⏱️ Plazo agotado esperando un hueco de concurrencia")
+            
+            started = time.perf_counter()
+            try:
+                self._count('attempts')
+                result = fn(*args, **kwargs)
+                error = None
+            except Exception as e:
+                result = None
+                error = e
+            finally:
+                self._slots.release()
+                with self._lock:
+                    self._latencies.append(time.perf_counter() - started)
+            
+            if error is None:
+                return result
+            
+            if not is_transient_error(error) or attempt >= self.max_retries:
+                self._count('failures')
+                raise error
+            
+            delay = self._backoff(attempt)
+            if time.monotonic() + delay >= end:
+                self._count('timeouts')
+                raise TimeoutError(f"⏱️ Plazo agotado reintentando la llamada al modelo: {error}") from error
+            
+            self._count('retries')
+            time.sleep(delay)
+            attempt += 1
+    
+    def submit(self, fn, *args, **kwargs):
+        """Programa la llamada en el pool y devuelve un Future"""
+        return self._executor.submit(self.call, fn, *args, **kwargs)
+    
+    def map(self, fn, items, deadline=None):
+        """Ejecuta fn(item) para todos los items; devuelve resultados o excepciones en orden"""
+        futures = [self.submit(fn, item, deadline=deadline) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+    
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+    
+    def latency_summary(self):
+        """Latencias por intento en segundos: p50, p95, máximo y número de muestras"""
+        with self._lock:
+            samples = sorted(self._latencies)
+        if not samples:
+            return {'count': 0, 'p50': None, 'p95': None, 'max': None}
+        return {
+            'count': len(samples),
+            'p50': samples[len(samples) // 2],
+            'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            'max': samples[-1]
+        }
+    
+    def shutdown(self, wait=True):
+        """Detiene el pool de hilos"""
+        self._executor.shutdown(wait=wait)
+
+
+_shared_scheduler = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_scheduler():
+    """Planificador único del proceso configurado desde variables de entorno"""
+    global _shared_scheduler
+    with _shared_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = LLMScheduler(
+                max_in_flight=int(os.getenv('IA_LLM_MAX_IN_FLIGHT', '4')),
+                rate_per_second=float(os.getenv('IA_LLM_RATE_PER_SECOND', '2')),
+                max_retries=int(os.getenv('IA_LLM_MAX_RETRIES', '3')),
+                default_deadline=float(os.getenv('IA_LLM_DEADLINE_SECONDS', '60'))
+            )
+        return _shared_scheduler
+
+
+# Prueba con un modelo falso local (sin red)
+if __name__ == "__main__":
+    print("=" * 70)
+    print("PRUEBA DEL PLANIFICADOR DE LLAMADAS AL LLM")
+    print("=" * 70)
+    
+    class ResourceExhausted(Exception):
+        """Imita el error de cuota de la API"""
+    
+    class FakeModel:
+        """Modelo local con latencia fija y fallos transitorios aleatorios"""
+        
+        def __init__(self, latency=0.05, failure_rate=0.3):
+            self.latency = latency
+            self.failure_rate = failure_rate
+        
+        def generate_content(self, prompt):
+            time.sleep(self.latency)
+            if random.random() < self.failure_rate:
+                raise ResourceExhausted("429 cuota excedida")
+            return f"SQL para: {prompt}"
+    
+    scheduler = LLMScheduler(max_in_flight=4, rate_per_second=20, burst=5, base_delay=0.05)
+    model = FakeModel()
+    
+    started = time.perf_counter()
+    results = scheduler.map(model.generate_content, [f"petición {i}" for i in range(20)], deadline=10)
+    elapsed = time.perf_counter() - started
+    
+    ok = sum(1 for r in results if not isinstance(r, Exception))
+    print(f"✅ {ok}/{len(results)} llamadas correctas en {elapsed:.2f}s")
+    print(f"📊 Estadísticas: {scheduler.stats}")
+    print(f"⏱️  Latencias: {scheduler.latency_summary()}")
+    
+    scheduler.shutdown()
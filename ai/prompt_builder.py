@@ -0,0 +1,111 @@
+"""
+FASE 2 - Constructor del Contexto del Sistema
+Compila una sola vez por versión de configuración el prefijo estático del prompt
+(prompt base, mapeos de columnas y catálogos) y en cada petición solo añade el turno
+del usuario
+"""
+
+import hashlib
+import json
+from collections import OrderedDict, namedtuple
+
+
+# Catálogos de IDs usados en DCitas. Se pueden sobrescribir desde CONFIG_SISTEMA
+# con categoria='CATALOGO', clave=<columna> y valor JSON {"titulo": ..., "valores": {...}}
+DEFAULT_CATALOGS = OrderedDict([
+    ('IdSitC', {
+        'titulo': 'Estados de cita',
+        'valores': {0: 'Planificada', 1: 'Anulada', 5: 'Finalizada', 7: 'Confirmada', 8: 'Cancelada'}
+    }),
+    ('IdIcono', {
+        'titulo': 'Tratamientos',
+        'valores': {1: 'Control', 2: 'Urgencia', 3: 'Prótesis Fija', 13: 'Primera Visita',
+                    14: 'Higiene Dental', 15: 'Endodoncia', 17: 'Exodoncia'}
+    }),
+    ('IdUsu', {
+        'titulo': 'Odontólogos',
+        'valores': {3: 'Dr. Mario Rubio', 4: 'Dra. Irene García', 8: 'Dra. Virginia Tresgallo',
+                    10: 'Dra. Miriam Carrasco', 12: 'Tc. Juan Antonio Manzanedo'}
+    }),
+])
+
+
+# Prefijo compilado e inmutable: versión de configuración, texto y hash del texto
+CompiledContext = namedtuple('CompiledContext', ['version', 'prefix', 'prefix_hash'])
+
+
+def load_catalogs(catalog_rows):
+    """Combina los catálogos por defecto con los definidos en CONFIG_SISTEMA"""
+    catalogs = OrderedDict((k, dict(v)) for k, v in DEFAULT_CATALOGS.items())
+    for row in catalog_rows:
+        try:
+            data = json.loads(row['valor'])
+        except (TypeError, ValueError):
+            print(f"⚠️  Catálogo {row.get('clave')} con JSON inválido, se ignora")
+            continue
+        try:
+            items = data.get('valores', {}).items()
+            titulo = data.get('titulo', row['clave'])
+        except AttributeError:
+            print(f"⚠️  Catálogo {row.get('clave')} sin formato {{\"titulo\", \"valores\"}}, se ignora")
+            continue
+        valores = {}
+        for key, label in items:
+            try:
+                valores[int(key)] = label
+            except (TypeError, ValueError):
+                print(f"⚠️  Catálogo {row.get('clave')}: ID no numérico {key!r}, se ignora")
+        catalogs[row['clave']] = {'titulo': titulo, 'valores': valores}
+    return catalogs
+
+
+class SystemContextBuilder:
+    """Compila y memoriza el prefijo del prompt por versión de configuración"""
+    
+    def __init__(self, max_versions=4):
+        self.max_versions = max_versions
+        self._compiled = OrderedDict()
+    
+    def compile(self, version, base_prompt, mappings=(), catalogs=None):
+        """Devuelve el CompiledContext de la versión, construyéndolo solo la primera vez"""
+        compiled = self._compiled.get(version)
+        if compiled is not None:
+            self._compiled.move_to_end(version)
+            return compiled
+        
+        parts = [base_prompt]
+        
+        if mappings:
+            parts.append("""
+
+**MAPEO DE COLUMNAS (CRÍTICO)**:
+Cuando consultes o modifiques datos, usa estas conversiones:
+
+""")
+            parts.extend(
+                f"- {m['tabla']}.{m['columna_bd']} → {m['nombre_coloquial']}: {m['formula_conversion']}\n"
+                for m in mappings
+            )
+        
+        if catalogs:
+            parts.append("\n\n**CATÁLOGOS DE IDENTIFICADORES**:\n")
+            for column, catalog in catalogs.items():
+                parts.append(f"\n{catalog['titulo']} ({column}):\n")
+                parts.extend(f"- {key} = {label}\n" for key, label in sorted(catalog['valores'].items()))
+        
+        prefix = ''.join(parts)
+        compiled = CompiledContext(
+            version=version,
+            prefix=prefix,
+            prefix_hash=hashlib.sha256(prefix.encode('utf-8')).hexdigest()
+        )
+        
+        self._compiled[version] = compiled
+        while len(self._compiled) > self.max_versions:
+            self._compiled.popitem(last=False)
+        return compiled
+    
+    @staticmethod
+    def render(compiled, user_section):
+        """Prompt final: prefijo compilado + sección variable de la petición"""
+        return compiled.prefix + user_section
@@ -0,0 +1,198 @@
+"""
+FASE 3 - Control de Coste de Consultas
+Antes de ejecutar SQL generado por el modelo obtiene el plan estimado (SET SHOWPLAN_XML)
+y extrae el coste y las filas estimadas. Las consultas por encima de los umbrales se
+rechazan o se limitan con TOP; las aceptadas se ejecutan con tiempo máximo por consulta
+y se pueden cancelar, para que una consulta mala no bloquee la BD de la clínica
+"""
+
+import os
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, namedtuple
+
+from sql_pagination import SQLPaginator
+
+
+PlanEstimate = namedtuple('PlanEstimate', 'cost rows statements warnings')
+
+# Avisos del plan que indican una consulta probablemente errónea
+PLAN_WARNINGS = ('NoJoinPredicate', 'UnmatchedIndexes', 'PlanAffectingConvert')
+
+
+def parse_plan(plan_xml):
+    """Coste y filas estimadas del plan XML (se suma el coste de todas las sentencias)"""
+    root = ET.fromstring(plan_xml)
+    cost = 0.0
+    rows = 0.0
+    statements = 0
+    for statement in root.iter():
+        if not statement.tag.endswith('StmtSimple'):
+            continue
+        statements += 1
+        cost += float(statement.get('StatementSubTreeCost') or 0)
+        rows = max(rows, float(statement.get('StatementEstRows') or 0))
+    
+    warnings = set()
+    for element in root.iter():
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag in PLAN_WARNINGS or (tag == 'Warnings' and element.get('NoJoinPredicate') == 'true'):
+            warnings.add('NoJoinPredicate' if tag == 'Warnings' else tag)
+    return PlanEstimate(cost, rows, statements, sorted(warnings))
+
+
+class QueryGuard:
+    """Umbrales de coste/filas estimadas, límite de tiempo y cancelación"""
+    
+    def __init__(self, max_cost=None, max_rows=None, action=None, timeout=None,
+                 require_plan=None, max_entries=1024):
+        self.max_cost = float(os.getenv('IA_SQL_MAX_COST', '50') if max_cost is None else max_cost)
+        self.max_rows = int(os.getenv('IA_SQL_MAX_EST_ROWS', '100000') if max_rows is None else max_rows)
+        # reject: se rechaza; limit: se añade TOP max_rows y se vuelve a estimar
+        self.action = (action or os.getenv('IA_SQL_GUARD_ACTION', 'limit')).lower()
+        self.timeout = float(os.getenv('IA_SQL_TIMEOUT_SECONDS', '30') if timeout is None else timeout)
+        # Sin plan (p. ej. a través del proxy) se ejecuta igualmente salvo que se exija
+        if require_plan is None:
+            require_plan = os.getenv('IA_SQL_GUARD_REQUIRE_PLAN', '0') == '1'
+        self.require_plan = require_plan
+        if self.action not in ('reject', 'limit'):
+            raise ValueError(f"❌ Acción de control de coste desconocida: {self.action}")
+        
+        self.max_entries = max_entries
+        self._estimates = OrderedDict()
+        self._lock = threading.Lock()
+        self._limiter = SQLPaginator(default_limit=self.max_rows)
+        self.stats = {'checked': 0, 'plan_hits': 0, 'rejected': 0, 'limited': 0,
+                      'no_plan': 0, 'timeouts': 0, 'cancelled': 0}
+    
+    def estimate(self, db, sql, params=None):
+        """Estimación del plan (cacheada por SQL y parámetros); None si la BD no da planes"""
+        if not hasattr(db, 'estimated_plan'):
+            return None
+        key = (sql, tuple(params) if params else ())
+        with self._lock:
+            estimate = self._estimates.get(key)
+            if estimate is not None:
+                self._estimates.move_to_end(key)
+                self.stats['plan_hits'] += 1
+                return estimate
+        
+        estimate = parse_plan(db.estimated_plan(sql, params))
+        with self._lock:
+            self._estimates[key] = estimate
+            while len(self._estimates) > self.max_entries:
+                self._estimates.popitem(last=False)
+        return estimate
+    
+    def _over(self, estimate):
+        """Motivo por el que la estimación supera los umbrales ('' si no los supera)"""
+        reasons = []
+        if estimate.cost > self.max_cost:
+            reasons.append(f"coste estimado {estimate.cost:.1f} > {self.max_cost:g}")
+        if estimate.rows > self.max_rows:
+            reasons.append(f"{estimate.rows:,.0f} filas estimadas > {self.max_rows:,}")
+        if 'NoJoinPredicate' in estimate.warnings:
+            reasons.append("JOIN sin predicado (producto cartesiano)")
+        return ', '.join(reasons)
+    
+    def check(self, db, sql, params=None):
+        """Devuelve (SQL a ejecutar, estimación); ValueError si la consulta es demasiado costosa"""
+        with self._lock:
+            self.stats['checked'] += 1
+        try:
+            estimate = self.estimate(db, sql, params)
+        except Exception as e:
+            estimate = None
+            print(f"⚠️  Plan estimado no disponible: {e}")
+        
+        if estimate is None:
+            with self._lock:
+                self.stats['no_plan'] += 1
+            if self.require_plan:
+                self._reject("❌ Consulta rechazada: no se pudo obtener el plan estimado")
+            return sql, None
+        
+        reason = self._over(estimate)
+        if not reason:
+            return sql, estimate
+        
+        # Solo el exceso de filas se corrige con TOP; el coste se vuelve a comprobar
+        if self.action == 'limit' and estimate.rows > self.max_rows:
+            limited = self._limiter.limit(sql, self.max_rows)
+            if limited != sql:
+                limited_estimate = self.estimate(db, limited, params)
+                if not self._over(limited_estimate):
+                    with self._lock:
+                        self.stats['limited'] += 1
+                    print(f"⚠️  Consulta limitada a {self.max_rows:,} filas ({reason})")
+                    return limited, limited_estimate
+                reason = self._over(limited_estimate)
+        
+        self._reject(f"❌ Consulta rechazada por coste: {reason}")
+    
+    def _reject(self, message):
+        with self._lock:
+            self.stats['rejected'] += 1
+        raise ValueError(message)
+    
+    def run(self, db, sql, params=None):
+        """Ejecuta con el tiempo máximo por consulta (si la conexión lo admite)"""
+        try:
+            return db.execute_query(sql, params, timeout=self.timeout or None)
+        except Exception as e:
+            raise self._translate(e)
+    
+    def stream(self, db, sql, params=None, batch_size=500):
+        """Como run(), pero devuelve las filas por lotes (iter_query de la conexión)"""
+        try:
+            yield from db.iter_query(sql, params, batch_size=batch_size, timeout=self.timeout or None)
+        except Exception as e:
+            raise self._translate(e)
+    
+    def _translate(self, error):
+        """Timeout (HYT00) y cancelación (HY008) como errores propios; el resto sin cambios"""
+        message = str(error)
+        if 'HYT00' in message or 'timeout' in message.lower():
+            with self._lock:
+                self.stats['timeouts'] += 1
+            return TimeoutError(f"❌ Consulta cancelada tras {self.timeout:g}s: {message}")
+        if 'HY008' in message:
+            with self._lock:
+                self.stats['cancelled'] += 1
+            return RuntimeError("❌ Consulta cancelada")
+        return error
+    
+    def cancel(self, db):
+        """Cancela las consultas en curso en la conexión; devuelve cuántas"""
+        if not hasattr(db, 'cancel'):
+            return 0
+        return db.cancel()
+
+
+# Prueba del control de coste
+if __name__ == "__main__":
+    print("=" * 70)
+    print("PRUEBA DE CONTROL DE COSTE")
+    print("=" * 70)
+    
+    plan = """<ShowPlanXML xmlns="http://schemas.microsoft.com/sqlserver/2004/07/showplan"><BatchSequence><Batch>
+    <Statements><StmtSimple StatementText="SELECT * FROM DCitas" StatementSubTreeCost="{cost}"
+    StatementEstRows="{rows}" StatementType="SELECT"/></Statements></Batch></BatchSequence></ShowPlanXML>"""
+    
+    class PlanOnlyDB:
+        """BD simulada: el plan depende de si la consulta tiene TOP"""
+        
+        def estimated_plan(self, sql, params=None):
+            if 'TOP' in sql:
+                return plan.format(cost=1.2, rows=1000)
+            return plan.format(cost=80.5, rows=2500000)
+    
+    guard = QueryGuard(max_cost=50, max_rows=1000, action='limit')
+    sql, estimate = guard.check(PlanOnlyDB(), "SELECT * FROM DCitas")
+    print(f"✅ {sql} | {estimate}")
+    
+    try:
+        QueryGuard(max_cost=50, max_rows=1000, action='reject').check(PlanOnlyDB(), "SELECT * FROM DCitas")
+    except ValueError as e:
+        print(f"⛔ {e}")
+    print(f"\n📊 {guard.stats}")
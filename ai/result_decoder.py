@@ -0,0 +1,170 @@
+"""
+FASE 3 - Decodificación de Resultados
+Convierte en el cliente, por columnas y en bloque, los valores codificados que devuelve
+el SQL generado: fechas como días desde 1900 (Fecha), horas como segundos desde
+medianoche (Hora), duraciones en segundos (Duracion) e IDs de catálogo (IdSitC, IdIcono,
+IdUsu). Así el SQL no lleva CASE WHEN ni DATEADD/CONVERT por fila y su plan se reutiliza
+"""
+
+import os
+from datetime import date
+
+from prompt_builder import DEFAULT_CATALOGS, load_catalogs
+from sql_rewriter import DAY_SERIAL_TYPES, DEFAULT_MAPPINGS, SECOND_OF_DAY_TYPES
+
+
+DURATION_TYPES = {'DURACION_MINUTOS'}
+
+# Mapeos por defecto (sin BD): los de DCitas más la duración
+DEFAULT_DECODE_MAPPINGS = DEFAULT_MAPPINGS + [
+    {'tabla': 'DCitas', 'columna_bd': 'Duracion', 'tipo_dato': 'DURACION_MINUTOS',
+     'formula_conversion': "CAST(CAST(Duracion AS DECIMAL(10, 2)) / 60 AS INT)"},
+]
+
+# Tablas de catálogo de las que se cargan los nombres: columna -> (tabla, columna descripción)
+LOOKUP_TABLES = {
+    'IdSitC': ('TSitCita', 'Descripcio'),
+    'IdIcono': ('IconoTratAgenda', 'Descripcion'),
+    'IdUsu': ('TUsuAgd', 'Descripcio'),
+}
+
+# Fecha = días desde 1900-01-01 + 2 (misma base que DATEADD(DAY, Fecha - 2, '1900-01-01'))
+_DAY_BASE = date(1900, 1, 1).toordinal() - 2
+
+
+def decode_day_serials(values):
+    """Días desde 1900 -> 'YYYY-MM-DD' (como CONVERT(VARCHAR(10), ..., 23))"""
+    return {v: date.fromordinal(_DAY_BASE + v).isoformat() for v in values}
+
+
+def decode_seconds(values):
+    """Segundos desde medianoche -> 'HH:MM' (como CONVERT(VARCHAR(5), ..., 108))"""
+    return {v: f"{v // 3600 % 24:02d}:{v // 60 % 60:02d}" for v in values}
+
+
+def decode_durations(values):
+    """Segundos -> minutos enteros (truncado, como la fórmula de MAPEO_COLUMNAS)"""
+    return {v: v // 60 for v in values}
+
+
+_DECODERS = {'day': decode_day_serials, 'second': decode_seconds, 'duration': decode_durations}
+
+
+def load_lookup_tables(db, tables=None):
+    """{columna: {id: nombre}} leídos de las tablas de catálogo (las que fallan se omiten)"""
+    lookups = {}
+    for column, (table, description) in (tables or LOOKUP_TABLES).items():
+        try:
+            rows = db.execute_query(f"SELECT {column} AS id, {description} AS nombre FROM {table}")
+        except Exception as e:
+            print(f"⚠️  Catálogo {table} no disponible, se usan los valores por defecto: {e}")
+            continue
+        lookups[column] = {row['id']: (row['nombre'] or '').strip() for row in rows if row['id'] is not None}
+    return lookups
+
+
+class ResultDecoder:
+    """Decodifica columnas de filas de resultado por bloques usando MAPEO_COLUMNAS y catálogos"""
+    
+    def __init__(self, mappings=None, lookups=None):
+        # {COLUMNA: (tipo de decodificación, tablas)}; solo columnas codificadas
+        self.encoded = {}
+        for m in mappings if mappings is not None else DEFAULT_DECODE_MAPPINGS:
+            tipo = (m.get('tipo_dato') or '').upper()
+            formula = (m.get('formula_conversion') or '').upper().replace(' ', '')
+            if tipo in DAY_SERIAL_TYPES or "DATEADD(DAY," in formula and "'1900-01-01'" in formula:
+                kind = 'day'
+            elif tipo in SECOND_OF_DAY_TYPES or "DATEADD(SECOND," in formula:
+                kind = 'second'
+            elif tipo in DURATION_TYPES or formula.endswith('/60ASINT)'):
+                kind = 'duration'
+            else:
+                continue
+            _, tables = self.encoded.setdefault(m['columna_bd'].upper(), (kind, set()))
+            tables.add(m['tabla'].upper())
+        
+        if lookups is None:
+            lookups = {column: catalog['valores'] for column, catalog in DEFAULT_CATALOGS.items()}
+        self.lookups = {column.upper(): dict(values) for column, values in lookups.items()}
+        self.stats = {'rows': 0, 'values': 0, 'distinct': 0}
+    
+    @classmethod
+    def from_config_cache(cls, cache):
+        """Mapeos de MAPEO_COLUMNAS; catálogos por defecto < tablas de catálogo < CONFIG_SISTEMA"""
+        lookups = {column: dict(catalog['valores']) for column, catalog in DEFAULT_CATALOGS.items()}
+        lookups.update(load_lookup_tables(cache.db))
+        rows = cache.get_category('CATALOGO')
+        catalogs = load_catalogs(rows)
+        for row in rows:
+            if row['clave'] in catalogs:
+                lookups.setdefault(row['clave'], {}).update(catalogs[row['clave']]['valores'])
+        return cls(cache.mappings or DEFAULT_DECODE_MAPPINGS, lookups)
+    
+    def plan(self, columns, tables=None):
+        """[(columna, tipo, destino)] aplicables a las columnas del resultado"""
+        tables = {t.split('.')[-1].upper() for t in tables} if tables else None
+        steps = []
+        for column in columns:
+            upper = column.upper()
+            encoded = self.encoded.get(upper)
+            # Con tablas conocidas, solo si alguna de ellas tiene la columna codificada
+            if encoded and (tables is None or encoded[1] & tables):
+                steps.append((column, encoded[0], column))
+            if upper in self.lookups:
+                steps.append((column, 'lookup', f"{column}_nombre"))
+        return steps
+    
+    def decode(self, rows, tables=None):
+        """Filas nuevas con los valores decodificados (las de entrada no se modifican)
+
+        Cada columna se decodifica de una vez: se convierten solo sus valores
+        distintos y después se reparte el resultado por las filas. Los valores
+        que no son enteros (NULL, texto ya convertido) se dejan igual.
+        """
+        if not rows:
+            return rows
+        steps = self.plan(list(rows[0].keys()), tables)
+        if not steps:
+            return rows
+        
+        decoded = [dict(row) for row in rows]
+        for column, kind, target in steps:
+            values = [row.get(column) for row in rows]
+            distinct = {v for v in values if isinstance(v, int) and not isinstance(v, bool)}
+            if kind == 'lookup':
+                table = self.lookups[column.upper()]
+                mapping = {v: table[v] for v in distinct if v in table}
+            else:
+                mapping = _DECODERS[kind](distinct)
+            for row, value in zip(decoded, values):
+                row[target] = mapping.get(value, value) if kind != 'lookup' else mapping.get(value)
+            self.stats['values'] += len(values)
+            self.stats['distinct'] += len(distinct)
+        self.stats['rows'] += len(rows)
+        return decoded
+
+
+def decoding_enabled():
+    """IA_DECODE_RESULTS=0 desactiva la decodificación en el cliente"""
+    return os.getenv('IA_DECODE_RESULTS', '1') != '0'
+
+
+# Prueba de decodificación
+if __name__ == "__main__":
+    import time
+    
+    print("=" * 70)
+    print("PRUEBA DE DECODIFICACIÓN DE RESULTADOS")
+    print("=" * 70)
+    
+    decoder = ResultDecoder()
+    rows = [{'IdCita': i, 'Fecha': 46312 + i % 30, 'Hora': 32400 + (i % 20) * 900, 'Duracion': 1800,
+             'IdUsu': (3, 4, 8, 10, 12)[i % 5], 'IdSitC': (0, 5, 7)[i % 3], 'IdIcono': 13}
+            for i in range(50000)]
+    
+    started = time.perf_counter()
+    decoded = decoder.decode(rows, tables=['DCitas'])
+    elapsed = time.perf_counter() - started
+    
+    print(f"\n📝 {rows[0]}\n➡️  {decoded[0]}")
+    print(f"\n📊 {len(rows):,} filas en {elapsed * 1000:.1f} ms | {decoder.stats}")
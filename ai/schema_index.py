@@ -0,0 +1,252 @@
+"""
+FASE 2 - Índice de Relevancia del Esquema
+Índice BM25 local (sin red) sobre descripciones de tablas, mapeos de columnas y
+nombres coloquiales. Para cada petición selecciona solo las tablas y columnas
+relevantes dentro de un presupuesto de tokens, de modo que el prompt no crece
+con el catálogo
+"""
+
+import json
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+
+# Palabras sin valor para la búsqueda
+STOPWORDS = {
+    'a', 'al', 'con', 'cual', 'cuales', 'cuanto', 'cuantos', 'cuantas', 'de', 'del', 'el', 'en',
+    'es', 'esta', 'este', 'hay', 'la', 'las', 'lo', 'los', 'me', 'mi', 'muestrame', 'muestra',
+    'para', 'por', 'que', 'se', 'sin', 'su', 'sus', 'tenemos', 'todas', 'todos', 'un', 'una',
+    'y', 'o', 'dame', 'lista', 'listar', 'ver', 'quiero', 'dr', 'dra', 'id'
+}
+
+# Nombres coloquiales de las tablas principales de GELITE
+TABLE_SYNONYMS = {
+    'DCitas': 'cita citas agenda agendamiento hora fecha consulta visita odontologo doctor',
+    'Pacientes': 'paciente pacientes cliente nombre apellidos telefono ficha',
+    'Tratamientos': 'tratamiento tratamientos catalogo acto',
+    'TtosMed': 'tratamiento realizado historial clinico pieza diente',
+    'Presu': 'presupuesto presupuestos estimacion importe',
+    'TColabos': 'doctor doctora odontologo dentista colaborador higienista',
+    'TSitCita': 'estado situacion cita anulada confirmada cancelada',
+    'Clientes': 'aseguradora mutua cliente compañia',
+}
+
+_CAMEL_CASE = re.compile(r'(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])')
+_TOKEN = re.compile(r'[a-z0-9]+')
+_VOWELS = set('aeiou')
+# Consonantes tras las que el plural añade "es" (doctor-es, actividad-es, total-es, vez -> vec-es)
+_ES_CONSONANTS = set('lnrdjc')
+
+
+def _stem(token):
+    """Singular aproximado: citas -> cita, doctores -> doctor, clientes -> cliente
+
+    El plural y el singular de una palabra dan siempre la misma raíz: tras
+    vocal + l/n/r/d/j/c, la "e" final se quita también en singular (cine/cines
+    -> cin), y la z final pasa a c (vez/veces -> vec).
+    """
+    if len(token) > 4 and token.endswith('es') and token[-3] in _ES_CONSONANTS and token[-4] in _VOWELS:
+        return token[:-2]
+    if len(token) > 3 and token.endswith('s'):
+        token = token[:-1]
+    if len(token) > 3 and token.endswith('e') and token[-2] in _ES_CONSONANTS and token[-3] in _VOWELS:
+        return token[:-1]
+    if token.endswith('z'):
+        return token[:-1] + 'c'
+    return token
+
+
+def normalize_tokens(text):
+    """Tokeniza en español: separa camelCase, minúsculas, sin acentos, stemming ligero"""
+    if not text:
+        return []
+    text = _CAMEL_CASE.sub(' ', text.replace('_', ' '))
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    
+    tokens = []
+    for token in _TOKEN.findall(text):
+        if token in STOPWORDS or len(token) < 2:
+            continue
+        tokens.append(_stem(token))
+    return tokens
+
+
+def estimate_tokens(text):
+    """Estimación rápida de tokens del modelo (~4 caracteres por token)"""
+    return len(text) // 4 + 1
+
+
+class SchemaIndex:
+    """Índice BM25 de tablas con sus columnas y mapeos"""
+    
+    def __init__(self, k1=1.5, b=0.5):
+        self.k1 = k1
+        self.b = b
+        self.exact_name_boost = 2.0
+        self.tables = {}
+        self._postings = defaultdict(dict)
+        self._doc_lengths = {}
+        self._avg_length = 0.0
+        self._name_terms = {}
+    
+    def add_table(self, table_name, description=None, mappings=()):
+        """Añade (o amplía) el documento de una tabla"""
+        entry = self.tables.setdefault(table_name, {'description': None, 'mappings': []})
+        if description:
+            entry['description'] = description
+        entry['mappings'].extend(mappings)
+    
+    def build(self):
+        """Construye el índice invertido; llamar tras añadir todas las tablas"""
+        self._postings = defaultdict(dict)
+        self._doc_lengths = {}
+        self._name_terms = {}
+        
+        for table_name, entry in self.tables.items():
+            self._name_terms[table_name] = (
+                frozenset(normalize_tokens(table_name)),
+                frozenset(normalize_tokens(TABLE_SYNONYMS.get(table_name, '')))
+            )
+
+            # El nombre de la tabla y sus sinónimos pesan el triple que las columnas
+            terms = normalize_tokens(table_name) * 3
+            terms += normalize_tokens(TABLE_SYNONYMS.get(table_name, '')) * 3
+            terms += normalize_tokens(entry['description'])
+            for m in entry['mappings']:
+                terms += normalize_tokens(m['columna_bd'])
+                if m.get('nombre_coloquial') and m['nombre_coloquial'] != m['columna_bd']:
+                    terms += normalize_tokens(m['nombre_coloquial'])
+            
+            for term, freq in Counter(terms).items():
+                self._postings[term][table_name] = freq
+            self._doc_lengths[table_name] = len(terms)
+        
+        total = len(self._doc_lengths)
+        self._avg_length = (sum(self._doc_lengths.values()) / total) if total else 0.0
+        return self
+    
+    def search(self, query, top_k=5):
+        """Tablas más relevantes para la consulta: [(tabla, puntuación)]"""
+        total = len(self._doc_lengths)
+        if not total:
+            return []
+        
+        query_terms = set(normalize_tokens(query))
+        scores = defaultdict(float)
+        for term in query_terms:
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for table_name, freq in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[table_name] / self._avg_length)
+                scores[table_name] += idf * freq * (self.k1 + 1) / (freq + norm)
+        
+        # La tabla nombrada exactamente (o por un sinónimo) gana a sus tablas satélite
+        for table_name in scores:
+            name_terms, synonyms = self._name_terms[table_name]
+            if (name_terms and name_terms <= query_terms) or synonyms & query_terms:
+                scores[table_name] *= self.exact_name_boost
+        
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:top_k]
+    
+    def build_context(self, query, top_k=5, token_budget=800, max_columns=15):
+        """Sección de esquema para el prompt limitada a token_budget tokens"""
+        ranked = self.search(query, top_k)
+        if not ranked:
+            return ''
+        
+        query_terms = set(normalize_tokens(query))
+        header = "\n\n**ESQUEMA RELEVANTE PARA ESTA PETICIÓN**:\n"
+        parts = [header]
+        used = estimate_tokens(header)
+        
+        for table_name, _ in ranked:
+            entry = self.tables[table_name]
+            table_line = f"\n{table_name}"
+            if entry['description']:
+                table_line += f": {entry['description']}"
+            table_line += "\n"
+            
+            cost = estimate_tokens(table_line)
+            if used + cost > token_budget:
+                break
+            parts.append(table_line)
+            used += cost
+            
+            # Primero las columnas con fórmula, luego las que coinciden con la consulta
+            def column_rank(m):
+                has_formula = m.get('formula_conversion') is not None
+                matches = bool(query_terms & set(normalize_tokens(f"{m['columna_bd']} {m.get('nombre_coloquial') or ''}")))
+                return (not has_formula, not matches, m['columna_bd'])
+            
+            for m in sorted(entry['mappings'], key=column_rank)[:max_columns]:
+                line = f"- {table_name}.{m['columna_bd']}"
+                if m.get('nombre_coloquial') and m['nombre_coloquial'] != m['columna_bd']:
+                    line += f" → {m['nombre_coloquial']}"
+                if m.get('formula_conversion'):
+                    line += f": {m['formula_conversion']}"
+                line += "\n"
+                
+                cost = estimate_tokens(line)
+                if used + cost > token_budget:
+                    break
+                parts.append(line)
+                used += cost
+        
+        return ''.join(parts)
+    
+    @classmethod
+    def from_config_cache(cls, cache):
+        """Construye el índice desde ConfigCache (DESCRIPCION_TABLA + MAPEO_COLUMNAS)"""
+        index = cls()
+        for row in cache.get_category('DESCRIPCION_TABLA'):
+            index.add_table(row['clave'], row['valor'])
+        
+        by_table = defaultdict(list)
+        for m in cache.mappings:
+            by_table[m['tabla']].append(m)
+        for table_name, mappings in by_table.items():
+            index.add_table(table_name, mappings=mappings)
+        return index.build()
+    
+    @classmethod
+    def from_discovery_file(cls, discovery_file='database/schema/auto_discovery_results.json', mappings=()):
+        """Construye el índice desde los resultados de AutoDiscoveryEngine (sin BD)"""
+        with open(discovery_file, 'r', encoding='utf-8') as f:
+            discovery = json.load(f)
+        
+        index = cls()
+        for table_name, description in discovery.get('table_descriptions', {}).items():
+            index.add_table(table_name, description)
+        
+        by_table = defaultdict(list)
+        for m in mappings:
+            by_table[m['tabla']].append(m)
+        for table_name, table_mappings in by_table.items():
+            index.add_table(table_name, mappings=table_mappings)
+        return index.build()
+
+
+# Prueba del índice: singular y plural dan los mismos términos
+if __name__ == "__main__":
+    print("=" * 70)
+    print("PRUEBA DEL ÍNDICE DE RELEVANCIA DEL ESQUEMA")
+    print("=" * 70)
+    
+    pairs = [('paciente', 'pacientes'), ('cliente', 'clientes'), ('importe', 'importes'),
+             ('doctor', 'doctores'), ('actividad', 'actividades'), ('cita', 'citas'),
+             ('nombre', 'nombres'), ('total', 'totales'), ('vez', 'veces'), ('tarde', 'tardes')]
+    for singular, plural in pairs:
+        same = normalize_tokens(singular) == normalize_tokens(plural)
+        print(f"{'✅' if same else '❌'} {singular} / {plural} -> {normalize_tokens(singular)} {normalize_tokens(plural)}")
+    
+    index = SchemaIndex()
+    index.add_table('Facturas', 'Importe facturado por cliente')
+    index.add_table('DCitas', 'Citas de la agenda')
+    index.build()
+    print(f"\n🔎 importes de los clientes -> {index.search('importes de los clientes')}")
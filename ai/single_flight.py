@@ -0,0 +1,103 @@
+"""
+FASE 3 - Agrupación de Peticiones en Curso (single-flight)
+Las llamadas concurrentes con la misma clave comparten una única ejecución: la
+primera la lanza y las demás esperan su resultado (o su error)
+"""
+
+import threading
+
+
+class _Flight:
+    """Ejecución en curso para una clave"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Agrupa llamadas idénticas simultáneas en una sola ejecución"""
+    
+    def __init__(self, name='single-flight', copy=None):
+        self.name = name
+        # Cada llamada recibe copy(resultado); el objeto compartido no sale nunca
+        self.copy = copy
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, 'executions': 0, 'shared': 0, 'errors': 0}
+    
+    def do(self, key, fn, *args, **kwargs):
+        """Ejecuta fn(*args, **kwargs) salvo que ya haya una ejecución en curso para key
+        
+        Todas las llamadas que coinciden reciben el mismo objeto resultado, o
+        una copia propia si se indicó copy; si la ejecución falla, todas
+        reciben la misma excepción.
+        """
+        with self._lock:
+            self.stats['calls'] += 1
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.waiters += 1
+                self.stats['shared'] += 1
+                leader = False
+            else:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.stats['executions'] += 1
+                leader = True
+        
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return self._result(flight)
+        
+        try:
+            flight.result = fn(*args, **kwargs)
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self.stats['errors'] += 1
+            raise
+        finally:
+            # La clave se libera al terminar: las llamadas posteriores vuelven a ejecutar
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+        return self._result(flight)
+    
+    def _result(self, flight):
+        return self.copy(flight.result) if self.copy is not None else flight.result
+    
+    @property
+    def saved(self):
+        """Ejecuciones evitadas por agrupación"""
+        return self.stats['shared']
+    
+    def in_flight(self):
+        """Número de claves con ejecución en curso"""
+        with self._lock:
+            return len(self._flights)
+
+
+# Prueba: 10 hilos preguntan lo mismo a la vez
+if __name__ == "__main__":
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    
+    print("=" * 70)
+    print("PRUEBA DE SINGLE-FLIGHT")
+    print("=" * 70)
+    
+    flight = SingleFlight('citas-hoy')
+    
+    def slow_query():
+        time.sleep(0.2)
+        return [{'total': 42}]
+    
+    with ThreadPoolExecutor(max_workers=10) as pool:
+        results = list(pool.map(lambda _: flight.do('¿qué citas hay hoy?', slow_query), range(10)))
+    
+    print(f"✅ {len(results)} respuestas, {flight.stats['executions']} ejecución(es), {flight.saved} ahorradas")
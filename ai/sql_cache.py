@@ -0,0 +1,202 @@
+"""
+FASE 3 - Caché de Consultas NL→SQL
+Guarda el SQL ya validado por petición normalizada (mayúsculas, acentos, espacios y
+fechas relativas resueltas) y versión de configuración. Nivel en memoria LRU con TTL
+y nivel persistente en SQLite para compartirlo entre procesos y reinicios
+"""
+
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import date, timedelta
+
+
+# En <repo>/database/cache, con independencia del directorio de trabajo
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'database', 'cache', 'sql_cache.sqlite3')
+
+_PUNCTUATION = re.compile(r"[¿?¡!.,;:\"'()]+")
+_SPACES = re.compile(r'\s+')
+_NUMERIC_DATE = re.compile(r'\b(\d{1,2})[/-](\d{1,2})[/-](\d{4})\b')
+
+# "mañana" como franja del día, no como fecha
+_MORNING = re.compile(r'\b(por|de|a|esta) la manana\b|\besta manana\b')
+
+
+def _fold(text):
+    """Minúsculas y sin acentos (mañana -> manana)"""
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+
+def _week(day):
+    """Semana ISO canónica, p. ej. 'semana 2026-W42'"""
+    year, week, _ = day.isocalendar()
+    return f"semana {year}-W{week:02d}"
+
+
+def _month(day):
+    """Mes canónico, p. ej. 'mes 2026-10'"""
+    return f"mes {day.year}-{day.month:02d}"
+
+
+def _canonicalize(text, today):
+    """(forma canónica, número de fechas relativas resueltas) de una petición"""
+    text = _fold(text)
+    
+    # Fechas numéricas dd/mm/aaaa -> aaaa-mm-dd
+    def numeric_date(match):
+        day, month, year = (int(g) for g in match.groups())
+        try:
+            return date(year, month, day).isoformat()
+        except ValueError:
+            return match.group(0)
+    text = _NUMERIC_DATE.sub(numeric_date, text)
+    
+    text = _PUNCTUATION.sub(' ', text)
+    text = _SPACES.sub(' ', text).strip()
+    
+    # Proteger "por la mañana" antes de resolver "mañana" como día siguiente
+    text = _MORNING.sub(lambda m: m.group(0).replace('manana', '@franja@'), text)
+    
+    first_of_month = today.replace(day=1)
+    replacements = [
+        (r'\bpasado manana\b', (today + timedelta(days=2)).isoformat()),
+        (r'\banteayer\b', (today - timedelta(days=2)).isoformat()),
+        (r'\bmanana\b', (today + timedelta(days=1)).isoformat()),
+        (r'\bayer\b', (today - timedelta(days=1)).isoformat()),
+        (r'\bhoy\b', today.isoformat()),
+        (r'\b(?:la )?(?:proxima semana|semana que viene|semana proxima)\b', _week(today + timedelta(days=7))),
+        (r'\b(?:la )?semana pasada\b', _week(today - timedelta(days=7))),
+        (r'\besta semana\b', _week(today)),
+        (r'\b(?:el )?(?:proximo mes|mes que viene)\b', _month((first_of_month + timedelta(days=32)).replace(day=1))),
+        (r'\b(?:el )?mes pasado\b', _month(first_of_month - timedelta(days=1))),
+        (r'\beste mes\b', _month(today)),
+    ]
+    relative = 0
+    for pattern, value in replacements:
+        text, count = re.subn(pattern, value, text)
+        relative += count
+    
+    return text.replace('@franja@', 'manana'), relative
+
+
+def normalize_request(text, today=None):
+    """Forma canónica de una petición: sin acentos ni puntuación y con fechas absolutas"""
+    return _canonicalize(text, today or date.today())[0]
+
+
+class SQLCache:
+    """Caché de SQL validado: LRU en memoria + nivel persistente SQLite, ambos con TTL"""
+    
+    def __init__(self, max_entries=512, ttl_seconds=None, path=None):
+        if ttl_seconds is None:
+            ttl_seconds = float(os.getenv('IA_SQL_CACHE_TTL', str(6 * 3600)))
+        if path is None:
+            path = os.getenv('IA_SQL_CACHE_PATH', DEFAULT_CACHE_PATH)
+        
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits_memory': 0, 'hits_disk': 0, 'misses': 0, 'stores': 0}
+        
+        self._disk = None
+        if path:
+            try:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._disk = sqlite3.connect(path, check_same_thread=False)
+                self._disk.execute("""
+                    CREATE TABLE IF NOT EXISTS sql_cache (
+                        key TEXT PRIMARY KEY,
+                        request TEXT,
+                        sql TEXT NOT NULL,
+                        created_at REAL NOT NULL
+                    )
+                """)
+                self._disk.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️  Caché SQL persistente no disponible ({path}): {e}")
+                self._disk = None
+    
+    @staticmethod
+    def make_key(user_request, config_version, allow_write=False, today=None):
+        """Clave: petición normalizada + versión de configuración + modo
+
+        El modelo recibe la petición original y su SQL sigue siendo relativo a
+        GETDATE(): si la petición tenía fechas relativas, la clave lleva además
+        el día de hoy, para que "mañana" pedido ayer no responda a "hoy".
+        """
+        today = today or date.today()
+        normalized, relative = _canonicalize(user_request, today)
+        if relative:
+            normalized = f"{normalized}|@{today.isoformat()}"
+        raw = f"{config_version}|{int(bool(allow_write))}|{normalized}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        """SQL cacheado o None si no existe o ha caducado"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                sql, created_at = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.stats['hits_memory'] += 1
+                    return sql
+                del self._memory[key]
+            
+            if self._disk is not None:
+                row = self._disk.execute(
+                    "SELECT sql, created_at FROM sql_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    sql, created_at = row
+                    if now - created_at <= self.ttl_seconds:
+                        self._remember(key, sql, created_at)
+                        self.stats['hits_disk'] += 1
+                        return sql
+                    self._disk.execute("DELETE FROM sql_cache WHERE key = ?", (key,))
+                    self._disk.commit()
+            
+            self.stats['misses'] += 1
+            return None
+    
+    def put(self, key, sql, request=None):
+        """Guarda SQL ya validado en ambos niveles"""
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, sql, created_at)
+            if self._disk is not None:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO sql_cache (key, request, sql, created_at) VALUES (?, ?, ?, ?)",
+                    (key, request, sql, created_at)
+                )
+                self._disk.commit()
+            self.stats['stores'] += 1
+    
+    def _remember(self, key, sql, created_at):
+        """Inserta en el nivel de memoria respetando el límite LRU"""
+        self._memory[key] = (sql, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+    
+    def purge_expired(self):
+        """Elimina del nivel persistente las entradas caducadas"""
+        if self._disk is None:
+            return 0
+        with self._lock:
+            cursor = self._disk.execute(
+                "DELETE FROM sql_cache WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+            )
+            self._disk.commit()
+            return cursor.rowcount
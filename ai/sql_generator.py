@@ -3,91 +3,448 @@ FASE 2/3 - Generador de SQL con Gemini
 Genera consultas SQL desde lenguaje natural con validación
 """
 
+import os
 import re
-from gemini_client import GeminiAIClient
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from aggregates import AggregateManager
+from gemini_client import load_environment
+from query_guard import QueryGuard
+from result_decoder import ResultDecoder, decoding_enabled
+from single_flight import SingleFlight
+from sql_cache import SQLCache, normalize_request
+from sql_lexer import analyze
+from sql_pagination import KeyCatalog, SQLPaginator
+from sql_rewriter import SargableRewriter
+from sql_validator import SQLValidator
+from workload_log import get_shared_workload_log
+
+
+def _copy_rows(rows):
+    """Filas propias para cada llamada agrupada (las de la ejecución compartida no se entregan)"""
+    return [dict(row) for row in rows] if isinstance(rows, list) else rows
+
+
+def _copy_result(result):
+    """Resultado de natural_language_query con sus filas copiadas"""
+    return dict(result, rows=_copy_rows(result['rows'])) if 'rows' in result else dict(result)
 
 
 class SQLGenerator:
     """Generador de SQL usando Gemini con validación"""
     
-    def __init__(self, gemini_client, db_connection=None):
+    def __init__(self, gemini_client, db_connection=None, sql_cache=None):
+        # .env antes de leer IA_SQL_* (caché, límites, control de coste)
+        load_environment()
+        
         self.gemini = gemini_client
         self.db = db_connection
+        self.sql_cache = sql_cache if sql_cache is not None else SQLCache()
         self.dangerous_keywords = ['DROP', 'TRUNCATE', 'DELETE FROM', 'ALTER TABLE', 'EXEC']
+        self.validator = SQLValidator(self.dangerous_keywords)
+        
+        # Predicados de fecha/hora sobre el entero original (usa índices de DCitas)
+        self.rewrite_enabled = os.getenv('IA_SQL_REWRITE', '1') != '0'
+        self._default_rewriter = SargableRewriter()
+        
+        # Fechas, horas, duraciones e IDs se devuelven en bruto y se decodifican aquí
+        self.decode_enabled = decoding_enabled()
+        self._default_decoder = ResultDecoder()
+        
+        # Plan estimado, umbrales de coste y tiempo máximo antes de ejecutar SQL generado
+        self.guard = QueryGuard()
+        
+        # Estadísticas frecuentes desde tablas de resumen de DCitas (sin modelo)
+        self.aggregates = AggregateManager(db_connection) if db_connection else None
+        
+        # Registro de carga: todas las consultas de la conexión; las del modelo como 'generate_sql'
+        self.workload = get_shared_workload_log()
+        if self.workload and db_connection is not None and getattr(db_connection, 'query_observer', False) is None:
+            db_connection.query_observer = self.workload.observer(getattr(db_connection, 'workload_source', 'pipeline'))
+        
+        # Límite de filas por defecto (IA_SQL_ROW_LIMIT, 0 = sin límite); claves al primer uso
+        self._paginator = None
+        
+        # Peticiones y lecturas idénticas simultáneas comparten una única ejecución
+        # y reciben cada una su propia copia de las filas
+        self.request_flight = SingleFlight('natural_language_query', copy=_copy_result)
+        self.query_flight = SingleFlight('execute_query', copy=_copy_rows)
     
     def generate_sql(self, user_request, allow_write=False):
         """Genera SQL desde lenguaje natural"""
         
         print(f"🤖 Generando SQL para: {user_request}")
         
+        # Buscar en caché por petición normalizada y versión de configuración
+        cache_key = self.sql_cache.make_key(user_request, self.gemini.config_version(), allow_write)
+        cached_sql = self.sql_cache.get(cache_key)
+        if cached_sql is not None:
+            print("⚡ SQL recuperado de caché")
+            return cached_sql
+        
         # Generar SQL con Gemini
         sql = self.gemini.generate_sql(user_request)
         
         # Validar SQL
-        validated_sql = self.validate_sql(sql, allow_write)
+        validated_sql = self.rewrite_sql(self.validate_sql(sql, allow_write))
+        
+        # Solo se cachea SQL ya validado
+        self.sql_cache.put(cache_key, validated_sql, user_request)
         
         return validated_sql
     
-    def validate_sql(self, sql, allow_write=False):
-        """Valida que el SQL sea seguro"""
+    def generate_sql_batch(self, requests, allow_write=False, pack_size=5, execute=False):
+        """Genera (y opcionalmente ejecuta) SQL para una lista de peticiones
+
+        Las peticiones equivalentes (misma forma normalizada) se generan una sola
+        vez y se consultan primero en la caché. Las pendientes se agrupan de
+        pack_size en pack_size en una llamada al modelo con salida JSON por
+        elemento; los paquetes van en paralelo y lo que un paquete no resuelve
+        se genera individualmente. Cada SQL se valida por separado y los fallos
+        se informan por elemento sin detener el resto.
+        """
+        
+        started = time.perf_counter()
+        config_version = self.gemini.config_version()
+        stats = {'requests': len(requests), 'unique': 0, 'cache_hits': 0,
+                 'packed_calls': 0, 'individual_calls': 0, 'failed': 0}
+        stats_lock = threading.Lock()
+        
+        # Deduplicar por clave de caché (petición normalizada + versión + modo)
+        unique = {}
+        for position, user_request in enumerate(requests):
+            key = self.sql_cache.make_key(user_request, config_version, allow_write)
+            unique.setdefault(key, {'request': user_request, 'positions': []})['positions'].append(position)
+        stats['unique'] = len(unique)
+        
+        answers = {}
+        pending = []
+        for key, entry in unique.items():
+            cached_sql = self.sql_cache.get(key)
+            if cached_sql is not None:
+                answers[key] = {'sql': cached_sql, 'source': 'cache'}
+                stats['cache_hits'] += 1
+            else:
+                pending.append(key)
         
-        if not sql or sql.startswith('--'):
-            raise ValueError("No se pudo generar SQL válido")
+        def validate(key, sql, source):
+            if sql.startswith('-- Error'):
+                # Fallo de la llamada individual: se conserva el mensaje original
+                answers[key] = {'error': sql[3:].strip(), 'source': source}
+                return
+            try:
+                validated_sql = self.rewrite_sql(self.validate_sql(sql, allow_write))
+                self.sql_cache.put(key, validated_sql, unique[key]['request'])
+                answers[key] = {'sql': validated_sql, 'source': source}
+            except ValueError as e:
+                answers[key] = {'error': str(e), 'source': source}
         
-        sql_upper = sql.upper()
+        def run_pack(keys):
+            with stats_lock:
+                stats['packed_calls'] += 1
+            # Ids posicionales cortos ("1".."n"): el modelo los repite sin errores de copia
+            ids = {str(number): key for number, key in enumerate(keys, 1)}
+            try:
+                answered = self.gemini.generate_sql_batch(
+                    [(item_id, unique[key]['request']) for item_id, key in ids.items()])
+            except Exception as e:
+                print(f"⚠️  Paquete de {len(keys)} peticiones falló, se generan por separado: {e}")
+                answered = {}
+            generated = {ids[item_id]: sql for item_id, sql in answered.items() if item_id in ids}
+            for key in keys:
+                if key in generated:
+                    validate(key, generated[key], 'batch')
+            return [key for key in keys if key not in generated]
         
-        # Prevenir operaciones peligrosas
-        for keyword in self.dangerous_keywords:
-            if keyword in sql_upper:
-                raise ValueError(f"❌ SQL contiene operación peligrosa: {keyword}")
+        def run_single(key):
+            with stats_lock:
+                stats['individual_calls'] += 1
+            validate(key, self.gemini.generate_sql(unique[key]['request']), 'individual')
         
-        # Si no se permiten escrituras, solo SELECT
-        if not allow_write:
-            if not sql_upper.strip().startswith('SELECT'):
-                raise ValueError("❌ Solo se permiten consultas SELECT en modo lectura")
+        if pending:
+            packs = [pending[i:i + pack_size] for i in range(0, len(pending), pack_size)] if pack_size > 1 else []
+            workers = max(1, getattr(getattr(self.gemini, 'scheduler', None), 'max_in_flight', 4))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                leftovers = [key for missing in pool.map(run_pack, packs) for key in missing]
+                if not packs:
+                    leftovers = pending
+                list(pool.map(run_single, leftovers))
         
-        # Validar que no haya múltiples statements (prevenir SQL injection)
-        if ';' in sql and not sql.strip().endswith(';'):
-            raise ValueError("❌ No se permiten múltiples statements SQL")
+        results = [None] * len(requests)
+        for key, entry in unique.items():
+            answer = answers[key]
+            item = {'request': entry['request'], 'source': answer['source'], 'executed': False}
+            if 'error' in answer:
+                item['error'] = answer['error']
+                stats['failed'] += 1
+            else:
+                item['sql'] = answer['sql']
+                # La conexión no es segura entre hilos: se ejecuta en serie
+                if execute and self.db:
+                    item.update(self.execute_paged(answer['sql']))
+                    item['executed'] = True
+            for position in entry['positions']:
+                results[position] = dict(item, request=requests[position])
+        
+        stats['elapsed'] = time.perf_counter() - started
+        print(f"📦 Lote: {stats['requests']} peticiones, {stats['unique']} únicas, "
+              f"{stats['cache_hits']} en caché, {stats['packed_calls']} paquetes, "
+              f"{stats['individual_calls']} individuales, {stats['failed']} fallidas "
+              f"({stats['elapsed']:.2f}s)")
+        return {'results': results, 'stats': stats}
+    
+    def validate_sql(self, sql, allow_write=False):
+        """Valida que el SQL sea seguro
+
+        El análisis es léxico (sql_validator): palabras peligrosas solo como
+        palabras clave, comentarios y literales ignorados y detección real de
+        lotes con varias sentencias. El SQL repetido se resuelve en la caché
+        de veredictos sin volver a analizarlo.
+        """
+        
+        validated_sql = self.validator.validate(sql, allow_write)
         
         print("✅ SQL validado correctamente")
-        return sql
+        return validated_sql
+    
+    def rewrite_sql(self, sql):
+        """Reescribe predicados no indexables sobre columnas con fórmula de conversión
+
+        Las columnas y sus codificaciones salen de MAPEO_COLUMNAS (tipo_dato
+        FECHA_DIAS/HORA_SEGUNDOS o fórmula con DATEADD); sin BD se usan las de
+        DCitas. La conversión se mantiene en la lista del SELECT.
+        """
+        if not self.rewrite_enabled:
+            return sql
+        
+        rewriter = self._default_rewriter
+        cache = getattr(self.gemini, 'config_cache', None)
+        if cache is not None:
+            try:
+                rewriter = cache.derived('sargable_rewriter', SargableRewriter.from_config_cache)
+            except Exception as e:
+                print(f"⚠️  Mapeos no disponibles para reescritura, se usan los de DCitas: {e}")
+        
+        rewritten = rewriter.rewrite(sql)
+        if rewritten != sql:
+            print("⚡ Predicados de fecha/hora reescritos a rangos sobre columnas enteras")
+        return rewritten
+    
+    def decode_rows(self, rows, sql):
+        """Decodifica en bloque las columnas codificadas e IDs de catálogo del resultado
+
+        Los tipos de cada columna salen de MAPEO_COLUMNAS y los nombres de las
+        tablas de catálogo (TSitCita, IconoTratAgenda, TUsuAgd), cargados una vez
+        por versión de configuración; sin BD se usan los de DCitas.
+        """
+        if not self.decode_enabled or not isinstance(rows, list) or not rows:
+            return rows
+        
+        decoder = self._default_decoder
+        cache = getattr(self.gemini, 'config_cache', None)
+        if cache is not None and self.db:
+            try:
+                decoder = cache.derived('result_decoder', ResultDecoder.from_config_cache)
+            except Exception as e:
+                print(f"⚠️  Mapeos no disponibles para decodificar, se usan los de DCitas: {e}")
+        
+        tables = analyze(sql).tables
+        if self.aggregates:
+            tables = self.aggregates.source_tables(tables)
+        return decoder.decode(rows, tables)
     
     def execute_sql(self, sql, params=None):
-        """Ejecuta SQL validado en la base de datos"""
+        """Ejecuta SQL validado en la base de datos
+
+        Los SELECT pasan antes por el control de coste (plan estimado): por
+        encima de los umbrales se limitan con TOP o se rechazan. Todo se
+        ejecuta con tiempo máximo por consulta y se puede cancelar con cancel().
+        """
         
         if not self.db:
             return {"error": "Base de datos no disponible"}
         
         try:
-            result = self.db.execute_query(sql, params)
-            return {
+            # Las consultas del modelo se registran con su propio origen
+            is_select = analyze(sql).statement_type == 'SELECT'
+            with self._tagged():
+                if is_select:
+                    sql, estimate = self.guard.check(self.db, sql, params)
+                    key = (sql.strip(), tuple(params) if params else ())
+                    result = self.query_flight.do(key, self.guard.run, self.db, sql, params)
+                else:
+                    estimate = None
+                    result = self.guard.run(self.db, sql, params)
+            if is_select:
+                result = self.decode_rows(result, sql)
+            response = {
                 "success": True,
                 "rows": result,
                 "count": len(result) if result else 0
             }
+            if estimate is not None:
+                response["estimate"] = {"cost": estimate.cost, "rows": estimate.rows}
+            return response
         except Exception as e:
             return {
                 "success": False,
                 "error": str(e)
             }
     
-    def natural_language_query(self, user_request, execute=False):
-        """Procesa consulta en lenguaje natural completa"""
+    def _tagged(self):
+        """Contexto que registra las consultas del hilo con origen 'generate_sql'"""
+        return self.workload.tagged('generate_sql') if self.workload else nullcontext()
+    
+    def cancel(self):
+        """Cancela las consultas en curso en la conexión (desde otro hilo)"""
+        if not self.db:
+            return 0
+        cancelled = self.guard.cancel(self.db)
+        if cancelled:
+            print(f"🛑 {cancelled} consulta(s) cancelada(s)")
+        return cancelled
+    
+    @property
+    def paginator(self):
+        """Paginador con las claves únicas de la BD (o del esquema extraído si no hay BD)"""
+        if self._paginator is None:
+            catalog = None
+            if self.db:
+                try:
+                    catalog = KeyCatalog.from_db(self.db)
+                except Exception as e:
+                    print(f"⚠️  Claves no disponibles en la BD, se usa el esquema extraído: {e}")
+            self._paginator = SQLPaginator(catalog or KeyCatalog.from_schema_file())
+        return self._paginator
+    
+    def execute_paged(self, sql, page_size=None, page_token=None, params=None):
+        """Ejecuta un SELECT por páginas y devuelve el token de la siguiente
+
+        Sin page_size se usa el límite por defecto. Si la consulta se ordena por
+        una clave única de su tabla (o no tiene orden y la tabla tiene clave) se
+        pagina por clave; si no, con OFFSET-FETCH. Se pide una fila de más para
+        saber si hay otra página: next_token es None en la última.
+        """
+        page_size = page_size or self.paginator.default_limit
+        if not page_size or analyze(sql).statement_type != 'SELECT':
+            return self.execute_sql(sql, params)
+        
+        try:
+            page_sql, state = self.paginator.page(sql, page_size, page_token)
+        except ValueError as e:
+            return {"success": False, "error": str(e)}
+        
+        result = self.execute_sql(page_sql, params)
+        if result.get("success"):
+            rows, next_token = self.paginator.finish_page(state, result["rows"] or [], page_size)
+            result.update(rows=rows, count=len(rows), next_token=next_token, page_sql=page_sql)
+        return result
+    
+    def route_aggregate(self, user_request):
+        """Ruta a una tabla de resumen si la petición es una estadística que puede responder"""
+        if not self.aggregates:
+            return None
+        route = self.aggregates.route(user_request)
+        if route:
+            print(f"⚡ Respondida desde {route.aggregate} (sin modelo)")
+        return route
+    
+    def sql_for_request(self, user_request):
+        """SQL de la tabla de resumen si encaja; si no, SQL generado y validado"""
+        route = self.route_aggregate(user_request)
+        return route.sql if route else self.generate_sql(user_request, allow_write=False)
+    
+    def natural_language_query(self, user_request, execute=False, page_size=None, page_token=None):
+        """Procesa consulta en lenguaje natural completa
+
+        Las peticiones equivalentes que llegan mientras otra igual está en curso
+        esperan y reciben una copia de su resultado. Al ejecutar se devuelve una
+        página (next_token para pedir la siguiente con page_token).
+        """
+        key = (bool(execute), normalize_request(user_request), page_size, page_token)
+        result = self.request_flight.do(key, self._natural_language_query, user_request, execute,
+                                        page_size, page_token)
+        return dict(result, request=user_request)
+    
+    def natural_language_query_stream(self, user_request, batch_size=500):
+        """Versión en streaming de natural_language_query
+
+        Produce eventos: primero {'type': 'sql'}, después {'type': 'rows'} con
+        cada lote según llega de la BD (fetchmany) y al final {'type': 'end'}
+        con el número total de filas. Un fallo produce {'type': 'error'} y
+        termina. Las filas nunca se acumulan en memoria.
+        """
+        started = time.perf_counter()
+        try:
+            sql = self.sql_for_request(user_request)
+            if not self.db:
+                raise ValueError("Base de datos no disponible")
+            # El control de coste puede limitar el SQL: se anuncia el que se ejecuta
+            sql, estimate = self.guard.check(self.db, sql)
+        except Exception as e:
+            yield {"type": "error", "request": user_request, "error": str(e)}
+            return
+        event = {"type": "sql", "request": user_request, "sql": sql}
+        if estimate is not None:
+            event["estimate"] = {"cost": estimate.cost, "rows": estimate.rows}
+        yield event
         
+        count = 0
+        batches = 0
+        batches_iter = self.guard.stream(self.db, sql, batch_size=batch_size)
         try:
-            # 1. Generar SQL
-            sql = self.generate_sql(user_request, allow_write=False)
+            while True:
+                # Cada lote se lee con la etiqueta activa (el registro se hace al agotar el cursor)
+                with self._tagged():
+                    rows = next(batches_iter, None)
+                if rows is None:
+                    break
+                count += len(rows)
+                batches += 1
+                yield {"type": "rows", "rows": self.decode_rows(rows, sql), "offset": count - len(rows)}
+        except Exception as e:
+            yield {"type": "error", "request": user_request, "error": str(e), "count": count}
+            return
+        finally:
+            # Si el consumidor deja de leer, el cursor se cierra aquí (y se registra con la
+            # etiqueta), no al recolectar el generador
+            with self._tagged():
+                batches_iter.close()
+        
+        yield {"type": "end", "request": user_request, "count": count, "batches": batches,
+               "elapsed": time.perf_counter() - started}
+    
+    def coalescing_stats(self):
+        """Contadores de llamadas agrupadas (ejecuciones ahorradas)"""
+        return {
+            'natural_language_query': dict(self.request_flight.stats),
+            'execute_query': dict(self.query_flight.stats),
+            'saved': self.request_flight.saved + self.query_flight.saved
+        }
+    
+    def _natural_language_query(self, user_request, execute=False, page_size=None, page_token=None):
+        """Generación, validación y ejecución de una petición"""
+        
+        try:
+            # 1. Generar SQL (o consultar el resumen si es una estadística conocida)
+            route = self.route_aggregate(user_request)
+            sql = route.sql if route else self.generate_sql(user_request, allow_write=False)
             
             result = {
                 "request": user_request,
                 "sql": sql,
                 "executed": False
             }
+            if route:
+                result["source"] = "aggregate"
+                result["aggregate"] = route.aggregate
             
             # 2. Ejecutar si se solicita
             if execute and self.db:
-                execution_result = self.execute_sql(sql)
+                execution_result = self.execute_paged(sql, page_size, page_token)
                 result.update(execution_result)
                 result["executed"] = True
             
@@ -107,6 +464,14 @@ if __name__ == "__main__":
     print("PRUEBA DE SQL GENERATOR")
     print("=" * 70)
     
+    # Solo medir el coste de arranque de los módulos
+    if '--profile-startup' in sys.argv:
+        from startup_profile import run_startup_profile
+        sys.exit(run_startup_profile())
+    
+    # El cliente (y con él el SDK) solo se importa al usarlo
+    from gemini_client import GeminiAIClient
+    
     # Crear cliente Gemini
     gemini = GeminiAIClient()
     
@@ -130,6 +495,12 @@ if __name__ == "__main__":
         else:
             print(f"✅ SQL generado:\n{result['sql']}\n")
     
+    # Prueba por lotes (las peticiones repetidas se generan una sola vez)
+    print("\n📦 Prueba por lotes:")
+    batch = generator.generate_sql_batch(test_queries + ["muéstrame todas las citas de mañana"])
+    for item in batch['results']:
+        print(f"  [{item['source']}] {item['request']}: {item.get('sql') or item.get('error')}")
+    
     # Prueba de validación
     print("\n🔒 Prueba de validación de seguridad:")
     try:
@@ -0,0 +1,352 @@
+"""
+FASE 3 - Analizador Léxico de T-SQL
+Tokeniza T-SQL en una sola pasada (comentarios anidados, literales N'...', [identificadores]
+y "identificadores") y a partir de los tokens clasifica el tipo de sentencia, las tablas
+referenciadas, los lotes con varias sentencias y la huella (fingerprint) sin literales
+"""
+
+import re
+from collections import namedtuple
+
+
+# kind: word, ident (entre [] o ""), string, number, variable, comment, semicolon, op, other
+Token = namedtuple('Token', ['kind', 'value', 'upper', 'pos', 'closed'])
+
+SQLAnalysis = namedtuple('SQLAnalysis', [
+    'statement_type',   # tipo de la primera sentencia (SELECT, INSERT, SELECT INTO, ...)
+    'statement_types',  # tipos de todas las sentencias del lote
+    'statements',       # número de sentencias no vacías
+    'tables',           # tablas referenciadas (FROM/JOIN/INTO/UPDATE/MERGE/USING), sin CTEs
+    'fingerprint',      # SQL normalizado con literales sustituidos por ?
+    'unterminated'      # True si hay literal, identificador o comentario sin cerrar
+])
+
+_MASTER = re.compile(r"""
+    (?P<ws>\s+)
+  | (?P<line_comment>--[^\n]*)
+  | (?P<block_comment>/\*)
+  | (?P<string>[Nn]?'(?:[^']|'')*'?)
+  | (?P<bracket>\[(?:[^\]]|\]\])*\]?)
+  | (?P<dquote>"(?:[^"]|"")*"?)
+  | (?P<number>0[xX][0-9a-fA-F]*|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<variable>@@?[\w$#@]+)
+  | (?P<word>[^\W\d][\w$#@]*|\#\#?[\w$#@]+)
+  | (?P<semicolon>;)
+  | (?P<op><>|!=|>=|<=|!<|!>|[-+*/%=<>(),.~&|^!?:])
+  | (?P<other>.)
+""", re.X | re.S)
+
+# Palabras que abren una sentencia nueva en un lote
+STATEMENT_KEYWORDS = {
+    'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'MERGE', 'WITH', 'DROP', 'ALTER', 'CREATE', 'TRUNCATE',
+    'EXEC', 'EXECUTE', 'DECLARE', 'SET', 'USE', 'GRANT', 'REVOKE', 'DENY', 'BACKUP', 'RESTORE',
+    'SHUTDOWN', 'DBCC', 'WAITFOR', 'BULK', 'KILL', 'RECONFIGURE', 'BEGIN', 'COMMIT', 'ROLLBACK',
+    'PRINT', 'RAISERROR', 'THROW', 'IF', 'WHILE', 'RETURN', 'GOTO', 'DEALLOCATE', 'SAVE',
+    'ENABLE', 'DISABLE', 'CHECKPOINT', 'READTEXT', 'WRITETEXT', 'UPDATETEXT'
+}
+_DML = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'MERGE'}
+_SET_OPERATORS = {'UNION', 'ALL', 'EXCEPT', 'INTERSECT'}
+_TABLE_INTRODUCERS = {'FROM', 'JOIN', 'INTO', 'UPDATE', 'MERGE', 'USING'}
+
+# Palabras reservadas que no pueden ser alias de tabla
+RESERVED_WORDS = {
+    'WHERE', 'ON', 'JOIN', 'INNER', 'LEFT', 'RIGHT', 'FULL', 'OUTER', 'CROSS', 'APPLY', 'GROUP',
+    'ORDER', 'HAVING', 'UNION', 'EXCEPT', 'INTERSECT', 'WITH', 'SET', 'OUTPUT', 'VALUES', 'SELECT',
+    'FROM', 'OPTION', 'FOR', 'WHEN', 'THEN', 'USING', 'OFFSET', 'FETCH', 'PIVOT', 'UNPIVOT',
+    'TABLESAMPLE', 'AND', 'OR', 'NOT', 'AS', 'INTO', 'DEFAULT', 'ALL', 'TOP', 'DISTINCT', 'BY'
+} | STATEMENT_KEYWORDS
+
+
+def _block_comment_end(sql, start):
+    """Fin de un comentario /* */ con anidamiento (T-SQL lo permite); -1 si no se cierra"""
+    depth = 0
+    i = start
+    length = len(sql)
+    while i < length:
+        opening = sql.find('/*', i)
+        closing = sql.find('*/', i)
+        if closing == -1:
+            return -1
+        if opening != -1 and opening < closing:
+            depth += 1
+            i = opening + 2
+        else:
+            depth -= 1
+            i = closing + 2
+            if depth == 0:
+                return i
+    return -1
+
+
+def tokenize(sql, keep_comments=False):
+    """Tokens de T-SQL en orden (sin espacios); lineal en el tamaño de la entrada"""
+    tokens = []
+    pos = 0
+    length = len(sql)
+    match = _MASTER.match
+    while pos < length:
+        m = match(sql, pos)
+        kind = m.lastgroup
+        value = m.group(kind)
+        end = m.end()
+        closed = True
+        
+        if kind == 'ws':
+            pos = end
+            continue
+        if kind == 'block_comment':
+            end = _block_comment_end(sql, pos)
+            closed = end != -1
+            end = end if closed else length
+            value = sql[pos:end]
+            kind = 'comment'
+        elif kind == 'line_comment':
+            kind = 'comment'
+        elif kind == 'string':
+            body = value[2:] if value[0] in 'Nn' else value[1:]
+            closed = body.endswith("'") and (len(body) - len(body.rstrip("'"))) % 2 == 1
+        elif kind == 'bracket':
+            closed = value.endswith(']') and len(value) > 1 and (len(value) - 1 - len(value[1:].rstrip(']'))) % 2 == 1
+            kind = 'ident'
+        elif kind == 'dquote':
+            closed = value.endswith('"') and len(value) > 1 and (len(value) - 1 - len(value[1:].rstrip('"'))) % 2 == 1
+            kind = 'ident'
+        
+        if kind != 'comment' or keep_comments:
+            upper = value.upper() if kind in ('word', 'variable') else value
+            tokens.append(Token(kind, value, upper, pos, closed))
+        elif not closed:
+            tokens.append(Token(kind, value, value, pos, closed))
+        pos = end
+    return tokens
+
+
+def ident_name(token):
+    """Nombre de un identificador sin delimitadores"""
+    if token.kind == 'ident':
+        quote = token.value[0]
+        inner = token.value[1:-1] if token.closed else token.value[1:]
+        return inner.replace(']]', ']') if quote == '[' else inner.replace('""', '"')
+    return token.value
+
+
+def split_statements(tokens):
+    """Separa los tokens en sentencias: por ';' o por una palabra inicial de sentencia a nivel 0
+    
+    Un SELECT no abre sentencia tras UNION/ALL/EXCEPT/INTERSECT, como parte de
+    INSERT ... SELECT ni como sentencia principal de un WITH; los DML dentro de
+    MERGE (WHEN ... THEN UPDATE/INSERT/DELETE) y los cuerpos de CREATE/ALTER
+    tampoco. WITH solo abre sentencia al principio o tras ';'.
+    """
+    statements = []
+    current = []
+    depth = 0
+    kind = None        # tipo de la sentencia en curso
+    main_seen = False  # en WITH/INSERT, si ya apareció la sentencia o fuente principal
+    previous = None
+    
+    def close():
+        nonlocal current, kind, main_seen
+        if current:
+            statements.append(current)
+        current = []
+        kind = None
+        main_seen = False
+    
+    for token in tokens:
+        if token.kind == 'comment':
+            continue
+        if token.kind == 'semicolon':
+            if depth == 0:
+                close()
+                previous = None
+                continue
+        elif token.kind == 'op' and token.value == '(':
+            depth += 1
+        elif token.kind == 'op' and token.value == ')':
+            depth = max(0, depth - 1)
+        elif (token.kind == 'word' and depth == 0 and token.upper in STATEMENT_KEYWORDS and kind is not None
+                and not (previous is not None and previous.value == '.')):
+            # Tras '.' es un nombre calificado (e.exec, t.set), no una palabra clave
+            word = token.upper
+            prev = previous.upper if previous is not None and previous.kind == 'word' else None
+            if word == 'WITH':
+                # Sugerencias de tabla y opciones: WITH (NOLOCK), WITH CHECK OPTION...
+                starts = False
+            elif kind == 'WITH' and not main_seen and word in _DML:
+                starts = False
+                main_seen = True
+            elif kind == 'INSERT' and not main_seen and word in ('SELECT', 'EXEC', 'EXECUTE', 'WITH'):
+                starts = False
+                main_seen = True
+            elif word == 'SELECT' and prev in _SET_OPERATORS:
+                starts = False
+            elif word in ('UPDATE', 'INSERT', 'DELETE') and (kind == 'MERGE' or prev in ('THEN', 'FOR', 'ON')):
+                starts = False
+            elif word == 'SET' and (kind in ('UPDATE', 'MERGE') or prev in ('UPDATE', 'THEN')):
+                starts = False
+            elif kind in ('CREATE', 'ALTER'):
+                # Cuerpo de vista/procedimiento/tabla: parte de la misma sentencia
+                starts = False
+            else:
+                starts = True
+            
+            if starts:
+                close()
+        
+        if kind is None and token.kind != 'semicolon':
+            kind = token.upper if token.kind == 'word' else token.kind.upper()
+        current.append(token)
+        previous = token
+    
+    close()
+    return statements
+
+
+def statement_type(statement):
+    """Tipo de una sentencia; WITH se resuelve a su sentencia principal y SELECT ... INTO se distingue"""
+    if not statement:
+        return None
+    first = statement[0]
+    kind = first.upper if first.kind == 'word' else first.kind.upper()
+    
+    depth = 0
+    main = kind
+    for index, token in enumerate(statement):
+        if token.kind == 'op' and token.value == '(':
+            depth += 1
+        elif token.kind == 'op' and token.value == ')':
+            depth -= 1
+        elif depth == 0 and token.kind == 'word':
+            if kind == 'WITH' and main == 'WITH' and token.upper in _DML and index > 0:
+                main = token.upper
+            elif main == 'SELECT' and token.upper == 'INTO':
+                return 'SELECT INTO'
+    return main
+
+
+def _read_name(tokens, index):
+    """Lee un nombre [servidor.][bd.][esquema.]objeto desde index; devuelve (nombre, siguiente)"""
+    parts = []
+    while index < len(tokens) and tokens[index].kind in ('word', 'ident'):
+        parts.append(ident_name(tokens[index]))
+        if index + 1 < len(tokens) and tokens[index + 1].value == '.':
+            index += 2
+            while index < len(tokens) and tokens[index].value == '.':
+                # Esquema omitido: bd..tabla
+                parts.append('')
+                index += 1
+            continue
+        index += 1
+        break
+    return '.'.join(parts), index
+
+
+def referenced_tables(tokens):
+    """Tablas referenciadas tras FROM, JOIN, INTO, UPDATE, MERGE y USING (excluye CTEs)"""
+    tokens = [t for t in tokens if t.kind != 'comment']
+    ctes = set()
+    for i in range(len(tokens) - 2):
+        if (tokens[i].kind in ('word', 'ident') and tokens[i + 1].upper == 'AS'
+                and tokens[i + 2].value == '(' and (i == 0 or tokens[i - 1].value in (',',) or tokens[i - 1].upper == 'WITH')):
+            ctes.add(ident_name(tokens[i]).upper())
+    
+    tables = []
+    seen = set()
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token.kind == 'word' and token.upper in _TABLE_INTRODUCERS:
+            introducer = token.upper
+            i += 1
+            while i < len(tokens):
+                if tokens[i].kind not in ('word', 'ident') or (tokens[i].kind == 'word' and tokens[i].upper in RESERVED_WORDS):
+                    break
+                name, i = _read_name(tokens, i)
+                # Funciones de tabla: nombre(...)
+                if i < len(tokens) and tokens[i].value == '(':
+                    break
+                base = name.split('.')[-1]
+                if name and base.upper() not in ctes and name.upper() not in seen:
+                    seen.add(name.upper())
+                    tables.append(name)
+                # Lista separada por comas solo en FROM: FROM a x, b y
+                if introducer != 'FROM':
+                    break
+                if i < len(tokens) and tokens[i].upper == 'AS':
+                    i += 1
+                if i < len(tokens) and tokens[i].kind in ('word', 'ident') and tokens[i].upper not in RESERVED_WORDS:
+                    i += 1
+                if i < len(tokens) and tokens[i].value == ',':
+                    i += 1
+                    continue
+                break
+            continue
+        i += 1
+    return tables
+
+
+_REPEATED_PLACEHOLDERS = re.compile(r'\?(?: , \?)+')
+
+
+def fingerprint(tokens):
+    """Huella de la consulta: literales -> ?, sin comentarios, mayúsculas y espacios normalizados"""
+    parts = []
+    for token in tokens:
+        if token.kind == 'comment':
+            continue
+        if token.kind in ('string', 'number'):
+            parts.append('?')
+        elif token.kind == 'ident':
+            parts.append(f"[{ident_name(token).upper()}]")
+        elif token.kind == 'word':
+            parts.append(token.upper)
+        else:
+            parts.append(token.value)
+    # IN (1, 2, 3) e IN (4, 5) comparten huella
+    return _REPEATED_PLACEHOLDERS.sub('?', ' '.join(parts))
+
+
+def analyze(sql, tokens=None):
+    """Análisis completo de un texto SQL (o de sus tokens ya calculados)"""
+    if tokens is None:
+        tokens = tokenize(sql)
+    statements = split_statements(tokens)
+    types = tuple(statement_type(s) for s in statements)
+    return SQLAnalysis(
+        statement_type=types[0] if types else None,
+        statement_types=types,
+        statements=len(statements),
+        tables=tuple(referenced_tables(tokens)),
+        fingerprint=fingerprint(tokens),
+        unterminated=any(not t.closed for t in tokens)
+    )
+
+
+def sql_fingerprint(sql):
+    """Huella de un texto SQL (atajo de tokenize + fingerprint)"""
+    return fingerprint(tokenize(sql))
+
+
+# Prueba del analizador
+if __name__ == "__main__":
+    print("=" * 70)
+    print("PRUEBA DEL ANALIZADOR LÉXICO DE T-SQL")
+    print("=" * 70)
+    
+    samples = [
+        "SELECT IdCita, Fecha FROM DCitas WITH (NOLOCK) WHERE IdUsu = 3 AND Texto = 'EXEC; DROP'",
+        "WITH hoy AS (SELECT * FROM DCitas WHERE Fecha = 46000) SELECT h.*, p.Nombre FROM hoy h JOIN dbo.Pacientes p ON p.IdPac = h.IdPac",
+        "SELECT 1 /* comentario /* anidado */ */ UNION ALL SELECT 2",
+        "SELECT * FROM Pacientes SELECT * FROM DCitas",
+        "SELECT * FROM Pacientes; DROP TABLE Pacientes",
+        "SELECT * INTO #copia FROM Pacientes",
+        "SELECT [Exec], \"Drop\" FROM [Mi Tabla] -- DELETE FROM x",
+        "SELECT e.exec, e.set FROM Ejecuciones e",
+        "SELECT * FROM DCitas WHERE IdSitC IN (1, 5, 7) AND Texto LIKE N'%revisión%'",
+    ]
+    for sql in samples:
+        result = analyze(sql)
+        print(f"\n📝 {sql}")
+        print(f"   tipos={result.statement_types} tablas={result.tables}")
+        print(f"   huella={result.fingerprint}")
@@ -0,0 +1,519 @@
+"""
+FASE 3 - Límite de Filas y Paginación
+Post-procesa los SELECT generados: añade un límite de filas por defecto (TOP u
+OFFSET-FETCH según haya ORDER BY) y pagina resultados grandes, por clave (keyset)
+cuando la consulta se ordena por una clave única de su tabla según el catálogo del
+esquema, o por desplazamiento en otro caso. Cada página devuelve un token de
+continuación opaco
+"""
+
+import base64
+import hashlib
+import json
+import os
+from datetime import date, datetime
+from decimal import Decimal
+
+from sql_lexer import analyze, ident_name, tokenize
+
+
+# Palabras que cierran la cláusula WHERE / la consulta principal a nivel 0
+_AFTER_WHERE = {'GROUP', 'HAVING', 'ORDER', 'OPTION', 'FOR', 'UNION', 'EXCEPT', 'INTERSECT', 'WINDOW'}
+_QUERY_TAIL = {'OPTION', 'FOR'}
+_SET_OPERATORS = {'UNION', 'EXCEPT', 'INTERSECT'}
+_AGGREGATES = {'COUNT', 'COUNT_BIG', 'SUM', 'AVG', 'MIN', 'MAX', 'STDEV', 'STDEVP', 'VAR', 'VARP',
+               'STRING_AGG', 'CHECKSUM_AGG', 'GROUPING', 'APPROX_COUNT_DISTINCT'}
+
+
+class KeyCatalog:
+    """Columnas clave (PK y UNIQUE de una sola columna) por tabla"""
+    
+    def __init__(self, keys=None):
+        # {TABLA: {COLUMNA: Columna}}: se compara sin mayúsculas y se conserva el nombre original
+        self._keys = {table.upper(): {c.upper(): c for c in columns} for table, columns in (keys or {}).items()}
+    
+    @classmethod
+    def from_schema_file(cls, schema_file='database/schema/schema_extracted.json'):
+        """Catálogo desde el esquema extraído por SchemaExtractor (vacío si no existe)"""
+        if not os.path.exists(schema_file):
+            return cls()
+        with open(schema_file, 'r', encoding='utf-8') as f:
+            schema = json.load(f)
+        keys = {}
+        for table in schema.get('tables', []):
+            columns = set()
+            if len(table.get('primary_keys') or []) == 1:
+                columns.update(table['primary_keys'])
+            # unique_constraints es una lista plana de columnas; solo vale si hay una
+            if len(table.get('unique_constraints') or []) == 1:
+                columns.update(table['unique_constraints'])
+            if columns:
+                keys[table['name']] = columns
+        return cls(keys)
+    
+    @classmethod
+    def from_db(cls, db):
+        """Catálogo desde INFORMATION_SCHEMA (PK y UNIQUE de una columna)"""
+        rows = db.execute_query("""
+            SELECT k.TABLE_NAME, MIN(k.COLUMN_NAME) AS COLUMN_NAME
+            FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS c
+            JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE k
+              ON k.CONSTRAINT_NAME = c.CONSTRAINT_NAME AND k.TABLE_NAME = c.TABLE_NAME
+            WHERE c.CONSTRAINT_TYPE IN ('PRIMARY KEY', 'UNIQUE')
+            GROUP BY k.TABLE_NAME, k.CONSTRAINT_NAME
+            HAVING COUNT(*) = 1
+        """)
+        keys = {}
+        for row in rows:
+            keys.setdefault(row['TABLE_NAME'], set()).add(row['COLUMN_NAME'])
+        return cls(keys)
+    
+    def is_key(self, table, column):
+        return column.upper() in self._keys.get(table.split('.')[-1].upper(), ())
+    
+    def key_for(self, table):
+        """Una columna clave de la tabla (la primera en orden alfabético) o None"""
+        columns = self._keys.get(table.split('.')[-1].upper())
+        return columns[min(columns)] if columns else None
+
+
+def encode_token(state):
+    """Token de continuación opaco (JSON en base64 url-safe)"""
+    raw = json.dumps(state, separators=(',', ':'), default=_encode_value)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_token(token):
+    """Estado de un token de continuación; ValueError si no es válido"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode('ascii')), object_hook=_decode_value)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"❌ Token de continuación no válido: {e}")
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'$dt': value.isoformat()}
+    if isinstance(value, date):
+        return {'$d': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'$dec': str(value)}
+    raise TypeError(f"Tipo no serializable en token: {type(value).__name__}")
+
+
+def _decode_value(obj):
+    if '$dt' in obj:
+        return datetime.fromisoformat(obj['$dt'])
+    if '$d' in obj:
+        return date.fromisoformat(obj['$d'])
+    if '$dec' in obj:
+        return Decimal(obj['$dec'])
+    return obj
+
+
+def sql_literal(value):
+    """Literal T-SQL para un valor de clave; None si el tipo no se puede usar en keyset"""
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, Decimal)):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime):
+        return f"'{value.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]}'"
+    if isinstance(value, date):
+        return f"'{value.strftime('%Y%m%d')}'"
+    if isinstance(value, str):
+        return "N'" + value.replace("'", "''") + "'"
+    return None
+
+
+class _Query:
+    """Estructura de nivel 0 de un SELECT: posiciones de SELECT principal, TOP, WHERE, ORDER BY..."""
+    
+    def __init__(self, sql):
+        sql = sql.strip()
+        tokens = tokenize(sql)
+        if tokens and tokens[-1].kind == 'semicolon':
+            sql = sql[:tokens[-1].pos].rstrip()
+            tokens = tokens[:-1]
+        self.sql = sql
+        self.tokens = tokens
+        self.analysis = analyze(sql, tokens)
+        self.valid = self.analysis.statements == 1 and self.analysis.statement_type == 'SELECT'
+        
+        self.main = None
+        self.select_end = None
+        self.top = None
+        self.where = None
+        self.where_end = len(sql)
+        self.order = None
+        self.order_items = []
+        self.tail = len(sql)
+        self.offset = False
+        self.fetch = None      # posición de FETCH (de OFFSET ... FETCH NEXT n ROWS ONLY)
+        self.compound = False
+        self.grouped = False
+        self.distinct = False
+        self.scalar = False    # agregados en la lista del SELECT sin GROUP BY: una sola fila
+        self.cte = False       # WITH ...: las tablas del catálogo no son las del resultado
+        self.derived = False   # FROM/JOIN/APPLY (subconsulta)
+        self.aliases = set()
+        if self.valid:
+            self._scan()
+    
+    def _scan(self):
+        tokens = self.tokens
+        depth = 0
+        for index, token in enumerate(tokens):
+            if token.kind == 'op' and token.value == '(':
+                depth += 1
+                continue
+            if token.kind == 'op' and token.value == ')':
+                depth -= 1
+                continue
+            if depth != 0:
+                continue
+            word = token.upper if token.kind == 'word' else None
+            
+            if self.main is None:
+                if word == 'SELECT':
+                    self.main = index
+                    following = index + 1
+                    if following < len(tokens) and tokens[following].upper in ('ALL', 'DISTINCT'):
+                        self.distinct = tokens[following].upper == 'DISTINCT'
+                        following += 1
+                    self.select_end = tokens[following - 1].pos + len(tokens[following - 1].value)
+                    if following < len(tokens) and tokens[following].upper == 'TOP':
+                        self.top = following
+                continue
+            
+            following = tokens[index + 1] if index + 1 < len(tokens) else None
+            if word in ('FROM', 'JOIN', 'APPLY') and following is not None and following.value == '(':
+                self.derived = True
+            if word == 'AS' and following is not None and following.kind in ('word', 'ident'):
+                self.aliases.add(ident_name(tokens[index + 1]).upper())
+            if word in _SET_OPERATORS:
+                self.compound = True
+            elif word == 'GROUP':
+                self.grouped = True
+            elif word == 'WHERE' and self.where is None and not self.compound:
+                self.where = index
+            elif word == 'OFFSET':
+                self.offset = True
+            elif word == 'FETCH' and self.offset:
+                self.fetch = index
+            elif word == 'ORDER' and index + 1 < len(tokens) and tokens[index + 1].upper == 'BY':
+                self.order = index
+                self.order_items = []
+            elif word in _QUERY_TAIL and self.tail == len(self.sql):
+                self.tail = token.pos
+            
+            if word in _AFTER_WHERE and self.where is not None and self.where_end == len(self.sql):
+                self.where_end = token.pos
+        
+        if self.order is not None:
+            self.order_items = self._parse_order_items()
+        if self.main is not None:
+            self.cte = self.tokens[0].upper == 'WITH'
+            self.scalar = not self.grouped and not self.compound and self._has_aggregate()
+    
+    def _has_aggregate(self):
+        """True si la lista del SELECT principal tiene un agregado que no es de ventana (OVER)"""
+        tokens = self.tokens
+        depth = 0
+        index = self.main + 1
+        while index < len(tokens):
+            token = tokens[index]
+            if token.kind == 'op' and token.value == '(':
+                depth += 1
+            elif token.kind == 'op' and token.value == ')':
+                depth -= 1
+            elif depth == 0 and token.kind == 'word' and token.upper == 'FROM':
+                break
+            elif (token.kind == 'word' and token.upper in _AGGREGATES
+                    and index + 1 < len(tokens) and tokens[index + 1].value == '('):
+                # Se salta la llamada y se mira si le sigue OVER
+                close = index + 1
+                level = 0
+                while close < len(tokens):
+                    if tokens[close].value == '(':
+                        level += 1
+                    elif tokens[close].value == ')':
+                        level -= 1
+                        if level == 0:
+                            break
+                    close += 1
+                if close + 1 >= len(tokens) or tokens[close + 1].upper != 'OVER':
+                    return True
+                index = close
+            index += 1
+        return False
+    
+    def _parse_order_items(self):
+        """[(expresión, nombre de columna o None, descendente)] de la ORDER BY final"""
+        items = []
+        current = []
+        depth = 0
+        for token in self.tokens[self.order + 2:]:
+            if token.pos >= self.tail:
+                break
+            if token.kind == 'op' and token.value == '(':
+                depth += 1
+            elif token.kind == 'op' and token.value == ')':
+                depth -= 1
+            if depth == 0 and token.kind == 'word' and token.upper in ('OFFSET', 'OPTION', 'FOR'):
+                break
+            if depth == 0 and token.value == ',':
+                items.append(current)
+                current = []
+                continue
+            current.append(token)
+        if current:
+            items.append(current)
+        
+        parsed = []
+        for item in items:
+            descending = bool(item) and item[-1].kind == 'word' and item[-1].upper == 'DESC'
+            if item and item[-1].kind == 'word' and item[-1].upper in ('ASC', 'DESC'):
+                item = item[:-1]
+            # Columna simple: nombre o alias.nombre
+            column = None
+            if len(item) == 1 and item[0].kind in ('word', 'ident'):
+                column = ident_name(item[0])
+            elif len(item) == 3 and item[1].value == '.' and item[2].kind in ('word', 'ident'):
+                column = ident_name(item[2])
+            start = item[0].pos if item else 0
+            end = item[-1].pos + len(item[-1].value) if item else 0
+            parsed.append((self.sql[start:end], column, descending))
+        return parsed
+    
+    def fetch_token(self):
+        """Token numérico de FETCH NEXT n ROWS; None si no hay FETCH o es una expresión"""
+        if self.fetch is None:
+            return None
+        tokens = [t for t in self.tokens[self.fetch + 2:self.fetch + 5] if t.value not in ('(', ')')]
+        return tokens[0] if tokens and tokens[0].kind == 'number' else None
+    
+    def top_value(self):
+        """Valor numérico de TOP n / TOP (n); None si es TOP PERCENT, WITH TIES o una expresión"""
+        if self.top is None:
+            return None
+        tokens = self.tokens[self.top + 1:self.top + 5]
+        values = [t for t in tokens[:3] if t.value not in ('(', ')')]
+        if not values or values[0].kind != 'number':
+            return None
+        following = tokens[3] if tokens and tokens[0].value == '(' and len(tokens) > 3 else (
+            tokens[1] if len(tokens) > 1 and tokens[0].value != '(' else None)
+        if following is not None and following.upper in ('PERCENT', 'WITH'):
+            return None
+        try:
+            return int(values[0].value)
+        except ValueError:
+            return None
+
+
+def _wrap(query, select="SELECT *"):
+    """El SELECT principal como tabla derivada: '<select> FROM (<consulta>) AS _pagina'
+
+    Para UNION/EXCEPT/INTERSECT y DISTINCT, donde no se puede añadir TOP o
+    ORDER BY (SELECT NULL) directamente. Se conservan el WITH inicial y el
+    OPTION/FOR final.
+    """
+    main_start = query.tokens[query.main].pos
+    body = query.sql[main_start:query.tail].rstrip()
+    return (query.sql[:main_start] + f"{select} FROM ({body}) AS _pagina"
+            + (' ' + query.sql[query.tail:] if query.tail < len(query.sql) else ''))
+
+
+def _insert_before_tail(query, clause):
+    """Añade una cláusula al final del SELECT, antes de OPTION (...) / FOR XML|JSON"""
+    head, tail = query.sql[:query.tail].rstrip(), query.sql[query.tail:]
+    return f"{head} {clause} {tail}".rstrip()
+
+
+class SQLPaginator:
+    """Límite de filas por defecto y paginación con token de continuación"""
+    
+    def __init__(self, key_catalog=None, default_limit=None):
+        if default_limit is None:
+            default_limit = int(os.getenv('IA_SQL_ROW_LIMIT', '500'))
+        self.default_limit = default_limit
+        self.key_catalog = key_catalog or KeyCatalog()
+    
+    def limit(self, sql, limit=None):
+        """SELECT con como mucho 'limit' filas (TOP, OFFSET-FETCH o SELECT externo)"""
+        limit = self.default_limit if limit is None else limit
+        query = _Query(sql)
+        if not limit or not query.valid or query.main is None:
+            return sql
+        
+        if query.offset:
+            # OFFSET propio: se añade FETCH o se reduce el que supere el límite
+            if query.fetch is None:
+                return _insert_before_tail(query, f"FETCH NEXT {limit} ROWS ONLY")
+            token = query.fetch_token()
+            if token is None or int(float(token.value)) <= limit:
+                return sql
+            return query.sql[:token.pos] + str(limit) + query.sql[token.pos + len(token.value):]
+        
+        if query.top is not None:
+            # Se respeta un TOP explícito si no supera el límite
+            value = query.top_value()
+            if value is None or value <= limit:
+                return sql
+            token = next(t for t in query.tokens[query.top + 1:] if t.kind == 'number')
+            return query.sql[:token.pos] + str(limit) + query.sql[token.pos + len(token.value):]
+        
+        if query.order is not None:
+            return _insert_before_tail(query, f"OFFSET 0 ROWS FETCH NEXT {limit} ROWS ONLY")
+        
+        if query.compound:
+            return _wrap(query, f"SELECT TOP ({limit}) *")
+        
+        return query.sql[:query.select_end] + f" TOP ({limit})" + query.sql[query.select_end:]
+    
+    def _keyset_column(self, query):
+        """(columna, expresión, descendente) si se puede paginar por clave; None si no"""
+        # Con CTE o tabla derivada la tabla del catálogo no es la del resultado (sus columnas pueden no existir)
+        if (query.compound or query.grouped or query.distinct or query.scalar or query.cte or query.derived
+                or len(query.analysis.tables) != 1):
+            return None
+        table = query.analysis.tables[0]
+        if query.order is None:
+            column = self.key_catalog.key_for(table)
+            return (column, column, False) if column else None
+        if len(query.order_items) != 1:
+            return None
+        expression, column, descending = query.order_items[0]
+        if column is None or column.upper() in query.aliases or not self.key_catalog.is_key(table, column):
+            return None
+        return column, expression, descending
+    
+    def page(self, sql, page_size, token=None):
+        """SQL de una página (pide page_size + 1 filas para saber si hay más) y estado de paginación"""
+        query = _Query(sql)
+        query_hash = hashlib.sha1(query.sql.encode('utf-8')).hexdigest()[:12]
+        state = {'v': 1, 'q': query_hash, 'mode': None, 'offset': 0, 'after': None}
+        if token:
+            previous = decode_token(token)
+            if previous.get('q') != query_hash:
+                raise ValueError("❌ El token de continuación corresponde a otra consulta")
+            state.update(offset=previous.get('offset', 0), after=previous.get('after'))
+        
+        if not query.valid or query.main is None or query.top is not None or query.offset or query.scalar:
+            # Consulta no paginable (TOP u OFFSET propios, agregado sin GROUP BY): una sola
+            # página, pero nunca de más de page_size filas (un agregado devuelve una fila)
+            state['mode'] = 'single'
+            return (sql if query.scalar else self.limit(sql, page_size)), state
+        
+        fetch = page_size + 1
+        keyset = self._keyset_column(query)
+        if keyset is not None and query.order is None:
+            # Sin ORDER BY se ordena por la clave: páginas deterministas en ambos modos
+            query = _Query(_insert_before_tail(query, f"ORDER BY {keyset[1]}"))
+        
+        # Una página siguiente sin valor de clave (p. ej. la clave no está en el resultado) sigue por desplazamiento
+        if keyset is not None and not (token and state['after'] is None):
+            column, expression, descending = keyset
+            state.update(mode='keyset', column=column)
+            page_sql = query.sql
+            if state['after'] is not None:
+                predicate = f"{expression} {'<' if descending else '>'} {sql_literal(state['after'])}"
+                page_sql = self._add_predicate(query, predicate)
+            return self.limit(page_sql, fetch), state
+        
+        # Paginación por desplazamiento (ORDER BY (SELECT NULL) si no hay orden: no determinista)
+        state['mode'] = 'offset'
+        if query.order is None:
+            if query.compound or query.distinct:
+                # UNION/DISTINCT no admiten ORDER BY (SELECT NULL) (Msg 104/145): se ordena fuera
+                query = _Query(_wrap(query))
+            query = _Query(_insert_before_tail(query, "ORDER BY (SELECT NULL)"))
+        return _insert_before_tail(query, f"OFFSET {state['offset']} ROWS FETCH NEXT {fetch} ROWS ONLY"), state
+    
+    @staticmethod
+    def _add_predicate(query, predicate):
+        """Añade 'predicate' con AND al WHERE del SELECT principal (o crea el WHERE)"""
+        sql = query.sql
+        if query.where is not None:
+            where = query.tokens[query.where]
+            start = where.pos + len(where.value)
+            end = query.where_end
+            return f"{sql[:start]} ({sql[start:end].strip()}) AND {predicate} {sql[end:]}".rstrip()
+        
+        # Sin WHERE: antes de GROUP/ORDER/OPTION/FOR
+        insert_at = len(sql)
+        depth = 0
+        for token in query.tokens[query.main + 1:]:
+            if token.value == '(':
+                depth += 1
+            elif token.value == ')':
+                depth -= 1
+            elif depth == 0 and token.kind == 'word' and token.upper in _AFTER_WHERE:
+                insert_at = token.pos
+                break
+        return f"{sql[:insert_at].rstrip()} WHERE {predicate} {sql[insert_at:]}".rstrip()
+    
+    def finish_page(self, state, rows, page_size):
+        """Recorta la fila extra y devuelve (filas, token siguiente o None)"""
+        if state['mode'] == 'single' or len(rows) <= page_size:
+            return rows, None
+        rows = rows[:page_size]
+        following = {'v': 1, 'q': state['q'], 'offset': state['offset'] + len(rows), 'after': None}
+        if state['mode'] == 'keyset':
+            last = rows[-1]
+            value = last.get(state['column'])
+            if value is None:
+                # La columna clave no está en el resultado: se sigue por desplazamiento
+                matches = [v for k, v in last.items() if k.upper() == state['column'].upper()]
+                value = matches[0] if matches else None
+            following['after'] = value if sql_literal(value) is not None else None
+        return rows, encode_token(following)
+
+
+# Prueba de límites y paginación
+if __name__ == "__main__":
+    print("=" * 70)
+    print("PRUEBA DE LÍMITES Y PAGINACIÓN")
+    print("=" * 70)
+    
+    paginator = SQLPaginator(KeyCatalog({'DCitas': ['IdCita'], 'Pacientes': ['IdPac']}), default_limit=500)
+    samples = [
+        "SELECT * FROM DCitas",
+        "SELECT DISTINCT IdUsu FROM DCitas;",
+        "SELECT TOP 10 * FROM Pacientes",
+        "SELECT TOP 5000 * FROM Pacientes",
+        "SELECT IdCita, Fecha FROM DCitas WHERE IdUsu = 3 ORDER BY Fecha DESC OPTION (RECOMPILE)",
+        "SELECT IdPac FROM Pacientes UNION SELECT IdPac FROM DCitas",
+        "WITH hoy AS (SELECT * FROM DCitas WHERE Fecha = 46314) SELECT * FROM hoy",
+    ]
+    for sql in samples:
+        print(f"\n📝 {sql}\n➡️  {paginator.limit(sql)}")
+    
+    print("\n📄 Paginación por clave:")
+    sql = "SELECT IdCita, Fecha FROM DCitas WHERE IdUsu = 3 OR IdUsu = 4"
+    page_sql, state = paginator.page(sql, 2)
+    print(f"   {page_sql}")
+    rows, token = paginator.finish_page(state, [{'IdCita': 10}, {'IdCita': 11}, {'IdCita': 12}], 2)
+    page_sql, state = paginator.page(sql, 2, token)
+    print(f"   {page_sql}")
+    print(f"   token={token}")
+    
+    print("\n📄 Sin clave (agregados, CTE, tabla derivada, TOP/OFFSET propios, UNION, DISTINCT):")
+    samples = [
+        "SELECT TOP 100000 * FROM DCitas",
+        "SELECT * FROM DCitas ORDER BY Fecha OFFSET 0 ROWS",
+        "SELECT * FROM DCitas ORDER BY Fecha OFFSET 10 ROWS FETCH NEXT 5000 ROWS ONLY",
+        "SELECT IdPac FROM Pacientes UNION SELECT IdPac FROM DCitas",
+        "SELECT DISTINCT IdUsu FROM DCitas",
+        "SELECT COUNT(*) AS total FROM DCitas WHERE Fecha = 46314",
+        "SELECT MAX(Fecha) AS ultima FROM DCitas",
+        "SELECT IdCita, COUNT(*) OVER () AS total FROM DCitas",
+        "WITH c AS (SELECT Fecha, COUNT(*) n FROM DCitas GROUP BY Fecha) SELECT * FROM c",
+        "SELECT * FROM (SELECT Fecha, COUNT(*) n FROM DCitas GROUP BY Fecha) AS d",
+    ]
+    for sql in samples:
+        page_sql, state = paginator.page(sql, 50)
+        print(f"   [{state['mode']}] {page_sql}")
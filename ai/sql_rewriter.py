@@ -0,0 +1,308 @@
+"""
+FASE 3 - Reescritura de Predicados de Fecha/Hora
+Las columnas de GELITE con fórmula de conversión (DCitas.Fecha en días desde
+1900-01-01, DCitas.Hora en segundos desde medianoche) llegan del LLM envueltas en
+CONVERT/DATEADD también en el WHERE, lo que impide usar índices. Este módulo
+reescribe esos predicados a comparaciones sobre el entero original y deja la
+conversión solo en la lista del SELECT
+"""
+
+import re
+from datetime import date, datetime, timedelta
+
+from sql_lexer import tokenize
+
+
+DAY_ZERO = date(1900, 1, 1)
+
+# Tipos de MAPEO_COLUMNAS (generate_column_mappings.deduce_column_type)
+DAY_SERIAL_TYPES = {'FECHA_DIAS'}
+SECOND_OF_DAY_TYPES = {'HORA_SEGUNDOS'}
+
+DEFAULT_MAPPINGS = [
+    {'tabla': 'DCitas', 'columna_bd': 'Fecha', 'tipo_dato': 'FECHA_DIAS',
+     'formula_conversion': "CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23)"},
+    {'tabla': 'DCitas', 'columna_bd': 'Hora', 'tipo_dato': 'HORA_SEGUNDOS',
+     'formula_conversion': "CONVERT(VARCHAR(5), DATEADD(SECOND, Hora, 0), 108)"},
+]
+
+_COLUMN = r"(?P<col>(?:(?:\[[^\]]+\]|\w+)\s*\.\s*)?(?:\[(?P<qname>[^\]]+)\]|(?P<name>\w+)))"
+
+_DAY_EXPR = r"DATEADD\s*\(\s*(?:DAY|DD|D)\s*,\s*" + _COLUMN + r"\s*-\s*2\s*,\s*'1900-01-01'\s*\)"
+_SECOND_EXPR = r"DATEADD\s*\(\s*(?:SECOND|SS|S)\s*,\s*" + _COLUMN + r"\s*,\s*0\s*\)"
+
+
+def _wrapped(inner, varchar_len, style):
+    """Variantes de una expresión: CONVERT(VARCHAR(n), x, estilo), CONVERT(tipo, x), CAST(x AS tipo) o x"""
+    return (
+        r"(?:CONVERT\s*\(\s*N?(?:VAR)?CHAR\s*\(\s*(?P<len>" + varchar_len + r")\s*\)\s*,\s*" + inner
+        + r"\s*,\s*" + style + r"\s*\)"
+        + r"|CONVERT\s*\(\s*(?P<ctype>DATE|TIME|DATETIME)\s*,\s*" + inner.replace('?P<', '?P<c_') + r"\s*\)"
+        + r"|CAST\s*\(\s*" + inner.replace('?P<', '?P<k_') + r"\s+AS\s+(?P<ktype>DATE|TIME|DATETIME)\s*\)"
+        + r"|" + inner.replace('?P<', '?P<b_') + r")"
+    )
+
+
+_DATE_LHS = re.compile(_wrapped(_DAY_EXPR, r"10", r"23"), re.I)
+_TIME_LHS = re.compile(_wrapped(_SECOND_EXPR, r"5|8", r"108"), re.I)
+
+_OPERATOR = r"(?P<op><>|!=|>=|<=|=|<|>)"
+_LITERAL = r"N?'(?P<lit>[^']*)'"
+
+# Hoy (o hoy ± n días) como fecha, en las formas habituales
+_TODAY = (r"(?:DATEADD\s*\(\s*(?:DAY|DD|D)\s*,\s*(?P<shift>[-+]?\s*\d+)\s*,\s*(?:GETDATE|SYSDATETIME)\s*\(\s*\)\s*\)"
+          r"|(?:GETDATE|SYSDATETIME)\s*\(\s*\))")
+_TODAY_DATE = (
+    r"(?:CONVERT\s*\(\s*N?(?:VAR)?CHAR\s*\(\s*10\s*\)\s*,\s*" + _TODAY + r"\s*,\s*23\s*\)"
+    r"|CONVERT\s*\(\s*DATE\s*,\s*" + _TODAY.replace('?P<shift>', '?P<c_shift>') + r"\s*\)"
+    r"|CAST\s*\(\s*" + _TODAY.replace('?P<shift>', '?P<k_shift>') + r"\s+AS\s+DATE\s*\))")
+# ... o DATEADD(DAY, n, <hoy como fecha>), p. ej. el límite superior de "los próximos 7 días"
+_TODAY_AS_DATE = re.compile(
+    r"(?:DATEADD\s*\(\s*(?:DAY|DD|D)\s*,\s*(?P<o_shift>[-+]?\s*\d+)\s*,\s*"
+    + _TODAY_DATE.replace('?P<', '?P<d_') + r"\s*\)|" + _TODAY_DATE + ")", re.I)
+
+_FLIP = {'<': '>', '>': '<', '<=': '>=', '>=': '<=', '=': '=', '<>': '<>', '!=': '!='}
+
+_CLAUSES = {'SELECT', 'FROM', 'WHERE', 'ON', 'HAVING', 'GROUP', 'ORDER', 'SET', 'VALUES', 'OUTPUT', 'JOIN'}
+_SARGABLE_CLAUSES = {'WHERE', 'ON'}
+
+
+def day_serial(day):
+    """Entero de DCitas.Fecha para una fecha (días desde 1900-01-01 + 2)"""
+    return (day - DAY_ZERO).days + 2
+
+
+def _parse_date(text):
+    """Fecha de un literal 'aaaa-mm-dd' o 'aaaammdd'; None si tiene hora u otro formato"""
+    for fmt in ('%Y-%m-%d', '%Y%m%d'):
+        try:
+            return datetime.strptime(text.strip(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_time(text, exact_format=None):
+    """Segundos desde medianoche de 'HH:MM' o 'HH:MM:SS' (y su formato); None si no es una hora"""
+    match = re.fullmatch(r'(\d{1,2}):(\d{2})(?::(\d{2}))?', text.strip())
+    if not match:
+        return None
+    hours, minutes, seconds = int(match.group(1)), int(match.group(2)), int(match.group(3) or 0)
+    if hours > 23 or minutes > 59 or seconds > 59:
+        return None
+    if exact_format == 'HH:MM' and not re.fullmatch(r'\d{2}:\d{2}', text.strip()):
+        return None
+    if exact_format == 'HH:MM:SS' and not re.fullmatch(r'\d{2}:\d{2}:\d{2}', text.strip()):
+        return None
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def _group(match, name):
+    """Primer grupo con valor entre las variantes (name, c_name, k_name, b_name)"""
+    for prefix in ('', 'c_', 'k_', 'b_'):
+        value = match.groupdict().get(prefix + name)
+        if value is not None:
+            return value
+    return None
+
+
+class SargableRewriter:
+    """Reescribe predicados sobre columnas codificadas como enteros a predicados indexables"""
+    
+    def __init__(self, mappings=None):
+        self.day_columns = set()
+        self.second_columns = set()
+        for m in mappings if mappings is not None else DEFAULT_MAPPINGS:
+            column = m['columna_bd'].upper()
+            tipo = (m.get('tipo_dato') or '').upper()
+            formula = (m.get('formula_conversion') or '').upper().replace(' ', '')
+            if tipo in DAY_SERIAL_TYPES or "DATEADD(DAY," in formula and "'1900-01-01'" in formula:
+                self.day_columns.add(column)
+            elif tipo in SECOND_OF_DAY_TYPES or "DATEADD(SECOND," in formula:
+                self.second_columns.add(column)
+        self.stats = {'rewritten_queries': 0, 'rewritten_predicates': 0}
+    
+    @classmethod
+    def from_config_cache(cls, cache):
+        """Rewriter con los mapeos de MAPEO_COLUMNAS de la caché de configuración"""
+        return cls(cache.mappings or DEFAULT_MAPPINGS)
+    
+    def rewrite(self, sql):
+        """SQL con los predicados de fecha/hora reescritos sobre el entero original"""
+        if not sql or not (self.day_columns or self.second_columns) or 'DATEADD' not in sql.upper():
+            return sql
+        
+        clauses = self._clause_map(sql)
+        edits = []
+        for pattern, handler in ((_DATE_LHS, self._date_predicate), (_TIME_LHS, self._time_predicate)):
+            for match in pattern.finditer(sql):
+                if clauses.get(match.start()) not in _SARGABLE_CLAUSES:
+                    continue
+                edit = handler(sql, match)
+                if edit is not None:
+                    edits.append(edit)
+        
+        if not edits:
+            return sql
+        
+        # Aplicar de derecha a izquierda sin solapamientos
+        edits.sort(key=lambda e: e[0], reverse=True)
+        result = sql
+        last_start = len(sql) + 1
+        applied = 0
+        for start, end, text in edits:
+            if end > last_start:
+                continue
+            result = result[:start] + text + result[end:]
+            last_start = start
+            applied += 1
+        
+        self.stats['rewritten_queries'] += 1
+        self.stats['rewritten_predicates'] += applied
+        return result
+    
+    @staticmethod
+    def _clause_map(sql):
+        """Cláusula (WHERE, ON, SELECT...) en la que empieza cada palabra fuera de literales y comentarios"""
+        clauses = {}
+        stack = [None]
+        for token in tokenize(sql):
+            if token.kind == 'op' and token.value == '(':
+                stack.append(stack[-1])
+            elif token.kind == 'op' and token.value == ')':
+                if len(stack) > 1:
+                    stack.pop()
+            elif token.kind == 'word':
+                if token.upper in _CLAUSES:
+                    stack[-1] = 'FROM' if token.upper == 'JOIN' else token.upper
+                clauses[token.pos] = stack[-1]
+        return clauses
+    
+    def _comparison(self, sql, match):
+        """Otro lado de la comparación: (inicio, fin, operador, literal(es) | None, desplazamiento de hoy | None)"""
+        rest = sql[match.end():]
+        between = re.match(r"\s+BETWEEN\s+" + _LITERAL + r"\s+AND\s+" + _LITERAL.replace('lit', 'lit2'), rest, re.I)
+        if between:
+            return match.start(), match.end() + between.end(), 'BETWEEN', (between.group('lit'), between.group('lit2')), None
+        
+        right = re.match(r"\s*" + _OPERATOR + r"\s*(?:" + _LITERAL + r"|(?P<today>" + _TODAY_AS_DATE.pattern + r"))", rest, re.I)
+        if right:
+            shift = self._today_shift(right) if right.group('today') else None
+            return match.start(), match.end() + right.end(), right.group('op'), right.group('lit'), shift
+        
+        before = sql[max(0, match.start() - 200):match.start()]
+        left = re.search(_LITERAL + r"\s*" + _OPERATOR + r"\s*\Z", before, re.I)
+        if left:
+            start = match.start() - (len(before) - left.start())
+            return start, match.end(), _FLIP[left.group('op')], left.group('lit'), None
+        return None
+    
+    @staticmethod
+    def _today_shift(match):
+        """Desplazamiento en días de una expresión 'hoy ± n' (suma el DATEADD exterior, si lo hay)"""
+        shift = 0
+        for name in ('o_shift', 'shift', 'c_shift', 'k_shift', 'd_shift', 'd_c_shift', 'd_k_shift'):
+            value = match.groupdict().get(name)
+            if value is not None:
+                shift += int(value.replace(' ', ''))
+        return shift
+    
+    def _date_predicate(self, sql, match):
+        """Predicado sobre una fecha en días desde 1900 -> comparación entera"""
+        name = (_group(match, 'qname') or _group(match, 'name') or '').upper()
+        if name not in self.day_columns:
+            return None
+        comparison = self._comparison(sql, match)
+        if comparison is None:
+            return None
+        start, end, op, literal, shift = comparison
+        column = _group(match, 'col')
+        
+        if op == 'BETWEEN':
+            low, high = (_parse_date(v) for v in literal)
+            if low is None or high is None:
+                return None
+            return start, end, f"{column} BETWEEN {day_serial(low)} AND {day_serial(high)}"
+        
+        if literal is None:
+            if shift is None:
+                return None
+            offset = f" + {2 + shift}" if 2 + shift >= 0 else f" - {-(2 + shift)}"
+            return start, end, f"{column} {op} DATEDIFF(DAY, '1900-01-01', GETDATE()){offset}"
+        
+        day = _parse_date(literal)
+        if day is None:
+            return None
+        return start, end, f"{column} {op} {day_serial(day)}"
+    
+    def _time_predicate(self, sql, match):
+        """Predicado sobre una hora en segundos -> comparación entera (HH:MM abarca 60 segundos)"""
+        name = (_group(match, 'qname') or _group(match, 'name') or '').upper()
+        if name not in self.second_columns:
+            return None
+        comparison = self._comparison(sql, match)
+        if comparison is None:
+            return None
+        start, end, op, literal, _ = comparison
+        if literal is None:
+            return None
+        column = _group(match, 'col')
+        
+        # CONVERT(VARCHAR(5), ..., 108) compara cadenas 'HH:MM': cada valor cubre un minuto
+        length = match.groupdict().get('len')
+        if length == '5':
+            width, exact = 60, 'HH:MM'
+        elif length == '8':
+            width, exact = 1, 'HH:MM:SS'
+        else:
+            width, exact = 1, None
+        
+        if op == 'BETWEEN':
+            low, high = (_parse_time(v, exact) for v in literal)
+            if low is None or high is None:
+                return None
+            return start, end, f"{column} BETWEEN {low} AND {high + width - 1}"
+        
+        seconds = _parse_time(literal, exact)
+        if seconds is None:
+            return None
+        last = seconds + width - 1
+        if op == '=':
+            text = f"{column} BETWEEN {seconds} AND {last}" if width > 1 else f"{column} = {seconds}"
+        elif op in ('<>', '!='):
+            text = f"({column} < {seconds} OR {column} > {last})" if width > 1 else f"{column} <> {seconds}"
+        elif op == '>':
+            text = f"{column} > {last}"
+        elif op == '>=':
+            text = f"{column} >= {seconds}"
+        elif op == '<':
+            text = f"{column} < {seconds}"
+        else:
+            text = f"{column} <= {last}"
+        return start, end, text
+
+
+# Prueba de reescritura
+if __name__ == "__main__":
+    print("=" * 70)
+    print("PRUEBA DE REESCRITURA DE PREDICADOS")
+    print("=" * 70)
+    
+    rewriter = SargableRewriter()
+    samples = [
+        "SELECT CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) AS Fecha FROM DCitas "
+        "WHERE CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) = '2026-10-17'",
+        "SELECT * FROM DCitas c WHERE CONVERT(VARCHAR(10), DATEADD(DAY, c.Fecha - 2, '1900-01-01'), 23) "
+        "BETWEEN '2026-10-01' AND '2026-10-31' AND CONVERT(VARCHAR(5), DATEADD(SECOND, c.Hora, 0), 108) >= '16:00'",
+        "SELECT * FROM DCitas WHERE CAST(DATEADD(DAY, Fecha - 2, '1900-01-01') AS DATE) = CAST(GETDATE() AS DATE) "
+        "AND CONVERT(VARCHAR(5), DATEADD(SECOND, Hora, 0), 108) = '09:30'",
+        "SELECT * FROM DCitas WHERE '2026-10-17' <= CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, '1900-01-01'), 23) "
+        "AND Texto = 'CONVERT(VARCHAR(10), DATEADD(DAY, Fecha - 2, ''1900-01-01''), 23) = ''2026-01-01'''",
+        "SELECT * FROM DCitas WHERE DATEADD(DAY, Fecha - 2, '1900-01-01') >= CAST(GETDATE() AS DATE) "
+        "AND DATEADD(DAY, Fecha - 2, '1900-01-01') < DATEADD(DAY, 7, CAST(GETDATE() AS DATE))",
+    ]
+    for sql in samples:
+        print(f"\n📝 {sql}\n➡️  {rewriter.rewrite(sql)}")
+    print(f"\n📊 {rewriter.stats}")
+    print(f"🔢 day_serial(2026-10-17) = {day_serial(date(2026, 10, 17))} (comprobación: "
+          f"{DAY_ZERO + timedelta(days=day_serial(date(2026, 10, 17)) - 2)})")
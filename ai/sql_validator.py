@@ -0,0 +1,150 @@
+"""
+FASE 3 - Validador de SQL
+Valida el SQL generado a partir de los tokens de sql_lexer (no por subcadenas): las
+palabras peligrosas solo cuentan como palabras clave, los comentarios no ocultan
+sentencias y los lotes con varias sentencias se detectan. Los veredictos se cachean
+por texto exacto y por huella normalizada
+"""
+
+import threading
+from collections import OrderedDict
+
+from sql_lexer import analyze, fingerprint, tokenize
+
+
+DEFAULT_DANGEROUS_KEYWORDS = ['DROP', 'TRUNCATE', 'DELETE FROM', 'ALTER TABLE', 'EXEC']
+
+# Sinónimos que también se consideran la misma operación peligrosa
+KEYWORD_ALIASES = {'EXEC': ('EXECUTE',)}
+
+
+class SQLValidator:
+    """Validación léxica de SQL con caché de veredictos en dos niveles"""
+    
+    def __init__(self, dangerous_keywords=None, max_entries=4096):
+        self.dangerous_keywords = list(dangerous_keywords or DEFAULT_DANGEROUS_KEYWORDS)
+        self.max_entries = max_entries
+        self._by_text = OrderedDict()
+        self._by_fingerprint = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'text_hits': 0, 'fingerprint_hits': 0, 'analyzed': 0}
+        
+        # Frases como secuencias de palabras: 'DELETE FROM' -> ('DELETE', 'FROM')
+        self._phrases = []
+        for keyword in self.dangerous_keywords:
+            words = tuple(keyword.upper().split())
+            self._phrases.append((keyword, words))
+            for alias in KEYWORD_ALIASES.get(keyword.upper(), ()):
+                self._phrases.append((keyword, (alias,) + words[1:]))
+    
+    def validate(self, sql, allow_write=False):
+        """Devuelve el SQL si es seguro; lanza ValueError con el motivo si no"""
+        key = (sql, bool(allow_write))
+        with self._lock:
+            verdict = self._by_text.get(key)
+            if verdict is not None:
+                self._by_text.move_to_end(key)
+                self.stats['text_hits'] += 1
+                return self._apply(verdict, sql)
+        
+        tokens = tokenize(sql or '', keep_comments=True)
+        # La huella oculta los literales: un literal sin cerrar debe dar otra clave
+        unterminated = any(not t.closed for t in tokens)
+        print_key = (fingerprint(tokens), unterminated, bool(allow_write))
+        with self._lock:
+            verdict = self._by_fingerprint.get(print_key)
+            if verdict is not None:
+                self._by_fingerprint.move_to_end(print_key)
+                self.stats['fingerprint_hits'] += 1
+        
+        if verdict is None:
+            verdict = self._verdict(sql, tokens, allow_write)
+            with self._lock:
+                self.stats['analyzed'] += 1
+                self._store(self._by_fingerprint, print_key, verdict)
+        
+        with self._lock:
+            self._store(self._by_text, key, verdict)
+        return self._apply(verdict, sql)
+    
+    @staticmethod
+    def _apply(verdict, sql):
+        """Veredicto '' = válido; cualquier otro texto es el mensaje de error"""
+        if verdict:
+            raise ValueError(verdict)
+        return sql
+    
+    def _store(self, cache, key, verdict):
+        cache[key] = verdict
+        cache.move_to_end(key)
+        while len(cache) > self.max_entries:
+            cache.popitem(last=False)
+    
+    def _verdict(self, sql, tokens, allow_write):
+        """Motivo de rechazo ('' si el SQL es válido)"""
+        code = [t for t in tokens if t.kind != 'comment']
+        if not sql or not code:
+            return "No se pudo generar SQL válido"
+        
+        if any(not t.closed for t in tokens):
+            return "❌ SQL con literal, identificador o comentario sin cerrar"
+        
+        # Palabras peligrosas: solo palabras clave, no parte de un nombre a.b ni dentro de literales
+        for index, token in enumerate(code):
+            if token.kind != 'word':
+                continue
+            if index > 0 and code[index - 1].value == '.':
+                continue
+            for keyword, words in self._phrases:
+                if token.upper != words[0]:
+                    continue
+                end = index + len(words)
+                if end > len(code) or any(code[index + i].kind != 'word' or code[index + i].upper != w
+                                          for i, w in enumerate(words)):
+                    continue
+                if end < len(code) and code[end].value == '.':
+                    continue
+                return f"❌ SQL contiene operación peligrosa: {keyword}"
+        
+        analysis = analyze(sql, code)
+        
+        # Validar que no haya múltiples statements (prevenir SQL injection)
+        if analysis.statements > 1:
+            return "❌ No se permiten múltiples statements SQL"
+        
+        # Si no se permiten escrituras, solo SELECT
+        if not allow_write and analysis.statement_type != 'SELECT':
+            return "❌ Solo se permiten consultas SELECT en modo lectura"
+        
+        return ''
+
+
+# Prueba del validador
+if __name__ == "__main__":
+    print("=" * 70)
+    print("PRUEBA DEL VALIDADOR DE SQL")
+    print("=" * 70)
+    
+    validator = SQLValidator()
+    samples = [
+        "SELECT * FROM DCitas WHERE Texto LIKE '%EXEC%'",
+        "SELECT e.[Exec] FROM Ejecuciones e",
+        "-- citas de hoy\nSELECT * FROM DCitas",
+        "WITH hoy AS (SELECT * FROM DCitas) SELECT * FROM hoy",
+        "SELECT * FROM Pacientes /* */ DROP TABLE Pacientes",
+        "SELECT * FROM Pacientes SELECT * FROM DCitas",
+        "SELECT * INTO #copia FROM Pacientes",
+        "exec sp_who",
+        "SELECT 'sin cerrar",
+    ]
+    for sql in samples:
+        try:
+            validator.validate(sql)
+            print(f"✅ {sql!r}")
+        except ValueError as e:
+            print(f"⛔ {sql!r}: {e}")
+    
+    validator.validate("SELECT * FROM DCitas WHERE IdUsu = 3")
+    validator.validate("SELECT * FROM DCitas WHERE IdUsu = 4")
+    validator.validate("SELECT * FROM DCitas WHERE IdUsu = 4")
+    print(f"\n📊 Caché: {validator.stats}")
@@ -0,0 +1,91 @@
+"""
+FASE 3 - Perfil de Arranque
+Mide el tiempo de importación de cada módulo de ai/ en un intérprete limpio
+(python -X importtime) y lo compara con un presupuesto, para que las invocaciones
+cortas de línea de comandos no paguen el coste del SDK de Gemini
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+
+AI_DIR = os.path.dirname(os.path.abspath(__file__))
+
+AI_MODULES = [
+    'sql_cache', 'schema_index', 'prompt_builder', 'config_cache', 'conversation_memory',
+    'llm_scheduler', 'single_flight', 'gemini_client', 'sql_generator'
+]
+
+
+def measure_import(module, top=3):
+    """Importa 'module' en un proceso nuevo: ms acumulados, ms de pared y dependencias más lentas"""
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=AI_DIR, capture_output=True, text=True
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    
+    if completed.returncode != 0:
+        error = completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else 'error'
+        return {'module': module, 'error': error, 'wall_ms': wall_ms}
+    
+    # Formato: "import time: self [us] | cumulative | imported package"; la sangría
+    # del nombre indica el nivel (1 = importado por -c, 3 = importado por ese módulo)
+    cumulative_ms = None
+    heaviest = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative_us, raw_name = line[len('import time:'):].split('|')
+        name = raw_name.strip()
+        depth = len(raw_name) - len(raw_name.lstrip())
+        if name == module and depth == 1:
+            cumulative_ms = int(cumulative_us) / 1000
+        elif depth == 3:
+            heaviest.append((int(cumulative_us) / 1000, name))
+    
+    heaviest.sort(reverse=True)
+    return {
+        'module': module,
+        'import_ms': cumulative_ms,
+        'wall_ms': wall_ms,
+        'heaviest': heaviest[:top]
+    }
+
+
+def run_startup_profile(modules=None, budget_ms=None):
+    """Informe de importación por módulo; devuelve 0 si todos cumplen el presupuesto, 1 si no"""
+    if budget_ms is None:
+        budget_ms = float(os.getenv('IA_STARTUP_BUDGET_MS', '250'))
+    
+    print("=" * 70)
+    print(f"PERFIL DE ARRANQUE (presupuesto por módulo: {budget_ms:.0f} ms)")
+    print("=" * 70)
+    
+    over_budget = 0
+    for module in modules or AI_MODULES:
+        result = measure_import(module)
+        if 'error' in result:
+            print(f"❌ {module:<22} no se pudo importar: {result['error']}")
+            over_budget += 1
+            continue
+        
+        import_ms = result['import_ms'] or 0.0
+        ok = import_ms <= budget_ms
+        over_budget += 0 if ok else 1
+        heaviest = ', '.join(f"{name} {ms:.1f}ms" for ms, name in result['heaviest'])
+        print(f"{'✅' if ok else '⚠️ '} {module:<22} {import_ms:8.1f} ms import | "
+              f"{result['wall_ms']:7.1f} ms proceso | {heaviest}")
+    
+    if over_budget:
+        print(f"\n⚠️  {over_budget} módulo(s) superan el presupuesto de arranque")
+        return 1
+    print("\n✅ Todos los módulos dentro del presupuesto de arranque")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run_startup_profile(sys.argv[1:] or None))
@@ -0,0 +1,334 @@
+"""
+FASE 3 - Registro de Carga y Asesor de Índices
+Registra cada sentencia ejecutada (huella sin literales, latencia, filas y origen:
+generate_sql, pipeline o proxy) en un SQLite local. El analizador ordena las huellas
+más pesadas y las cruza con sys.dm_db_missing_index_* para proponer índices sobre las
+tablas de GELITE como DDL revisable
+"""
+
+import atexit
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from sql_lexer import analyze, fingerprint, tokenize
+
+
+# En <repo>/database/cache, con independencia del directorio de trabajo
+DEFAULT_LOG_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'database', 'cache', 'workload.sqlite3')
+
+
+class WorkloadLog:
+    """Registro local de ejecuciones por huella de consulta (escrituras en bloque)"""
+
+    def __init__(self, path=None, flush_every=50, flush_interval=5.0, retention_days=None):
+        if path is None:
+            path = os.getenv('IA_WORKLOAD_LOG_PATH', DEFAULT_LOG_PATH)
+        if retention_days is None:
+            retention_days = float(os.getenv('IA_WORKLOAD_RETENTION_DAYS', '30'))
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self._pending = []
+        self._lock = threading.Lock()      # cola y contadores
+        self._db_lock = threading.Lock()   # conexión SQLite (las escrituras no bloquean record())
+        self._wake = threading.Event()
+        self._local = threading.local()
+        self.stats = {'recorded': 0, 'flushes': 0, 'dropped': 0}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS statements (
+                fingerprint TEXT PRIMARY KEY,
+                normalized TEXT NOT NULL,
+                sample_sql TEXT NOT NULL,
+                statement_type TEXT,
+                tables TEXT,
+                first_seen REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS executions (
+                fingerprint TEXT NOT NULL,
+                source TEXT NOT NULL,
+                executed_at REAL NOT NULL,
+                latency_ms REAL NOT NULL,
+                rows INTEGER,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_executions_time ON executions(executed_at);
+        """)
+        self._known = {row[0] for row in self._db.execute("SELECT fingerprint FROM statements")}
+        self._prune()
+        atexit.register(self.flush)
+
+        # Las escrituras las hace un hilo en segundo plano: record() solo encola
+        self._writer = threading.Thread(target=self._flush_loop, name='workload-log', daemon=True)
+        self._writer.start()
+
+    @contextmanager
+    def tagged(self, source):
+        """Las consultas de este hilo dentro del bloque se registran con 'source'"""
+        previous = getattr(self._local, 'source', None)
+        self._local.source = source
+        try:
+            yield
+        finally:
+            self._local.source = previous
+
+    def observer(self, default_source):
+        """Callback para query_observer de una conexión: (sql, latencia s, filas, error)"""
+        def observe(sql, latency, rows, error=None):
+            source = getattr(self._local, 'source', None) or default_source
+            self.record(sql, latency, rows, source, error)
+        return observe
+
+    def record(self, sql, latency, rows, source, error=None):
+        """Encola una ejecución; el hilo de escritura la guarda cada flush_interval s o flush_every registros"""
+        if isinstance(rows, list):
+            rows = len(rows)
+        with self._lock:
+            self._pending.append((sql, source, time.time(), latency * 1000, rows,
+                                  str(error)[:500] if error is not None else None))
+            self.stats['recorded'] += 1
+            due = len(self._pending) >= self.flush_every
+        if due:
+            self._wake.set()
+
+    def _flush_loop(self):
+        """Hilo de escritura: vacía la cola periódicamente o cuando se llena"""
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Escribe las ejecuciones pendientes (la huella se calcula aquí, en el hilo de escritura)"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return 0
+        with self._db_lock:
+            try:
+                executions = []
+                for sql, source, executed_at, latency_ms, rows, error in pending:
+                    tokens = tokenize(sql or '')
+                    normalized = fingerprint(tokens)
+                    key = hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+                    if key not in self._known:
+                        analysis = analyze(sql or '', tokens)
+                        self._db.execute(
+                            "INSERT OR IGNORE INTO statements VALUES (?, ?, ?, ?, ?, ?)",
+                            (key, normalized, sql, analysis.statement_type, ','.join(analysis.tables), executed_at))
+                        self._known.add(key)
+                    executions.append((key, source, executed_at, latency_ms, rows, error))
+                self._db.executemany("INSERT INTO executions VALUES (?, ?, ?, ?, ?, ?)", executions)
+                self._db.commit()
+                with self._lock:
+                    self.stats['flushes'] += 1
+            except sqlite3.Error as e:
+                with self._lock:
+                    self.stats['dropped'] += len(pending)
+                print(f"⚠️  No se pudo escribir el registro de carga: {e}")
+        return len(pending)
+
+    def _prune(self):
+        """Borra ejecuciones más antiguas que retention_days"""
+        if self.retention_days:
+            with self._db_lock:
+                self._db.execute("DELETE FROM executions WHERE executed_at < ?",
+                                 (time.time() - self.retention_days * 86400,))
+                self._db.commit()
+
+    def heaviest(self, limit=20, since_days=None, source=None):
+        """Huellas ordenadas por tiempo total de ejecución (latencia media × llamadas)"""
+        self.flush()
+        where = ["1 = 1"]
+        params = []
+        if since_days:
+            where.append("e.executed_at >= ?")
+            params.append(time.time() - since_days * 86400)
+        if source:
+            where.append("e.source = ?")
+            params.append(source)
+        params.append(limit)
+        with self._db_lock:
+            rows = self._db.execute(f"""
+                SELECT s.fingerprint, s.normalized, s.sample_sql, s.statement_type, s.tables,
+                       COUNT(*) AS calls, SUM(e.latency_ms) AS total_ms, AVG(e.latency_ms) AS avg_ms,
+                       MAX(e.latency_ms) AS max_ms, SUM(COALESCE(e.rows, 0)) AS rows,
+                       SUM(e.error IS NOT NULL) AS errors, GROUP_CONCAT(DISTINCT e.source) AS sources
+                FROM executions e JOIN statements s ON s.fingerprint = e.fingerprint
+                WHERE {' AND '.join(where)}
+                GROUP BY s.fingerprint
+                ORDER BY total_ms DESC
+                LIMIT ?
+            """, params).fetchall()
+        columns = ['fingerprint', 'normalized', 'sample_sql', 'statement_type', 'tables', 'calls',
+                   'total_ms', 'avg_ms', 'max_ms', 'rows', 'errors', 'sources']
+        result = []
+        for row in rows:
+            item = dict(zip(columns, row))
+            item['tables'] = [t for t in (item['tables'] or '').split(',') if t]
+            result.append(item)
+        return result
+
+
+_shared_log = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_workload_log():
+    """Registro compartido del proceso; None si IA_WORKLOAD_LOG_PATH está vacío"""
+    global _shared_log
+    if os.getenv('IA_WORKLOAD_LOG_PATH', DEFAULT_LOG_PATH) == '':
+        return None
+    with _shared_lock:
+        if _shared_log is None:
+            try:
+                _shared_log = WorkloadLog()
+            except (OSError, sqlite3.Error) as e:
+                print(f"⚠️  Registro de carga no disponible: {e}")
+                return None
+        return _shared_log
+
+
+MISSING_INDEX_QUERY = """
+    SELECT OBJECT_SCHEMA_NAME(d.object_id, d.database_id) AS esquema,
+           OBJECT_NAME(d.object_id, d.database_id) AS tabla,
+           d.equality_columns, d.inequality_columns, d.included_columns,
+           s.user_seeks, s.user_scans, s.avg_total_user_cost, s.avg_user_impact
+    FROM sys.dm_db_missing_index_details d
+    JOIN sys.dm_db_missing_index_groups g ON g.index_handle = d.index_handle
+    JOIN sys.dm_db_missing_index_group_stats s ON s.group_handle = g.index_group_handle
+    WHERE d.database_id = DB_ID()
+"""
+
+_BRACKETED = re.compile(r'\[([^\]]+)\]')
+
+
+class IndexAdvisor:
+    """Propone índices cruzando las huellas más pesadas con los índices que faltan según SQL Server"""
+
+    def __init__(self, db_connection, workload_log, top_fingerprints=50):
+        self.db = db_connection
+        self.log = workload_log
+        self.top_fingerprints = top_fingerprints
+
+    def missing_indexes(self):
+        """Sugerencias de sys.dm_db_missing_index_* con su mejora estimada"""
+        suggestions = []
+        for row in self.db.execute_query(MISSING_INDEX_QUERY):
+            # Medida habitual: coste medio × % de impacto × (búsquedas + recorridos)
+            improvement = ((row['avg_total_user_cost'] or 0) * (row['avg_user_impact'] or 0) / 100
+                           * ((row['user_seeks'] or 0) + (row['user_scans'] or 0)))
+            suggestions.append(dict(row, improvement=improvement))
+        return suggestions
+
+    def propose(self, limit=10, include_unlogged=False):
+        """Propuestas ordenadas por mejora estimada ponderada por el peso de la tabla en la carga"""
+        heavy = self.log.heaviest(self.top_fingerprints)
+        total_ms = sum(item['total_ms'] for item in heavy) or 1.0
+        by_table = {}
+        for item in heavy:
+            for table in item['tables']:
+                by_table.setdefault(table.split('.')[-1].upper(), []).append(item)
+
+        proposals = []
+        for suggestion in self.missing_indexes():
+            fingerprints = by_table.get((suggestion['tabla'] or '').upper(), [])
+            if not fingerprints and not include_unlogged:
+                continue
+            key_columns = _BRACKETED.findall(suggestion['equality_columns'] or '') \
+                + _BRACKETED.findall(suggestion['inequality_columns'] or '')
+            # Consultas registradas que mencionan alguna columna clave de la sugerencia
+            related = [f for f in fingerprints
+                       if any(re.search(r'\b' + re.escape(c.upper()) + r'\b', f['normalized']) for c in key_columns)]
+            share = sum(f['total_ms'] for f in related) / total_ms
+            proposals.append(dict(suggestion, key_columns=key_columns,
+                                  included=_BRACKETED.findall(suggestion['included_columns'] or ''),
+                                  related=related, workload_share=share,
+                                  score=suggestion['improvement'] * (1 + share)))
+
+        # Una sola propuesta por tabla y columnas clave
+        proposals.sort(key=lambda p: p['score'], reverse=True)
+        unique = {}
+        for proposal in proposals:
+            unique.setdefault((proposal['tabla'].upper(), tuple(proposal['key_columns'])), proposal)
+        return list(unique.values())[:limit]
+
+    @staticmethod
+    def ddl(proposal):
+        """CREATE INDEX comentado para revisar antes de ejecutar"""
+        name = f"IX_IA_{proposal['tabla']}_{'_'.join(proposal['key_columns'])}"
+        name = re.sub(r'\W', '_', name)[:120]
+        columns = ', '.join(f"[{c}]" for c in proposal['key_columns'])
+        lines = [
+            f"-- {proposal['esquema']}.{proposal['tabla']}: mejora estimada {proposal['improvement']:,.0f}, "
+            f"impacto {proposal['avg_user_impact'] or 0:.0f}%, "
+            f"{(proposal['user_seeks'] or 0) + (proposal['user_scans'] or 0):,} búsquedas/recorridos, "
+            f"{proposal['workload_share']:.0%} del tiempo registrado",
+        ]
+        for related in proposal['related'][:3]:
+            lines.append(f"--   {related['calls']} llamadas, {related['avg_ms']:.0f} ms de media: "
+                         f"{related['normalized'][:150]}")
+        statement = f"CREATE NONCLUSTERED INDEX [{name}] ON [{proposal['esquema']}].[{proposal['tabla']}] ({columns})"
+        if proposal['included']:
+            statement += f" INCLUDE ({', '.join(f'[{c}]' for c in proposal['included'])})"
+        lines.append(f"IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = '{name}')")
+        lines.append(f"    {statement};")
+        lines.append("GO")
+        return '\n'.join(lines)
+
+    def write_ddl(self, proposals, path=None):
+        """Escribe las propuestas en un script .sql (no se ejecuta nada en la BD)"""
+        path = path or os.getenv('IA_INDEX_PROPOSALS_PATH', 'database/schema/IA_INDICES_PROPUESTOS.sql')
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        header = [
+            "-- Índices propuestos por IndexAdvisor a partir del registro de carga de IA Dental",
+            f"-- Generado: {time.strftime('%Y-%m-%d %H:%M:%S')}",
+            "-- REVISAR antes de ejecutar (sql_script_runner.py): cada índice encarece las escrituras",
+            "",
+        ]
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(header + [self.ddl(p) + '\n' for p in proposals]))
+        return path
+
+
+# Informe de carga y propuestas de índices
+if __name__ == "__main__":
+    import sys
+
+    print("=" * 70)
+    print("REGISTRO DE CARGA Y ASESOR DE ÍNDICES")
+    print("=" * 70)
+
+    log = get_shared_workload_log()
+    if log is None:
+        print("❌ Registro de carga desactivado (IA_WORKLOAD_LOG_PATH vacío)")
+        sys.exit(1)
+
+    print("\n📊 Huellas más pesadas:")
+    for item in log.heaviest(15):
+        print(f"  {item['total_ms']:10.0f} ms | {item['calls']:5} llamadas | {item['avg_ms']:7.1f} ms media | "
+              f"{item['sources']} | {item['normalized'][:80]}")
+
+    if '--advise' in sys.argv:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts', 'phase1'))
+        from db_connection import DatabaseConnection
+
+        db = DatabaseConnection()
+        advisor = IndexAdvisor(db, log)
+        proposals = advisor.propose(include_unlogged='--all' in sys.argv)
+        path = advisor.write_ddl(proposals)
+        print(f"\n✅ {len(proposals)} índice(s) propuesto(s) en {path}")
+        db.close()
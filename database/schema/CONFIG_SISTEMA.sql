@@ -3,12 +3,9 @@
 -- Tabla de auto-configuración del sistema de IA
 -- ============================================================================
 
--- Eliminar tabla si existe (solo para desarrollo)
-IF OBJECT_ID('CONFIG_SISTEMA', 'U') IS NOT NULL
-    DROP TABLE CONFIG_SISTEMA;
-GO
-
--- Crear tabla CONFIG_SISTEMA
+-- Crear tabla solo si no existe (re-ejecutable: conserva valores, versión y auditoría)
+IF OBJECT_ID('CONFIG_SISTEMA', 'U') IS NULL
+BEGIN
 CREATE TABLE CONFIG_SISTEMA (
     id INT IDENTITY(1,1) PRIMARY KEY,
     
@@ -34,15 +31,21 @@ CREATE TABLE CONFIG_SISTEMA (
     -- Constraint de unicidad
     CONSTRAINT UQ_CONFIG_CATEGORIA_CLAVE UNIQUE(categoria, clave)
 );
+END
 GO
 
 -- Índices para optimizar búsquedas
-CREATE INDEX idx_config_categoria ON CONFIG_SISTEMA(categoria, activo);
-CREATE INDEX idx_config_prioridad ON CONFIG_SISTEMA(prioridad DESC);
-CREATE INDEX idx_config_fecha_mod ON CONFIG_SISTEMA(fecha_modificacion DESC);
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_config_categoria' AND object_id = OBJECT_ID('CONFIG_SISTEMA'))
+    CREATE INDEX idx_config_categoria ON CONFIG_SISTEMA(categoria, activo);
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_config_prioridad' AND object_id = OBJECT_ID('CONFIG_SISTEMA'))
+    CREATE INDEX idx_config_prioridad ON CONFIG_SISTEMA(prioridad DESC);
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_config_fecha_mod' AND object_id = OBJECT_ID('CONFIG_SISTEMA'))
+    CREATE INDEX idx_config_fecha_mod ON CONFIG_SISTEMA(fecha_modificacion DESC);
 GO
 
 -- Comentarios de documentación
+IF NOT EXISTS (SELECT 1 FROM sys.extended_properties
+               WHERE major_id = OBJECT_ID('CONFIG_SISTEMA') AND minor_id = 0 AND name = N'MS_Description')
 EXEC sp_addextendedproperty 
     @name = N'MS_Description', 
     @value = N'Tabla de auto-configuración del sistema de IA. Almacena prompts, reglas de negocio y validaciones que se leen dinámicamente.', 
@@ -5,6 +5,9 @@ Gestión segura de conexión a SQL Server usando credenciales de RUBIOGARCIADENT
 
 import pyodbc
 import os
+import threading
+import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
 # Cargar variables de entorno
@@ -13,13 +16,24 @@ load_dotenv()
 class DatabaseConnection:
     """Gestiona la conexión segura a SQL Server"""
     
-    def __init__(self):
+    # Origen con el que se registran las consultas en el registro de carga
+    workload_source = 'pipeline'
+    
+    def __init__(self, query_observer=None):
         self.server = os.getenv('DB_SERVER', 'GABINETE2')
         self.instance = os.getenv('DB_INSTANCE', 'INFOMED')
         self.database = os.getenv('DB_NAME', 'GELITE')
         self.username = os.getenv('DB_USER')
         self.password = os.getenv('DB_PASSWORD')
         self.connection = None
+        self.in_transaction = False
+        
+        # Callback opcional (sql, latencia en s, filas, error) tras cada consulta
+        self.query_observer = query_observer
+        
+        # Cursores con una consulta en curso (para cancel())
+        self._active_cursors = set()
+        self._cursors_lock = threading.Lock()
         
         # Validar credenciales
         if not self.username or not self.password:
@@ -52,12 +66,36 @@ class DatabaseConnection:
             print(f"❌ Error de conexión: {e}")
             raise
     
-    def execute_query(self, query, params=None):
-        """Ejecuta una consulta SQL y retorna los resultados"""
+    def execute_query(self, query, params=None, timeout=None):
+        """Ejecuta una consulta SQL y retorna los resultados
+
+        timeout (segundos) limita esta consulta; al vencer, el driver la cancela
+        en el servidor y se lanza pyodbc.OperationalError (HYT00).
+        """
+        if self.query_observer is None:
+            return self._execute_query(query, params, timeout)
+        
+        started = time.perf_counter()
+        try:
+            result = self._execute_query(query, params, timeout)
+        except Exception as e:
+            self._observe(query, started, None, e)
+            raise
+        self._observe(query, started, result)
+        return result
+    
+    def _observe(self, query, started, rows, error=None):
+        """Notifica la consulta al observador; sus fallos nunca afectan a la consulta"""
+        try:
+            self.query_observer(query, time.perf_counter() - started, rows, error)
+        except Exception as e:
+            print(f"⚠️  Error en el observador de consultas: {e}")
+    
+    def _execute_query(self, query, params=None, timeout=None):
         if not self.connection:
             self.connect()
         
-        cursor = self.connection.cursor()
+        cursor = self._open_cursor(timeout)
         
         try:
             if params:
@@ -65,24 +103,175 @@ class DatabaseConnection:
             else:
                 cursor.execute(query)
             
-            # Si es SELECT, retornar resultados
-            if query.strip().upper().startswith('SELECT'):
+            # Si devuelve filas (SELECT o lote con SELECT/OUTPUT final), retornar resultados
+            if cursor.description is not None:
                 columns = [column[0] for column in cursor.description]
                 results = []
                 for row in cursor.fetchall():
                     results.append(dict(zip(columns, row)))
+                
+                # Los lotes de escritura que terminan en SELECT también deben confirmarse
+                if not query.strip().upper().startswith('SELECT'):
+                    self._commit()
                 return results
             else:
                 # Para INSERT/UPDATE/DELETE
-                self.connection.commit()
+                self._commit()
                 return cursor.rowcount
                 
         except pyodbc.Error as e:
             print(f"❌ Error ejecutando query: {e}")
             raise
+        finally:
+            self._close_cursor(cursor)
+    
+    def iter_query(self, query, params=None, batch_size=500, timeout=None):
+        """Ejecuta un SELECT y devuelve las filas por lotes (fetchmany) sin cargarlas todas
+
+        El cursor queda activo (cancelable) hasta agotar el generador o cerrarlo.
+        """
+        if not self.connection:
+            self.connect()
+        
+        cursor = self._open_cursor(timeout)
+        started = time.perf_counter()
+        count = 0
+        error = None
+        
+        try:
+            if params:
+                cursor.execute(query, params)
+            else:
+                cursor.execute(query)
+            
+            if cursor.description is None:
+                return
+            columns = [column[0] for column in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                count += len(rows)
+                yield [dict(zip(columns, row)) for row in rows]
+                
+        except pyodbc.Error as e:
+            error = e
+            print(f"❌ Error ejecutando query: {e}")
+            raise
+        finally:
+            self._close_cursor(cursor)
+            if self.query_observer is not None:
+                self._observe(query, started, count, error)
+    
+    def estimated_plan(self, query, params=None):
+        """Plan estimado (XML) de una consulta sin ejecutarla (SET SHOWPLAN_XML)"""
+        if not self.connection:
+            self.connect()
+        
+        cursor = self.connection.cursor()
+        try:
+            # SET SHOWPLAN_XML debe ir solo en su lote
+            cursor.execute("SET SHOWPLAN_XML ON")
+            try:
+                if params:
+                    cursor.execute(query, params)
+                else:
+                    cursor.execute(query)
+                # Un plan por lote: se concatenan si hay varios conjuntos de resultados
+                plans = []
+                while True:
+                    if cursor.description is not None:
+                        plans.extend(row[0] for row in cursor.fetchall())
+                    if not cursor.nextset():
+                        break
+                return ''.join(plans)
+            finally:
+                cursor.execute("SET SHOWPLAN_XML OFF")
+        except pyodbc.Error as e:
+            print(f"❌ Error obteniendo plan estimado: {e}")
+            raise
         finally:
             cursor.close()
     
+    def cancel(self):
+        """Cancela las consultas en curso de esta conexión (se puede llamar desde otro hilo)"""
+        with self._cursors_lock:
+            cursors = list(self._active_cursors)
+        for cursor in cursors:
+            try:
+                cursor.cancel()
+            except pyodbc.Error as e:
+                print(f"⚠️  No se pudo cancelar la consulta: {e}")
+        return len(cursors)
+    
+    def _open_cursor(self, timeout=None):
+        """Cursor registrado como activo; timeout se aplica a sus consultas"""
+        with self._cursors_lock:
+            # connection.timeout se lee al crear el cursor
+            previous = self.connection.timeout
+            if timeout is not None:
+                self.connection.timeout = max(1, int(round(timeout)))
+            try:
+                cursor = self.connection.cursor()
+            finally:
+                self.connection.timeout = previous
+            self._active_cursors.add(cursor)
+        return cursor
+    
+    def _close_cursor(self, cursor):
+        with self._cursors_lock:
+            self._active_cursors.discard(cursor)
+        cursor.close()
+    
+    def execute_many(self, query, rows):
+        """Ejecuta la misma sentencia para muchas filas en un único envío"""
+        if not self.connection:
+            self.connect()
+        
+        rows = list(rows)
+        if not rows:
+            return 0
+        
+        cursor = self.connection.cursor()
+        
+        try:
+            # Envía los parámetros en bloque en lugar de un round-trip por fila
+            cursor.fast_executemany = True
+            cursor.executemany(query, rows)
+            self._commit()
+            return len(rows)
+        except pyodbc.Error as e:
+            print(f"❌ Error ejecutando query masiva: {e}")
+            raise
+        finally:
+            cursor.close()
+    
+    def _commit(self):
+        """Confirma la operación salvo que forme parte de una transacción explícita"""
+        if not self.in_transaction:
+            self.connection.commit()
+    
+    @contextmanager
+    def transaction(self):
+        """Agrupa varias operaciones en una única transacción (commit o rollback al final)"""
+        if not self.connection:
+            self.connect()
+        
+        if self.in_transaction:
+            # Transacción anidada: se integra en la exterior
+            yield self
+            return
+        
+        self.in_transaction = True
+        try:
+            yield self
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            self.in_transaction = False
+    
     def close(self):
         """Cierra la conexión"""
         if self.connection:
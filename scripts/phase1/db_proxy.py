@@ -5,24 +5,53 @@ Mientras se configura el acceso remoto directo
 
 import requests
 import json
+import time
 
 
 class ServerJSProxy:
     """Usa el servidor Node.js existente como proxy para BD"""
     
-    def __init__(self, base_url='http://192.168.1.34:3001'):
+    # Origen con el que se registran las consultas en el registro de carga
+    workload_source = 'proxy'
+    
+    def __init__(self, base_url='http://192.168.1.34:3001', query_observer=None):
         self.base_url = base_url
         self.connection = None
+        # Callback opcional (sql, latencia en s, filas, error) tras cada consulta
+        self.query_observer = query_observer
     
-    def execute_query(self, query, params=None):
-        """Ejecuta query a través del servidor Node.js"""
+    def execute_query(self, query, params=None, timeout=None):
+        """Ejecuta query a través del servidor Node.js
+
+        timeout (segundos) limita la espera de la respuesta; la consulta no se
+        cancela en el servidor (server.js no lo permite).
+        """
+        if self.query_observer is None:
+            return self._execute_query(query, params, timeout)
         
+        started = time.perf_counter()
+        try:
+            rows = self._execute_query(query, params, timeout)
+        except Exception as e:
+            self._observe(query, started, None, e)
+            raise
+        self._observe(query, started, rows)
+        return rows
+    
+    def _observe(self, query, started, rows, error=None):
+        """Notifica la consulta al observador; sus fallos nunca afectan a la consulta"""
+        try:
+            self.query_observer(query, time.perf_counter() - started, rows, error)
+        except Exception as e:
+            print(f"⚠️  Error en el observador de consultas: {e}")
+    
+    def _execute_query(self, query, params=None, timeout=None):
         try:
             response = requests.post(
                 f'{self.base_url}/api/query',
                 json={'query': query},
                 headers={'Content-Type': 'application/json'},
-                timeout=30
+                timeout=timeout or 30
             )
             
             if response.status_code == 200:
@@ -43,6 +72,12 @@ class ServerJSProxy:
         except Exception as e:
             raise Exception(f"Error ejecutando query: {e}")
     
+    def iter_query(self, query, params=None, batch_size=500, timeout=None):
+        """Filas por lotes (server.js devuelve el resultado completo; se trocea aquí)"""
+        rows = self.execute_query(query, params, timeout=timeout)
+        for start in range(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+    
     def connect(self):
         """Verifica que el servidor esté disponible"""
         try:
@@ -5,9 +5,16 @@ Lee NOMBRE DE COLUMNAS.csv y genera:
 2. Documentación de estructura de BD para Gemini
 """
 
+import argparse
+import codecs
 import csv
+import json
+import mmap
+import os
+import sys
 from collections import defaultdict
 from db_connection import DatabaseConnection
+from schema_reconciler import SchemaReconciler, load_mappings_from_db
 
 
 class ColumnMappingGenerator:
@@ -18,33 +25,99 @@ class ColumnMappingGenerator:
         self.db = db_connection
         self.tables = defaultdict(list)
         
-    def parse_csv(self):
-        """Lee el CSV y organiza por tablas"""
+    def parse_csv(self, use_mmap=False):
+        """Lee el CSV en streaming y organiza por tablas
+
+        Admite BOM UTF-8, campos entre comillas y columnas que contienen ';'.
+        Con use_mmap=True el fichero se mapea en memoria (útil para exportaciones
+        de varios millones de líneas).
+        """
         print(f"📖 Leyendo {self.csv_file}...")
         
-        with open(self.csv_file, 'r', encoding='utf-8') as f:
+        tables = defaultdict(list)
+        seen = set()
+        total_rows = 0
+        skipped = 0
+        
+        for row in self._iter_csv_rows(use_mmap):
+            total_rows += 1
+            
             # El CSV tiene formato: Tabla;Columna
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                
-                parts = line.split(';')
-                if len(parts) == 2:
-                    table_name, column_name = parts
-                    self.tables[table_name].append(column_name)
-        
-        print(f"✅ Encontradas {len(self.tables)} tablas")
+            # Si la columna contiene ';' sin comillas, se reconstruye el resto de la fila
+            if len(row) < 2:
+                if row and row[0].strip():
+                    skipped += 1
+                continue
+            
+            table_name = sys.intern(row[0].strip())
+            column_name = sys.intern(';'.join(row[1:]).strip())
+            if not table_name or not column_name:
+                skipped += 1
+                continue
+            
+            key = (table_name, column_name)
+            if key in seen:
+                continue
+            seen.add(key)
+            tables[table_name].append(column_name)
+        
+        self.tables = tables
+        
+        print(f"✅ Encontradas {len(self.tables)} tablas ({len(seen)} columnas, {total_rows} filas leídas)")
+        if skipped:
+            print(f"⚠️  {skipped} filas ignoradas por formato inválido")
+        return self.tables
+    
+    def _iter_csv_rows(self, use_mmap=False):
+        """Itera las filas del CSV sin cargar el fichero completo"""
+        if use_mmap and os.path.getsize(self.csv_file) > 0:
+            with open(self.csv_file, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if mm[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8:
+                        mm.seek(len(codecs.BOM_UTF8))
+                    lines = (line.decode('utf-8') for line in iter(mm.readline, b''))
+                    yield from csv.reader(lines, delimiter=';', quotechar='"')
+        else:
+            # utf-8-sig elimina el BOM del primer nombre de tabla
+            with open(self.csv_file, 'r', encoding='utf-8-sig', newline='') as f:
+                yield from csv.reader(f, delimiter=';', quotechar='"')
+    
+    def load_schema_tables(self, schema_file='database/schema/schema_extracted.json'):
+        """Carga las tablas y columnas desde el esquema extraído (alternativa al CSV)"""
+        print(f"📖 Leyendo esquema {schema_file}...")
+        
+        with open(schema_file, 'r', encoding='utf-8') as f:
+            schema = json.load(f)
+        
+        tables = defaultdict(list)
+        for table in schema['tables']:
+            table_name = sys.intern(table['name'])
+            for column in table['columns']:
+                tables[table_name].append(sys.intern(column['COLUMN_NAME']))
+        
+        self.tables = tables
+        print(f"✅ Encontradas {len(self.tables)} tablas en el esquema")
         return self.tables
     
-    def create_mapeo_columnas_table(self):
-        """Crea la tabla MAPEO_COLUMNAS"""
+    def create_mapeo_columnas_table(self, drop_existing=True):
+        """Crea la tabla MAPEO_COLUMNAS
+
+        Con drop_existing=False solo se crea si no existe, conservando los mapeos actuales.
+        """
         print("📋 Creando tabla MAPEO_COLUMNAS...")
         
-        sql = """
+        if drop_existing:
+            prefix = """
         IF OBJECT_ID('MAPEO_COLUMNAS', 'U') IS NOT NULL
             DROP TABLE MAPEO_COLUMNAS;
+        """
+        else:
+            prefix = """
+        IF OBJECT_ID('MAPEO_COLUMNAS', 'U') IS NOT NULL
+            RETURN;
+        """
         
+        sql = prefix + """
         CREATE TABLE MAPEO_COLUMNAS (
             id INT IDENTITY(1,1) PRIMARY KEY,
             tabla VARCHAR(100) NOT NULL,
@@ -140,6 +213,38 @@ class ColumnMappingGenerator:
             'descripcion': None
         }
     
+    def build_mapping_row(self, table_name, column_name):
+        """Construye la fila de MAPEO_COLUMNAS para una columna"""
+        # Deducir tipo
+        col_info = self.deduce_column_type(table_name, column_name)
+        
+        # Nombre coloquial (por ahora igual al nombre de columna)
+        nombre_coloquial = column_name
+        
+        return (
+            table_name,
+            column_name,
+            nombre_coloquial,
+            col_info['tipo'],
+            col_info.get('es_fecha', 0),
+            col_info.get('es_hora', 0),
+            col_info.get('es_duracion', 0),
+            col_info.get('es_estado', 0),
+            col_info.get('formula'),
+            col_info.get('descripcion')
+        )
+    
+    def build_mapping_rows(self, tables=None):
+        """Genera las filas de mapeo para las tablas indicadas (todas por defecto)"""
+        if tables is None:
+            tables = sorted(self.tables.keys())
+        
+        rows = []
+        for table_name in tables:
+            for column_name in self.tables.get(table_name, []):
+                rows.append(self.build_mapping_row(table_name, column_name))
+        return rows
+    
     def populate_mappings(self, priority_tables=None):
         """Popula la tabla MAPEO_COLUMNAS"""
         if priority_tables is None:
@@ -164,25 +269,8 @@ class ColumnMappingGenerator:
             print(f"  📊 {table_name}: {len(columns)} columnas")
             
             for column_name in columns:
-                # Deducir tipo
-                col_info = self.deduce_column_type(table_name, column_name)
-                
-                # Nombre coloquial (por ahora igual al nombre de columna)
-                nombre_coloquial = column_name
-                
                 try:
-                    self.db.execute_query(insert_sql, [
-                        table_name,
-                        column_name,
-                        nombre_coloquial,
-                        col_info['tipo'],
-                        col_info.get('es_fecha', 0),
-                        col_info.get('es_hora', 0),
-                        col_info.get('es_duracion', 0),
-                        col_info.get('es_estado', 0),
-                        col_info.get('formula'),
-                        col_info.get('descripcion')
-                    ])
+                    self.db.execute_query(insert_sql, list(self.build_mapping_row(table_name, column_name)))
                     total_inserted += 1
                 except Exception as e:
                     print(f"⚠️  Error insertando {table_name}.{column_name}: {e}")
@@ -190,11 +278,146 @@ class ColumnMappingGenerator:
         print(f"✅ {total_inserted} mapeos insertados")
         return total_inserted
     
-    def generate_documentation(self, output_file='database/schema/estructura_bd.md'):
-        """Genera documentación de la estructura de BD"""
+    def sync_mappings(self, tables=None):
+        """Sincroniza MAPEO_COLUMNAS con el catálogo completo mediante staging + MERGE
+
+        Las filas se cargan en bloque en una tabla temporal y se aplican con un
+        único MERGE: se insertan las nuevas, se actualizan las que cambian y las
+        idénticas no se tocan. Devuelve los contadores inserted/updated/unchanged.
+        """
+        rows = self.build_mapping_rows(tables)
+        print(f"🔄 Sincronizando {len(rows)} mapeos de {len(tables) if tables else len(self.tables)} tablas...")
+        
+        if not rows:
+            return {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        
+        # 1. Tabla temporal de staging (vive en la sesión de la conexión)
+        self.db.execute_query("""
+        IF OBJECT_ID('tempdb..#MAPEO_COLUMNAS_STAGING') IS NOT NULL
+            DROP TABLE #MAPEO_COLUMNAS_STAGING;
+        
+        CREATE TABLE #MAPEO_COLUMNAS_STAGING (
+            tabla VARCHAR(100) NOT NULL,
+            columna_bd VARCHAR(100) NOT NULL,
+            nombre_coloquial VARCHAR(100),
+            tipo_dato VARCHAR(50),
+            es_fecha BIT,
+            es_hora BIT,
+            es_duracion BIT,
+            es_estado BIT,
+            formula_conversion NVARCHAR(MAX),
+            descripcion NVARCHAR(500),
+            PRIMARY KEY (tabla, columna_bd)
+        );
+        """)
+        
+        # 2. Carga masiva del staging
+        self.db.execute_many("""
+        INSERT INTO #MAPEO_COLUMNAS_STAGING
+        (tabla, columna_bd, nombre_coloquial, tipo_dato, es_fecha, es_hora, es_duracion, es_estado, formula_conversion, descripcion)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        
+        # 3. Un único MERGE; EXCEPT compara las columnas respetando NULLs
+        result = self.db.execute_query("""
+        SET NOCOUNT ON;
+        DECLARE @acciones TABLE (accion NVARCHAR(10));
+        
+        MERGE MAPEO_COLUMNAS AS t
+        USING #MAPEO_COLUMNAS_STAGING AS s
+            ON t.tabla = s.tabla AND t.columna_bd = s.columna_bd
+        WHEN MATCHED AND EXISTS (
+            SELECT s.nombre_coloquial, s.tipo_dato, s.es_fecha, s.es_hora, s.es_duracion,
+                   s.es_estado, s.formula_conversion, s.descripcion
+            EXCEPT
+            SELECT t.nombre_coloquial, t.tipo_dato, t.es_fecha, t.es_hora, t.es_duracion,
+                   t.es_estado, t.formula_conversion, t.descripcion
+        ) THEN
+            UPDATE SET
+                nombre_coloquial = s.nombre_coloquial,
+                tipo_dato = s.tipo_dato,
+                es_fecha = s.es_fecha,
+                es_hora = s.es_hora,
+                es_duracion = s.es_duracion,
+                es_estado = s.es_estado,
+                formula_conversion = s.formula_conversion,
+                descripcion = s.descripcion
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT (tabla, columna_bd, nombre_coloquial, tipo_dato, es_fecha, es_hora, es_duracion, es_estado, formula_conversion, descripcion)
+            VALUES (s.tabla, s.columna_bd, s.nombre_coloquial, s.tipo_dato, s.es_fecha, s.es_hora, s.es_duracion, s.es_estado, s.formula_conversion, s.descripcion)
+        OUTPUT $action INTO @acciones;
+        
+        DROP TABLE #MAPEO_COLUMNAS_STAGING;
+        
+        SELECT
+            SUM(CASE WHEN accion = 'INSERT' THEN 1 ELSE 0 END) AS inserted,
+            SUM(CASE WHEN accion = 'UPDATE' THEN 1 ELSE 0 END) AS updated
+        FROM @acciones;
+        """)
+        
+        counts = result[0] if result else {}
+        inserted = counts.get('inserted') or 0
+        updated = counts.get('updated') or 0
+        stats = {
+            'inserted': inserted,
+            'updated': updated,
+            'unchanged': len(rows) - inserted - updated
+        }
+        
+        print(f"✅ Mapeos sincronizados: {stats['inserted']} nuevos, {stats['updated']} actualizados, {stats['unchanged']} sin cambios")
+        return stats
+    
+    def _render_priority_fragment(self, table_name, description):
+        """Renderiza la sección detallada de una tabla principal"""
+        columns = self.tables[table_name]
+        parts = [
+            f"### {table_name}\n",
+            f"**Descripción**: {description}\n",
+            f"**Columnas**: {len(columns)}\n\n",
+        ]
+        
+        # Listar columnas importantes
+        important_cols = [c for c in columns if any(x in c.lower() for x in ['id', 'nombre', 'fecha', 'estado'])]
+        if important_cols:
+            parts.append("**Columnas clave**:\n")
+            parts.extend(f"- `{col}`\n" for col in important_cols[:10])
+            parts.append("\n")
+        return ''.join(parts)
+    
+    def _render_table_page(self, table_name, description, index_link):
+        """Renderiza el fichero individual de una tabla (modo dividido)"""
+        columns = self.tables[table_name]
+        parts = [f"# {table_name}\n\n"]
+        if description:
+            parts.append(f"**Descripción**: {description}\n\n")
+        parts.append(f"**Columnas**: {len(columns)}\n\n")
+        parts.extend(f"- `{col}`\n" for col in columns)
+        parts.append(f"\n[← Volver al índice]({index_link})\n")
+        return ''.join(parts)
+    
+    def _write_if_changed(self, path, content):
+        """Escribe el fichero solo si su contenido cambió; devuelve True si lo escribió"""
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                if f.read() == content:
+                    return False
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return True
+    
+    def generate_documentation(self, output_file='database/schema/estructura_bd.md', split_dir=None):
+        """Genera documentación de la estructura de BD
+
+        El documento se ensambla en memoria y solo se reescribe si cambió. Con
+        split_dir se escribe además un fichero por tabla (solo los que cambian),
+        el documento principal enlaza a ellos como índice y se borran las páginas
+        de tablas que ya no existen.
+        """
         print(f"📄 Generando documentación en {output_file}...")
         
-        content = f"""# Estructura de Base de Datos GELITE
+        stats = {'files_written': 0, 'files_removed': 0}
+        
+        parts = [f"""# Estructura de Base de Datos GELITE
 
 **Generado automáticamente desde NOMBRE DE COLUMNAS.csv**
 
@@ -202,7 +425,7 @@ Total de tablas: {len(self.tables)}
 
 ## Tablas Principales
 
-"""
+"""]
         
         # Tablas prioritarias con descripción
         priority_info = {
@@ -217,38 +440,63 @@ Total de tablas: {len(self.tables)}
         
         for table_name, description in priority_info.items():
             if table_name in self.tables:
-                columns = self.tables[table_name]
-                content += f"### {table_name}\n"
-                content += f"**Descripción**: {description}\n"
-                content += f"**Columnas**: {len(columns)}\n\n"
-                
-                # Listar columnas importantes
-                important_cols = [c for c in columns if any(x in c.lower() for x in ['id', 'nombre', 'fecha', 'estado'])]
-                if important_cols:
-                    content += "**Columnas clave**:\n"
-                    for col in important_cols[:10]:
-                        content += f"- `{col}`\n"
-                    content += "\n"
-        
-        content += f"""
+                parts.append(self._render_priority_fragment(table_name, description))
+        
+        parts.append(f"""
 ## Todas las Tablas
 
 Total: {len(self.tables)} tablas
 
-"""
+""")
+        
+        if split_dir:
+            os.makedirs(split_dir, exist_ok=True)
+            link_dir = os.path.relpath(split_dir, os.path.dirname(output_file) or '.')
+            index_link = os.path.relpath(output_file, split_dir)
+            pages = set()
         
         for table_name in sorted(self.tables.keys()):
-            content += f"- **{table_name}** ({len(self.tables[table_name])} columnas)\n"
+            columns = self.tables[table_name]
+            
+            if split_dir:
+                page_name = f"{table_name}.md"
+                pages.add(page_name)
+                text = self._render_table_page(table_name, priority_info.get(table_name), index_link)
+                if self._write_if_changed(os.path.join(split_dir, page_name), text):
+                    stats['files_written'] += 1
+                parts.append(f"- [**{table_name}**]({link_dir}/{table_name}.md) ({len(columns)} columnas)\n")
+            else:
+                parts.append(f"- **{table_name}** ({len(columns)} columnas)\n")
         
-        # Guardar
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(content)
+        if split_dir:
+            # Borrar páginas de tablas eliminadas en ejecuciones anteriores
+            output_abs = os.path.abspath(output_file)
+            for name in os.listdir(split_dir):
+                path = os.path.join(split_dir, name)
+                if name.endswith('.md') and name not in pages and os.path.abspath(path) != output_abs:
+                    os.remove(path)
+                    stats['files_removed'] += 1
+        
+        # Guardar solo si el documento cambió
+        self._write_if_changed(output_file, ''.join(parts))
         
         print(f"✅ Documentación generada: {output_file}")
+        if split_dir:
+            print(f"  📁 {stats['files_written']} ficheros de tabla actualizados, {stats['files_removed']} eliminados en {split_dir}")
+        return stats
 
 
 def main():
     """Ejecuta el proceso completo"""
+    parser = argparse.ArgumentParser(description='Generador de mapeos de columnas')
+    parser.add_argument('--completo', action='store_true',
+                        help='Genera mapeos para todas las tablas y los sincroniza con MERGE')
+    parser.add_argument('--esquema', metavar='JSON',
+                        help='Usa schema_extracted.json como origen en lugar del CSV')
+    parser.add_argument('--dividir-docs', metavar='DIR',
+                        help='Escribe un fichero Markdown por tabla en DIR con un índice en estructura_bd.md')
+    args = parser.parse_args()
+    
     print("=" * 70)
     print("GENERADOR DE MAPEOS DE COLUMNAS")
     print("=" * 70)
@@ -261,17 +509,39 @@ def main():
     csv_file = '../../NOMBRE DE COLUMNAS.csv'
     generator = ColumnMappingGenerator(csv_file, db)
     
-    # Parsear CSV
-    tables = generator.parse_csv()
+    # Leer origen de columnas
+    if args.esquema:
+        tables = generator.load_schema_tables(args.esquema)
+    else:
+        tables = generator.parse_csv()
     
-    # Crear tabla
-    generator.create_mapeo_columnas_table()
+    # Pre-flight: reconciliar CSV, esquema extraído y mapeos existentes
+    schema_file = args.esquema or 'database/schema/schema_extracted.json'
+    if os.path.exists(schema_file):
+        with open(schema_file, 'r', encoding='utf-8') as f:
+            schema = json.load(f)
+        csv_tables = tables if not args.esquema else ColumnMappingGenerator(csv_file, db).parse_csv()
+        reconciler = SchemaReconciler(csv_tables, schema, load_mappings_from_db(db))
+        reconciler.reconcile()
+        reconciler.print_summary()
+        reconciler.save_report()
+    else:
+        print(f"⚠️  {schema_file} no encontrado: se omite la reconciliación")
     
-    # Poblar mapeos
-    total = generator.populate_mappings()
+    if args.completo:
+        # Catálogo completo: conservar la tabla y sincronizar en un solo lote
+        generator.create_mapeo_columnas_table(drop_existing=False)
+        stats = generator.sync_mappings()
+        total = stats['inserted'] + stats['updated'] + stats['unchanged']
+    else:
+        # Crear tabla
+        generator.create_mapeo_columnas_table()
+        
+        # Poblar mapeos
+        total = generator.populate_mappings()
     
     # Generar documentación
-    generator.generate_documentation()
+    generator.generate_documentation(split_dir=args.dividir_docs)
     
     # Resumen
     print("\n" + "=" * 70)
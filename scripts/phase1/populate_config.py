@@ -5,6 +5,7 @@ Lee los resultados del auto-descubrimiento y popula la tabla CONFIG_SISTEMA
 
 import json
 from db_connection import DatabaseConnection
+from sql_script_runner import SQLScriptRunner
 
 
 class ConfigSystemPopulator:
@@ -21,36 +22,15 @@ class ConfigSystemPopulator:
         """Crea la tabla CONFIG_SISTEMA si no existe"""
         print("📋 Creando tabla CONFIG_SISTEMA...")
         
-        # Leer y ejecutar el script SQL
-        with open('database/schema/CONFIG_SISTEMA.sql', 'r', encoding='utf-8') as f:
-            sql_script = f.read()
-        
-        # Ejecutar cada statement (separados por GO)
-        statements = sql_script.split('GO')
-        
-        for statement in statements:
-            statement = statement.strip()
-            if statement and not statement.startswith('--'):
-                try:
-                    self.db.execute_query(statement)
-                except Exception as e:
-                    # Ignorar errores de tabla ya existente
-                    if 'already exists' not in str(e):
-                        print(f"⚠️  {e}")
+        # Ejecutar el script por lotes (GO) sobre la misma conexión
+        runner = SQLScriptRunner(self.db, on_error='stop')
+        runner.run_file('database/schema/CONFIG_SISTEMA.sql')
         
         print("✅ Tabla CONFIG_SISTEMA lista")
     
-    def insert_system_prompt(self):
-        """Inserta el prompt del sistema"""
-        print("💬 Insertando prompt del sistema...")
-        
-        query = """
-        INSERT INTO CONFIG_SISTEMA 
-        (categoria, clave, valor, tipo_dato, prioridad, modificado_por, razon_cambio)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """
-        
-        self.db.execute_query(query, [
+    def build_system_prompt_rows(self):
+        """Filas del prompt del sistema"""
+        return [(
             'PROMPT',
             'SISTEMA_BASE',
             self.discovery['system_prompt'],
@@ -58,21 +38,11 @@ class ConfigSystemPopulator:
             1,  # Máxima prioridad
             'AUTO_DESCUBRIMIENTO',
             'Prompt inicial generado automáticamente por análisis de esquema'
-        ])
-        
-        print("✅ Prompt del sistema insertado")
+        )]
     
-    def insert_business_rules(self):
-        """Inserta las reglas de negocio deducidas"""
-        print(f"📜 Insertando {len(self.discovery['business_rules'])} reglas de negocio...")
-        
-        query = """
-        INSERT INTO CONFIG_SISTEMA 
-        (categoria, clave, valor, tipo_dato, prioridad, modificado_por, razon_cambio)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """
-        
-        inserted = 0
+    def build_business_rule_rows(self):
+        """Filas de las reglas de negocio deducidas"""
+        rows = []
         for i, rule in enumerate(self.discovery['business_rules']):
             # Generar clave única para la regla
             rule_key = f"{rule['type']}_{rule.get('table', 'GLOBAL')}_{rule.get('column', 'GENERAL')}_{i}"
@@ -83,74 +53,151 @@ class ConfigSystemPopulator:
             # Determinar prioridad basada en tipo de regla
             priority = self._get_rule_priority(rule['type'])
             
-            try:
-                self.db.execute_query(query, [
-                    'REGLA_NEGOCIO',
-                    rule_key,
-                    rule_json,
-                    'JSON',
-                    priority,
-                    'AUTO_DESCUBRIMIENTO',
-                    f"Regla deducida automáticamente: {rule['type']}"
-                ])
-                inserted += 1
-            except Exception as e:
-                print(f"⚠️  Error insertando regla {rule_key}: {e}")
-        
-        print(f"✅ {inserted} reglas de negocio insertadas")
+            rows.append((
+                'REGLA_NEGOCIO',
+                rule_key,
+                rule_json,
+                'JSON',
+                priority,
+                'AUTO_DESCUBRIMIENTO',
+                f"Regla deducida automáticamente: {rule['type']}"
+            ))
+        return rows
     
-    def insert_table_descriptions(self):
-        """Inserta las descripciones de tablas"""
-        print(f"📊 Insertando descripciones de {len(self.discovery['table_descriptions'])} tablas...")
+    def build_table_description_rows(self):
+        """Filas de las descripciones de tablas"""
+        return [
+            ('DESCRIPCION_TABLA', table_name, description, 'TEXT', 50,
+             'AUTO_DESCUBRIMIENTO', 'Descripción deducida automáticamente')
+            for table_name, description in self.discovery['table_descriptions'].items()
+        ]
+    
+    def build_metadata_rows(self):
+        """Filas de metadatos del sistema"""
+        return [
+            ('CONFIGURACION', 'VERSION_SISTEMA', '1.0.0', 'TEXT', 10, 'SISTEMA', 'Versión inicial'),
+            ('CONFIGURACION', 'FECHA_INICIALIZACION', self.discovery['metadata']['discovered_at'], 'TEXT', 10, 'SISTEMA', 'Fecha de inicialización'),
+            ('CONFIGURACION', 'TOTAL_TABLAS', str(self.discovery['metadata']['total_tables_analyzed']), 'NUMBER', 10, 'SISTEMA', 'Total de tablas analizadas'),
+            ('CONFIGURACION', 'TOTAL_REGLAS', str(self.discovery['metadata']['total_rules']), 'NUMBER', 10, 'SISTEMA', 'Total de reglas deducidas'),
+            ('CONFIGURACION', 'MODO_ESCRITURA', 'false', 'BOOLEAN', 5, 'SISTEMA', 'Modo de escritura desactivado por seguridad'),
+            ('CONFIGURACION', 'IDIOMA', 'es-ES', 'TEXT', 10, 'SISTEMA', 'Idioma del sistema'),
+        ]
+    
+    def upsert_rows(self, rows):
+        """Aplica filas a CONFIG_SISTEMA con staging + MERGE sobre UQ_CONFIG_CATEGORIA_CLAVE
+
+        Solo se actualizan las filas cuyo valor cambia; en ese caso se incrementa
+        version y se renueva fecha_modificacion. Devuelve inserted/updated/unchanged.
+        """
+        if not rows:
+            return {'inserted': 0, 'updated': 0, 'unchanged': 0}
         
-        query = """
-        INSERT INTO CONFIG_SISTEMA 
+        # 1. Tabla temporal de staging (vive en la sesión de la conexión)
+        self.db.execute_query("""
+        IF OBJECT_ID('tempdb..#CONFIG_SISTEMA_STAGING') IS NOT NULL
+            DROP TABLE #CONFIG_SISTEMA_STAGING;
+        
+        CREATE TABLE #CONFIG_SISTEMA_STAGING (
+            categoria VARCHAR(50) NOT NULL,
+            clave VARCHAR(100) NOT NULL,
+            valor NVARCHAR(MAX) NOT NULL,
+            tipo_dato VARCHAR(20) NOT NULL,
+            prioridad INT,
+            modificado_por VARCHAR(100),
+            razon_cambio NVARCHAR(500),
+            PRIMARY KEY (categoria, clave)
+        );
+        """)
+        
+        # 2. Carga masiva del staging
+        self.db.execute_many("""
+        INSERT INTO #CONFIG_SISTEMA_STAGING
         (categoria, clave, valor, tipo_dato, prioridad, modificado_por, razon_cambio)
         VALUES (?, ?, ?, ?, ?, ?, ?)
-        """
+        """, rows)
+        
+        # 3. MERGE único; la comparación binaria detecta también cambios de mayúsculas
+        result = self.db.execute_query("""
+        SET NOCOUNT ON;
+        DECLARE @acciones TABLE (accion NVARCHAR(10));
+        
+        MERGE CONFIG_SISTEMA WITH (HOLDLOCK) AS t
+        USING #CONFIG_SISTEMA_STAGING AS s
+            ON t.categoria = s.categoria AND t.clave = s.clave
+        WHEN MATCHED AND t.valor COLLATE Latin1_General_BIN2 <> s.valor COLLATE Latin1_General_BIN2 THEN
+            UPDATE SET
+                valor = s.valor,
+                tipo_dato = s.tipo_dato,
+                prioridad = s.prioridad,
+                modificado_por = s.modificado_por,
+                razon_cambio = s.razon_cambio,
+                version = ISNULL(t.version, 1) + 1,
+                fecha_modificacion = GETDATE()
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT (categoria, clave, valor, tipo_dato, prioridad, modificado_por, razon_cambio)
+            VALUES (s.categoria, s.clave, s.valor, s.tipo_dato, s.prioridad, s.modificado_por, s.razon_cambio)
+        OUTPUT $action INTO @acciones;
+        
+        DROP TABLE #CONFIG_SISTEMA_STAGING;
+        
+        SELECT
+            SUM(CASE WHEN accion = 'INSERT' THEN 1 ELSE 0 END) AS inserted,
+            SUM(CASE WHEN accion = 'UPDATE' THEN 1 ELSE 0 END) AS updated
+        FROM @acciones;
+        """)
+        
+        counts = result[0] if result else {}
+        inserted = counts.get('inserted') or 0
+        updated = counts.get('updated') or 0
+        return {
+            'inserted': inserted,
+            'updated': updated,
+            'unchanged': len(rows) - inserted - updated
+        }
+    
+    def _print_upsert_stats(self, stats):
+        """Muestra los contadores de un upsert"""
+        print(f"  ➕ {stats['inserted']} nuevos · ✏️  {stats['updated']} actualizados · ⏸️  {stats['unchanged']} sin cambios")
+    
+    def insert_system_prompt(self):
+        """Inserta el prompt del sistema"""
+        print("💬 Insertando prompt del sistema...")
+        
+        stats = self.upsert_rows(self.build_system_prompt_rows())
+        self._print_upsert_stats(stats)
+        
+        print("✅ Prompt del sistema insertado")
+        return stats
+    
+    def insert_business_rules(self):
+        """Inserta las reglas de negocio deducidas"""
+        print(f"📜 Insertando {len(self.discovery['business_rules'])} reglas de negocio...")
         
-        for table_name, description in self.discovery['table_descriptions'].items():
-            try:
-                self.db.execute_query(query, [
-                    'DESCRIPCION_TABLA',
-                    table_name,
-                    description,
-                    'TEXT',
-                    50,
-                    'AUTO_DESCUBRIMIENTO',
-                    'Descripción deducida automáticamente'
-                ])
-            except Exception as e:
-                print(f"⚠️  Error insertando descripción de {table_name}: {e}")
+        stats = self.upsert_rows(self.build_business_rule_rows())
+        self._print_upsert_stats(stats)
+        
+        print("✅ Reglas de negocio insertadas")
+        return stats
+    
+    def insert_table_descriptions(self):
+        """Inserta las descripciones de tablas"""
+        print(f"📊 Insertando descripciones de {len(self.discovery['table_descriptions'])} tablas...")
+        
+        stats = self.upsert_rows(self.build_table_description_rows())
+        self._print_upsert_stats(stats)
         
         print("✅ Descripciones de tablas insertadas")
+        return stats
     
     def insert_metadata(self):
         """Inserta metadatos del sistema"""
         print("⚙️  Insertando metadatos del sistema...")
         
-        query = """
-        INSERT INTO CONFIG_SISTEMA 
-        (categoria, clave, valor, tipo_dato, prioridad, modificado_por, razon_cambio)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """
-        
-        metadata = [
-            ('CONFIGURACION', 'VERSION_SISTEMA', '1.0.0', 'TEXT', 10, 'SISTEMA', 'Versión inicial'),
-            ('CONFIGURACION', 'FECHA_INICIALIZACION', self.discovery['metadata']['discovered_at'], 'TEXT', 10, 'SISTEMA', 'Fecha de inicialización'),
-            ('CONFIGURACION', 'TOTAL_TABLAS', str(self.discovery['metadata']['total_tables_analyzed']), 'NUMBER', 10, 'SISTEMA', 'Total de tablas analizadas'),
-            ('CONFIGURACION', 'TOTAL_REGLAS', str(self.discovery['metadata']['total_rules']), 'NUMBER', 10, 'SISTEMA', 'Total de reglas deducidas'),
-            ('CONFIGURACION', 'MODO_ESCRITURA', 'false', 'BOOLEAN', 5, 'SISTEMA', 'Modo de escritura desactivado por seguridad'),
-            ('CONFIGURACION', 'IDIOMA', 'es-ES', 'TEXT', 10, 'SISTEMA', 'Idioma del sistema'),
-        ]
-        
-        for config in metadata:
-            try:
-                self.db.execute_query(query, list(config))
-            except Exception as e:
-                print(f"⚠️  Error insertando metadata: {e}")
+        stats = self.upsert_rows(self.build_metadata_rows())
+        self._print_upsert_stats(stats)
         
         print("✅ Metadatos insertados")
+        return stats
     
     def _get_rule_priority(self, rule_type):
         """Determina la prioridad de una regla según su tipo"""
@@ -175,11 +222,18 @@ class ConfigSystemPopulator:
         # Crear tabla
         self.create_config_table()
         
-        # Insertar datos
-        self.insert_system_prompt()
-        self.insert_business_rules()
-        self.insert_table_descriptions()
-        self.insert_metadata()
+        # Insertar datos: todas las filas en un único lote y una única transacción
+        rows = (
+            self.build_system_prompt_rows()
+            + self.build_business_rule_rows()
+            + self.build_table_description_rows()
+            + self.build_metadata_rows()
+        )
+        print(f"📦 Aplicando {len(rows)} registros en una transacción...")
+        
+        with self.db.transaction():
+            stats = self.upsert_rows(rows)
+        self._print_upsert_stats(stats)
         
         # Verificar
         result = self.db.execute_query("SELECT COUNT(*) as total FROM CONFIG_SISTEMA")
@@ -0,0 +1,199 @@
+"""
+FASE 1 - Reconciliador de Columnas
+Cruza las dos fuentes de verdad de columnas:
+1. NOMBRE DE COLUMNAS.csv (leído por ColumnMappingGenerator)
+2. schema_extracted.json (generado por SchemaExtractor)
+y detecta tablas/columnas ausentes en cada lado y mapeos obsoletos en MAPEO_COLUMNAS
+"""
+
+import json
+from datetime import datetime
+
+
+class SchemaReconciler:
+    """Reconcilia CSV, esquema extraído y MAPEO_COLUMNAS mediante índices hash"""
+    
+    def __init__(self, csv_tables, schema, mappings=None):
+        # csv_tables: {tabla: [columnas]} tal como lo devuelve ColumnMappingGenerator.parse_csv
+        self.csv_tables = csv_tables
+        self.schema = schema
+        self.mappings = mappings or []
+        self.report = None
+    
+    @staticmethod
+    def _key(name):
+        """Clave de comparación (SQL Server compara nombres sin distinguir mayúsculas)"""
+        return name.strip().casefold()
+    
+    @staticmethod
+    def _type_hint(column):
+        """Construye la pista de tipo a partir de los metadatos del esquema"""
+        data_type = column.get('DATA_TYPE') or ''
+        length = column.get('CHARACTER_MAXIMUM_LENGTH')
+        if length:
+            data_type += '(MAX)' if length == -1 else f'({length})'
+        if column.get('IS_NULLABLE') == 'NO':
+            data_type += ' NOT NULL'
+        return data_type
+    
+    def build_schema_index(self):
+        """Índice hash: tabla -> {columna: (nombre real, pista de tipo)}"""
+        index = {}
+        for table in self.schema.get('tables', []):
+            columns = {}
+            for column in table.get('columns', []):
+                columns[self._key(column['COLUMN_NAME'])] = (column['COLUMN_NAME'], self._type_hint(column))
+            index[self._key(table['name'])] = (table['name'], columns)
+        return index
+    
+    def reconcile(self):
+        """Ejecuta la reconciliación en una sola pasada lineal sobre cada fuente"""
+        print("🔀 Reconciliando CSV, esquema y MAPEO_COLUMNAS...")
+        
+        schema_index = self.build_schema_index()
+        
+        # Lado de construcción: esquema. Lado de sondeo: CSV.
+        matched_columns = {table_key: set() for table_key in schema_index}
+        missing_tables_in_schema = []
+        missing_columns_in_schema = []
+        type_hints = {}
+        csv_index = {}
+        
+        for table_name, columns in self.csv_tables.items():
+            table_key = self._key(table_name)
+            csv_columns = csv_index.setdefault(table_key, set())
+            entry = schema_index.get(table_key)
+            
+            if entry is None:
+                missing_tables_in_schema.append(table_name)
+                csv_columns.update(self._key(c) for c in columns)
+                continue
+            
+            schema_table, schema_columns = entry
+            seen = matched_columns[table_key]
+            table_hints = {}
+            
+            for column_name in columns:
+                column_key = self._key(column_name)
+                csv_columns.add(column_key)
+                schema_column = schema_columns.get(column_key)
+                if schema_column is None:
+                    missing_columns_in_schema.append(f"{table_name}.{column_name}")
+                else:
+                    seen.add(column_key)
+                    table_hints[schema_column[0]] = schema_column[1]
+            
+            if table_hints:
+                type_hints[schema_table] = table_hints
+        
+        # Lo que queda sin emparejar en el esquema falta en el CSV
+        missing_tables_in_csv = []
+        missing_columns_in_csv = []
+        for table_key, (schema_table, schema_columns) in schema_index.items():
+            if table_key not in csv_index:
+                missing_tables_in_csv.append(schema_table)
+                continue
+            seen = matched_columns[table_key]
+            for column_key, (column_name, _) in schema_columns.items():
+                if column_key not in seen:
+                    missing_columns_in_csv.append(f"{schema_table}.{column_name}")
+        
+        # Mapeos obsoletos: apuntan a tablas/columnas que ya no existen en el esquema
+        stale_mappings = []
+        for mapping in self.mappings:
+            entry = schema_index.get(self._key(mapping['tabla']))
+            if entry is None or self._key(mapping['columna_bd']) not in entry[1]:
+                stale_mappings.append(f"{mapping['tabla']}.{mapping['columna_bd']}")
+        
+        self.report = {
+            'metadata': {
+                'reconciled_at': datetime.now().isoformat(),
+                'csv_tables': len(self.csv_tables),
+                'schema_tables': len(schema_index),
+                'mappings_checked': len(self.mappings)
+            },
+            'missing_tables_in_schema': sorted(missing_tables_in_schema),
+            'missing_tables_in_csv': sorted(missing_tables_in_csv),
+            'missing_columns_in_schema': sorted(missing_columns_in_schema),
+            'missing_columns_in_csv': sorted(missing_columns_in_csv),
+            'stale_mappings': sorted(stale_mappings),
+            'type_hints': type_hints
+        }
+        
+        print("✅ Reconciliación completada")
+        return self.report
+    
+    def is_consistent(self):
+        """True si ambas fuentes coinciden y no hay mapeos obsoletos"""
+        if self.report is None:
+            self.reconcile()
+        return not any(self.report[k] for k in (
+            'missing_tables_in_schema', 'missing_tables_in_csv',
+            'missing_columns_in_schema', 'missing_columns_in_csv',
+            'stale_mappings'
+        ))
+    
+    def print_summary(self, limit=10):
+        """Muestra un resumen de las discrepancias"""
+        if self.report is None:
+            self.reconcile()
+        
+        sections = [
+            ('Tablas del CSV ausentes en el esquema', 'missing_tables_in_schema'),
+            ('Tablas del esquema ausentes en el CSV', 'missing_tables_in_csv'),
+            ('Columnas del CSV ausentes en el esquema', 'missing_columns_in_schema'),
+            ('Columnas del esquema ausentes en el CSV', 'missing_columns_in_csv'),
+            ('Mapeos obsoletos en MAPEO_COLUMNAS', 'stale_mappings'),
+        ]
+        
+        print("\n📊 RESUMEN DE RECONCILIACIÓN:")
+        for title, key in sections:
+            items = self.report[key]
+            status = "✅" if not items else "⚠️ "
+            print(f"  {status} {title}: {len(items)}")
+            for item in items[:limit]:
+                print(f"      • {item}")
+            if len(items) > limit:
+                print(f"      … y {len(items) - limit} más")
+    
+    def save_report(self, output_file='database/schema/reconciliacion_columnas.json'):
+        """Guarda el informe de reconciliación"""
+        if self.report is None:
+            self.reconcile()
+        
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(self.report, f, indent=2, ensure_ascii=False)
+        
+        print(f"💾 Informe guardado en: {output_file}")
+        return output_file
+
+
+def load_mappings_from_db(db):
+    """Lee los pares tabla/columna registrados en MAPEO_COLUMNAS"""
+    try:
+        return db.execute_query("SELECT tabla, columna_bd FROM MAPEO_COLUMNAS")
+    except Exception as e:
+        print(f"⚠️  No se pudo leer MAPEO_COLUMNAS: {e}")
+        return []
+
+
+# Ejecutar reconciliación
+if __name__ == "__main__":
+    from generate_column_mappings import ColumnMappingGenerator
+    
+    print("=" * 70)
+    print("FASE 1 - RECONCILIACIÓN CSV / ESQUEMA")
+    print("=" * 70)
+    
+    # Columnas del CSV (no requiere conexión)
+    generator = ColumnMappingGenerator('../../NOMBRE DE COLUMNAS.csv', None)
+    csv_tables = generator.parse_csv()
+    
+    # Esquema extraído
+    with open('database/schema/schema_extracted.json', 'r', encoding='utf-8') as f:
+        schema = json.load(f)
+    
+    reconciler = SchemaReconciler(csv_tables, schema)
+    reconciler.reconcile()
+    reconciler.print_summary()
+    reconciler.save_report()
@@ -0,0 +1,171 @@
+"""
+FASE 1 - Ejecutor de Scripts T-SQL
+Divide scripts .sql en lotes separados por GO (respetando cadenas, identificadores
+y comentarios) leyendo el fichero en streaming, y los ejecuta sobre una única conexión
+"""
+
+import argparse
+import re
+import time
+from collections import namedtuple
+
+
+# Un lote del script: texto, repeticiones (GO n) y línea donde empieza
+SQLBatch = namedtuple('SQLBatch', ['text', 'repeat', 'line'])
+
+# GO debe ir solo en su línea, opcionalmente con un contador y un comentario
+GO_PATTERN = re.compile(r'^[ \t]*GO(?:[ \t]+(\d+))?[ \t]*(?:--.*)?$', re.IGNORECASE)
+
+# Siguiente token relevante en estado normal
+NORMAL_TOKEN = re.compile(r"--|/\*|'|\[|\"")
+BLOCK_COMMENT_TOKEN = re.compile(r'/\*|\*/')
+
+NORMAL, STRING, BRACKET, QUOTED, COMMENT = range(5)
+
+
+def iter_batches(lines):
+    """Tokeniza un script T-SQL línea a línea y produce los lotes separados por GO
+    
+    Mantiene el estado léxico entre líneas, de modo que un GO dentro de una
+    cadena, un identificador o un comentario de bloque no corta el lote.
+    Los lotes que solo contienen comentarios o espacios se omiten.
+    """
+    state = NORMAL
+    comment_depth = 0
+    buffer = []
+    has_code = False
+    start_line = 1
+    
+    for line_number, line in enumerate(lines, 1):
+        if state == NORMAL:
+            match = GO_PATTERN.match(line.rstrip('\r\n'))
+            if match:
+                if has_code:
+                    yield SQLBatch(''.join(buffer).strip(), int(match.group(1) or 1), start_line)
+                buffer = []
+                has_code = False
+                start_line = line_number + 1
+                continue
+        
+        buffer.append(line)
+        pos = 0
+        length = len(line)
+        
+        while pos < length:
+            if state == NORMAL:
+                match = NORMAL_TOKEN.search(line, pos)
+                end = match.start() if match else length
+                if not has_code and line[pos:end].strip():
+                    has_code = True
+                if not match:
+                    break
+                
+                token = match.group()
+                pos = match.end()
+                if token == '--':
+                    break
+                if token == '/*':
+                    state = COMMENT
+                    comment_depth = 1
+                else:
+                    has_code = True
+                    state = {"'": STRING, '[': BRACKET, '"': QUOTED}[token]
+            
+            elif state == COMMENT:
+                # Los comentarios de bloque de T-SQL pueden anidarse
+                match = BLOCK_COMMENT_TOKEN.search(line, pos)
+                if not match:
+                    break
+                pos = match.end()
+                comment_depth += 1 if match.group() == '/*' else -1
+                if comment_depth == 0:
+                    state = NORMAL
+            
+            else:
+                # Cadenas e identificadores: el delimitador duplicado es un escape
+                closing = {STRING: "'", BRACKET: ']', QUOTED: '"'}[state]
+                index = line.find(closing, pos)
+                if index == -1:
+                    break
+                if line.startswith(closing * 2, index):
+                    pos = index + 2
+                    continue
+                pos = index + 1
+                state = NORMAL
+    
+    if has_code:
+        yield SQLBatch(''.join(buffer).strip(), 1, start_line)
+
+
+class SQLScriptRunner:
+    """Ejecuta scripts T-SQL lote a lote sobre una única conexión"""
+    
+    def __init__(self, db_connection, on_error='stop'):
+        if on_error not in ('stop', 'continue'):
+            raise ValueError("on_error debe ser 'stop' o 'continue'")
+        self.db = db_connection
+        self.on_error = on_error
+        self.results = []
+    
+    def run_file(self, script_file, encoding='utf-8-sig'):
+        """Ejecuta un fichero .sql leyéndolo en streaming"""
+        print(f"📜 Ejecutando script {script_file}...")
+        with open(script_file, 'r', encoding=encoding) as f:
+            return self.run_lines(f, source=script_file)
+    
+    def run_lines(self, lines, source='<script>'):
+        """Ejecuta los lotes de un iterable de líneas y devuelve el resumen"""
+        self.results = []
+        started = time.perf_counter()
+        
+        for batch in iter_batches(lines):
+            for _ in range(batch.repeat):
+                batch_start = time.perf_counter()
+                try:
+                    self.db.execute_query(batch.text)
+                    error = None
+                except Exception as e:
+                    error = str(e)
+                
+                elapsed = time.perf_counter() - batch_start
+                self.results.append({
+                    'line': batch.line,
+                    'seconds': elapsed,
+                    'ok': error is None,
+                    'error': error
+                })
+                
+                if error is None:
+                    print(f"  ✅ Lote línea {batch.line}: {elapsed * 1000:.1f} ms")
+                else:
+                    print(f"  ❌ Lote línea {batch.line} ({elapsed * 1000:.1f} ms): {error}")
+                    if self.on_error == 'stop':
+                        raise Exception(f"Error en {source}, lote de la línea {batch.line}: {error}")
+        
+        summary = {
+            'source': source,
+            'batches': len(self.results),
+            'failed': sum(1 for r in self.results if not r['ok']),
+            'seconds': time.perf_counter() - started
+        }
+        print(f"✅ {summary['batches']} lotes ejecutados en {summary['seconds']:.2f}s ({summary['failed']} con error)")
+        return summary
+
+
+# Ejecutar un script desde línea de comandos
+if __name__ == "__main__":
+    from db_connection import DatabaseConnection
+    
+    parser = argparse.ArgumentParser(description='Ejecuta un script T-SQL separado por GO')
+    parser.add_argument('script', help='Fichero .sql a ejecutar')
+    parser.add_argument('--continuar', action='store_true',
+                        help='Continúa con el siguiente lote si uno falla')
+    args = parser.parse_args()
+    
+    db = DatabaseConnection()
+    db.connect()
+    
+    runner = SQLScriptRunner(db, on_error='continue' if args.continuar else 'stop')
+    runner.run_file(args.script)
+    
+    db.close()